@@ -1,8 +1,13 @@
 """
 Random utilities that don't fit anywhere else. Internal use only.
 """
+import fcntl
+import os
+import shutil
+
 from functools import wraps
 from twisted.internet import defer
+from twisted.python import failure
 
 
 def synchronous(f):
@@ -18,3 +23,111 @@ def synchronous(f):
         return defer.maybeDeferred(f, *a, **kw)
 
     return wrapped
+
+
+
+def readAhead(path, chunkSize=1024 * 1024):
+    """
+    Reads a file sequentially from start to end, so that it is in the
+    operating system's page cache, and then throws the contents away.
+
+    Does nothing if the file does not exist.
+    """
+    try:
+        f = path.open()
+    except (IOError, OSError):
+        return
+
+    with f:
+        while f.read(chunkSize):
+            pass
+
+
+
+_FICLONE = 0x40049409
+"""
+The Linux ioctl that makes a file share the data of another file, copying
+it only when either is written to (a reflink).
+"""
+
+
+
+def cloneFile(source, destination):
+    """
+    Copies a file, as a reflink if the filesystem supports that, and as a
+    regular copy otherwise.
+
+    :param source: The path of the file to copy.
+    :param destination: The path of the copy.
+    """
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except (IOError, OSError):
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    shutil.copystat(source, destination)
+
+
+
+def cloneTree(source, destination):
+    """
+    Copies the directory tree at ``source`` to ``destination``, cloning files
+    with ``cloneFile``.
+
+    :type source: ``FilePath``
+    :type destination: ``FilePath``
+    """
+    for directory, _, files in os.walk(source.path):
+        target = os.path.join(destination.path,
+                              os.path.relpath(directory, source.path))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            cloneFile(os.path.join(directory, name), os.path.join(target, name))
+
+
+
+class Coalescer(object):
+    """
+    Coalesces concurrent calls with the same key: while a call for a key
+    is in flight, further calls for that key don't call anything, but wait
+    for the result of the call in flight.
+    """
+    def __init__(self):
+        self._waiting = {}
+
+
+    def call(self, key, f, *a, **kw):
+        """
+        Calls ``f(*a, **kw)``, unless a call for ``key`` is already in
+        flight.
+
+        :return: A ``Deferred`` that will fire with the result of the call
+            in flight for this key.
+        """
+        d = defer.Deferred()
+        if key in self._waiting:
+            self._waiting[key].append(d)
+            return d
+
+        self._waiting[key] = [d]
+        defer.maybeDeferred(f, *a, **kw).addBoth(self._fire, key)
+        return d
+
+
+    def inFlight(self, key):
+        """
+        Checks if a call for this key is in flight.
+        """
+        return key in self._waiting
+
+
+    def _fire(self, result, key):
+        """
+        Fires all of the deferreds waiting for this key with the result.
+        """
+        for d in self._waiting.pop(key):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
@@ -0,0 +1,543 @@
+"""
+Archiving stores to long-term object storage.
+
+A store is archived as a tarball of its database file and its files
+directory. The tarball is streamed into compressed, content-defined
+chunks of a bounded size, each of which is stored as a separate object
+named after the SHA-256 checksum of its contents. A manifest listing the
+chunks is stored last, so that a partially written archive never
+replaces a complete one.
+
+Chunks that the previous archive of a store already has are not stored
+again, so writing a store that has barely changed only stores a few
+chunks. Chunks that are no longer used are removed by a separate garbage
+collection pass.
+"""
+import hashlib
+import json
+import os
+import tarfile
+import zlib
+
+from axiom import attributes, item
+from contextlib import closing
+from exponent import exceptions, layout, opener
+from twisted.internet import defer, threads
+from zope import interface
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+"""
+The default average number of uncompressed tarball bytes in a chunk.
+"""
+
+
+class CorruptArchiveException(Exception):
+    """
+    An archive could not be read because it is damaged.
+    """
+
+
+
+class StaleTokenException(Exception):
+    """
+    A store was pushed with a fencing token that is older than the one its
+    current archive was written with.
+    """
+
+
+
+class IObjectStore(interface.Interface):
+    """
+    A flat, object-store-like namespace of named blobs.
+
+    Names are ``/``-separated. Methods may be called from any thread.
+    """
+    def put(name, data):
+        """
+        Atomically stores ``data`` under ``name``, replacing any previous
+        object with that name.
+        """
+
+
+    def get(name):
+        """
+        Gets the data stored under ``name``.
+
+        :raises KeyError: If there is no such object.
+        """
+
+
+    def exists(name):
+        """
+        Checks if there is an object stored under ``name``.
+        """
+
+
+    def delete(name):
+        """
+        Deletes the object stored under ``name``, if there is one.
+        """
+
+
+    def list(prefix):
+        """
+        Lists the names of the objects directly under ``prefix``.
+        """
+
+
+
+@interface.implementer(IObjectStore)
+class DirectoryObjectStore(object):
+    """
+    An object store in a local directory, with one file per object.
+    """
+    def __init__(self, path):
+        self.path = path
+
+
+    def _pathFor(self, name):
+        return self.path.descendant(name.split("/"))
+
+
+    def put(self, name, data):
+        path = self._pathFor(name)
+        if not path.parent().isdir():
+            path.parent().makedirs()
+        temporary = path.temporarySibling()
+        temporary.setContent(data)
+        os.rename(temporary.path, path.path)
+
+
+    def get(self, name):
+        try:
+            return self._pathFor(name).getContent()
+        except (IOError, OSError):
+            raise KeyError(name)
+
+
+    def exists(self, name):
+        return self._pathFor(name).isfile()
+
+
+    def delete(self, name):
+        path = self._pathFor(name)
+        if path.isfile():
+            path.remove()
+
+
+    def list(self, prefix):
+        path = self._pathFor(prefix)
+        if not path.isdir():
+            return []
+        return [prefix + "/" + child.basename()
+                for child in path.children() if child.isfile()]
+
+
+
+def _manifestName(key):
+    return key + "/manifest"
+
+
+
+def _previousManifestName(key):
+    return key + "/manifest.previous"
+
+
+
+def _chunkName(key, checksum):
+    return key + "/chunks/" + checksum
+
+
+
+class _ChunkWriter(object):
+    """
+    A write-only file that stores what is written to it as compressed,
+    checksummed, content-defined chunks.
+
+    Chunk boundaries are only ever placed between tar blocks. Everything in
+    a tarball, including the pages of the SQLite database, is aligned to
+    tar blocks, so a boundary is placed after a block when the block's
+    CRC-32 matches a pattern. This way, a change to one part of the store
+    only changes the chunks around it, even if it shifts the rest of the
+    tarball.
+
+    Chunks with checksums in ``known`` are assumed to already be stored,
+    and are not stored again.
+    """
+    def __init__(self, objectStore, key, chunkSize, known=frozenset()):
+        self._objectStore = objectStore
+        self._key = key
+        self._minimum = max(chunkSize // 4, tarfile.BLOCKSIZE)
+        self._maximum = chunkSize * 4
+        self._divisor = max((chunkSize - self._minimum) // tarfile.BLOCKSIZE, 1)
+        self._known = known
+
+        self._pending, self._scanned = bytearray(), 0
+        self.chunks = []
+        self.uploaded = 0
+
+
+    def write(self, data):
+        self._pending += data
+
+        block = tarfile.BLOCKSIZE
+        while self._scanned + block <= len(self._pending):
+            crc = zlib.crc32(buffer(self._pending, self._scanned, block))
+            self._scanned += block
+
+            if self._scanned < self._minimum:
+                continue
+            if crc % self._divisor == 0 or self._scanned >= self._maximum:
+                self._storeChunk(str(self._pending[:self._scanned]))
+                del self._pending[:self._scanned]
+                self._scanned = 0
+
+
+    def flush(self):
+        """
+        Stores whatever has been written but not stored yet as a final
+        chunk.
+        """
+        if self._pending:
+            self._storeChunk(str(self._pending))
+            self._pending, self._scanned = bytearray(), 0
+
+
+    def _storeChunk(self, data):
+        checksum = hashlib.sha256(data).hexdigest()
+        if checksum not in self._known:
+            compressed = zlib.compress(data)
+            self._objectStore.put(_chunkName(self._key, checksum), compressed)
+            self.uploaded += len(compressed)
+        self.chunks.append([checksum, len(data)])
+
+
+
+class _ChunkReader(object):
+    """
+    A read-only file that reads, decompresses and verifies chunks.
+    """
+    def __init__(self, objectStore, key, chunks):
+        self._objectStore = objectStore
+        self._key = key
+        self._chunks = iter(chunks)
+        self._buffer, self._offset = "", 0
+
+
+    def read(self, size):
+        if self._offset == len(self._buffer):
+            self._buffer, self._offset = self._nextChunk(), 0
+
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+
+    def _nextChunk(self):
+        """
+        Reads the next chunk, or returns the empty string if there are no
+        chunks left.
+
+        :raises CorruptArchiveException: If the chunk is missing or damaged.
+        """
+        try:
+            checksum, size = next(self._chunks)
+        except StopIteration:
+            return ""
+
+        try:
+            compressed = self._objectStore.get(_chunkName(self._key, checksum))
+            data = zlib.decompress(compressed)
+        except (KeyError, zlib.error):
+            raise CorruptArchiveException("unreadable chunk", checksum)
+
+        if len(data) != size or hashlib.sha256(data).hexdigest() != checksum:
+            raise CorruptArchiveException("bad chunk checksum", checksum)
+
+        return data
+
+
+
+def _checkToken(objectStore, key, token):
+    """
+    Checks that a fencing token isn't older than that of the current
+    archive of a store.
+
+    :return: The token to record in the new archive: the newest of the two.
+    :raises StaleTokenException: If it is older.
+    """
+    try:
+        current = json.loads(objectStore.get(_manifestName(key))).get("token")
+    except KeyError:
+        current = None
+
+    if token is None or current is None:
+        return token if current is None else current
+    if token < current:
+        raise StaleTokenException(token, current)
+    return token
+
+
+
+def pack(storePath, objectStore, key, chunkSize=DEFAULT_CHUNK_SIZE,
+         token=None):
+    """
+    Synchronously archives the store at the given path.
+
+    If a fencing token is given, it is recorded in the manifest, and
+    archives with a newer token are never replaced.
+
+    Only chunks that aren't in the previous archive of this store are
+    stored. At most about four times ``chunkSize`` bytes of the store are
+    in memory at any time. No chunks are deleted: the manifest that is
+    replaced is kept as the previous manifest, and chunks that neither uses
+    are removed by ``collectGarbage``.
+
+    This must not run concurrently with ``pack`` or ``collectGarbage`` for
+    the same key.
+
+    :return: The manifest of the new archive, with the number of
+        compressed bytes that were stored under ``"uploaded"``.
+    :rtype: ``dict``
+    :raises StaleTokenException: If the current archive was written with a
+        newer fencing token.
+    """
+    _checkToken(objectStore, key, token)
+    known = frozenset(checksum for checksum, _ in _chunksOf(objectStore, key))
+    writer = _ChunkWriter(objectStore, key, chunkSize, known)
+    with closing(tarfile.open(fileobj=writer, mode="w|")) as tar:
+        tar.add(storePath.child("db.sqlite").path, "db.sqlite")
+        filesPath = storePath.child("files")
+        if filesPath.isdir():
+            tar.add(filesPath.path, "files")
+    writer.flush()
+
+    manifest = {"format": 1, "chunks": writer.chunks}
+    token = _checkToken(objectStore, key, token)
+    if token is not None:
+        manifest["token"] = token
+    try:
+        previous = objectStore.get(_manifestName(key))
+    except KeyError:
+        pass
+    else:
+        objectStore.put(_previousManifestName(key), previous)
+    objectStore.put(_manifestName(key), json.dumps(manifest))
+
+    return dict(manifest, uploaded=writer.uploaded)
+
+
+
+def collectGarbage(objectStore, key):
+    """
+    Synchronously deletes the chunks of a store that are used by neither its
+    current nor its previous archive. Readers that have just read the
+    previous manifest can still read all of its chunks.
+
+    This must not run concurrently with ``pack`` for the same key, since
+    the chunks it is storing aren't in a manifest yet.
+
+    :return: The number of chunks that were deleted.
+    """
+    used = set(_chunkName(key, checksum) for checksum, _
+               in _chunksOf(objectStore, key, _manifestName(key))
+               + _chunksOf(objectStore, key, _previousManifestName(key)))
+    deleted = 0
+    for name in objectStore.list(key + "/chunks"):
+        if name not in used:
+            objectStore.delete(name)
+            deleted += 1
+    return deleted
+
+
+
+def _chunksOf(objectStore, key, manifestName=None):
+    """
+    Gets the chunks in the current archive of a store (or the one with the
+    given manifest), or an empty list if there is no such archive.
+    """
+    if manifestName is None:
+        manifestName = _manifestName(key)
+    try:
+        return json.loads(objectStore.get(manifestName))["chunks"]
+    except KeyError:
+        return []
+
+
+
+def _safeMembers(tar):
+    """
+    Yields the members of the tarball, making sure they are regular files
+    or directories that stay inside the extraction directory.
+
+    :raises CorruptArchiveException: If an unsafe member is found.
+    """
+    for member in tar:
+        name = member.name
+        if os.path.isabs(name) or ".." in name.split("/"):
+            raise CorruptArchiveException("unsafe member name", name)
+        if not (member.isfile() or member.isdir()):
+            raise CorruptArchiveException("unsafe member type", name)
+        yield member
+
+
+
+def unpack(objectStore, key, storePath):
+    """
+    Synchronously restores an archived store to the given path.
+
+    The store is extracted next to ``storePath`` and then moved into place,
+    so ``storePath`` never contains a partially restored store.
+
+    :raises NoSuchStoreException: If there is no archive for this store.
+    :raises CorruptArchiveException: If the archive is damaged.
+    """
+    try:
+        manifest = json.loads(objectStore.get(_manifestName(key)))
+    except KeyError:
+        raise exceptions.NoSuchStoreException()
+
+    reader = _ChunkReader(objectStore, key, manifest["chunks"])
+    temporary = storePath.temporarySibling(layout.TEMPORARY_EXTENSION)
+    temporary.makedirs()
+    try:
+        with closing(tarfile.open(fileobj=reader, mode="r|")) as tar:
+            for member in _safeMembers(tar):
+                tar.extract(member, temporary.path)
+        temporary.moveTo(storePath)
+    except:
+        if temporary.exists():
+            temporary.remove()
+        raise
+
+
+
+class IStoreArchive(interface.Interface):
+    """
+    Long-term storage for stores that are used locally.
+
+    Long-term storage and lock directories fetch stores that aren't
+    available locally from the ``IStoreArchive`` powerup of their root
+    store, and write locks push stores back to it.
+    """
+    def fetch(pathSegments, storePath):
+        """
+        Restores the archived store to a local path.
+
+        :return: A deferred that will fire when the store has been restored,
+            or fail with ``NoSuchStoreException`` if it was never archived.
+        """
+
+
+    def push(pathSegments, storePath, token=None):
+        """
+        Archives the store at the local path.
+
+        :param token: If given, the fencing token of the lock the store is
+            written with. Archives written with newer tokens are never
+            replaced.
+        :return: A deferred that will fire when the store has been archived,
+            or fail with ``StaleTokenException`` if it was archived with a
+            newer token.
+        """
+
+
+
+@interface.implementer(IStoreArchive)
+class DirectoryArchive(item.Item):
+    """
+    Archives stores in an object store in a local directory.
+
+    Archiving and restoring happens in the reactor's thread pool. Stores
+    should not be changed while they are being archived. Pushes of the same
+    store are done one at a time, each followed by garbage collection of
+    the chunks that are no longer used.
+    """
+    powerupInterfaces = [IStoreArchive]
+
+    path = attributes.path(allowNone=False)
+    """
+    The directory that objects are stored in.
+    """
+
+    chunkSize = attributes.integer(allowNone=False, default=DEFAULT_CHUNK_SIZE)
+    """
+    The average number of uncompressed bytes in a chunk.
+    """
+
+    _locks = attributes.inmemory()
+
+    def activate(self):
+        self._locks = {}
+
+
+    def _objectStore(self):
+        return DirectoryObjectStore(self.path)
+
+
+    def _serialized(self, key, f, *a, **kw):
+        """
+        Runs ``f`` once nothing else is running for the same key.
+        """
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = defer.DeferredLock()
+
+        d = lock.run(f, *a, **kw)
+
+        @d.addBoth
+        def forgetLock(result):
+            if not lock.locked and self._locks.get(key) is lock:
+                del self._locks[key]
+            return result
+
+        return d
+
+
+    def fetch(self, pathSegments, storePath):
+        key = "/".join(pathSegments)
+        return threads.deferToThread(unpack, self._objectStore(), key,
+                                     storePath)
+
+
+    def push(self, pathSegments, storePath, token=None):
+        key = "/".join(pathSegments)
+        return self._serialized(key, threads.deferToThread, self._pushSync,
+                                storePath, key, token)
+
+
+    def _pushSync(self, storePath, key, token):
+        """
+        Synchronously archives a store, and collects the garbage left over.
+        """
+        objectStore = self._objectStore()
+        manifest = pack(storePath, objectStore, key, self.chunkSize, token)
+        collectGarbage(objectStore, key)
+        return manifest
+
+
+
+def openStore(rootStore, pathSegments, storePath):
+    """
+    Opens a local store with the root store's store opener. If the store
+    isn't available locally, it is fetched from the root store's archive
+    first, if it has one.
+
+    :return: A deferred that will fire with the store, or fail with
+        ``NoSuchStoreException``.
+    """
+    storeOpener = opener.getOpener(rootStore)
+    d = storeOpener.open(storePath)
+
+    archive = IStoreArchive(rootStore, None)
+    if archive is None:
+        return d
+
+    @d.addErrback
+    def fetchMissing(failure):
+        failure.trap(exceptions.NoSuchStoreException)
+        fetched = archive.fetch(pathSegments, storePath)
+        return fetched.addCallback(lambda _: storeOpener.open(storePath))
+
+    return d
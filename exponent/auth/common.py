@@ -1,13 +1,15 @@
 """
 The base model for users.
 """
-from axiom import attributes, item, scheduler
+from axiom import attributes, item, scheduler, upgrade
 from datetime import timedelta
 from epsilon import extime
 from exponent import substore, _util
+from math import ceil
 from os import urandom
 from twisted.cred import checkers, credentials, error
 from twisted.protocols import amp
+import weakref
 from zope import interface
 
 
@@ -53,16 +55,27 @@ def _createIdentifier(bits=160, _urandom=urandom):
 
 
 
+def _expiry():
+    """
+    Computes when a token that is created now expires.
+    """
+    return extime.Time() + Token.validity
+
+
+
 class Token(item.Item):
     """
     An authentication token.
     """
+    schemaVersion = 3
+
     validity = timedelta(seconds=60)
     """
     The amount of time to wait before automatically removing the token.
     """
 
-    identifier = attributes.bytes(defaultFactory=_createIdentifier)
+    identifier = attributes.bytes(defaultFactory=_createIdentifier,
+                                  indexed=True)
     """
     The identifier of this token.
     """
@@ -72,20 +85,108 @@ class Token(item.Item):
     The authentication method that this token was created with.
     """
 
+    expiresAt = attributes.timestamp(allowNone=False, defaultFactory=_expiry,
+                                     indexed=True)
+    """
+    When this token stops being valid, and is removed.
+    """
+
 
     def stored(self):
         """
-        Schedules the token to be invalidated.
+        Makes sure the token will be removed once it has expired.
+        """
+        self.store.findOrCreate(_TokenSweeper).expect(self.expiresAt)
+
+
+
+item.declareLegacyItem(Token.typeName, 1, {
+    "identifier": attributes.bytes(),
+    "source": attributes.bytes(allowNone=False)
+})
+
+upgrade.registerAttributeCopyingUpgrader(Token, 1, 2)
+
+
+
+item.declareLegacyItem(Token.typeName, 2, {
+    "identifier": attributes.bytes(indexed=True),
+    "source": attributes.bytes(allowNone=False)
+})
+
+
+
+def _token2to3(old):
+    """
+    Gives a token an expiry time. Older tokens still have their own
+    invalidator, which removes them before then.
+    """
+    return old.upgradeVersion(Token.typeName, 2, 3,
+                              identifier=old.identifier,
+                              source=old.source,
+                              expiresAt=_expiry())
+
+upgrade.registerUpgrader(_token2to3, Token.typeName, 2, 3)
+
+
+
+class _TokenSweeper(item.Item):
+    """
+    Removes all expired tokens from a store at once.
+
+    There is one sweeper per store, scheduled to run when the oldest token
+    expires, and then again while there are tokens left. It runs at most
+    once every ``interval``, so that tokens that expire close together are
+    removed together.
+    """
+    interval = timedelta(seconds=10)
+    """
+    The minimum amount of time between two sweeps.
+    """
+
+    nextSweep = attributes.timestamp()
+    """
+    When the sweeper is scheduled to run, or ``None`` if it isn't.
+    """
+
+    def expect(self, expiresAt):
+        """
+        Makes sure the sweeper runs at some point after a token expires.
         """
-        invalidator = _TokenInvalidator(store=self.store, token=self)
-        when = extime.Time() + self.validity
-        scheduler.IScheduler(self.store).schedule(invalidator, when)
+        if self.nextSweep is None:
+            self.nextSweep = expiresAt
+            scheduler.IScheduler(self.store).schedule(self, expiresAt)
+
+
+    def run(self):
+        """
+        Removes the expired tokens, and reschedules the sweeper if there are
+        tokens left.
+
+        The scheduler runs this in a single transaction. Tokens are deleted
+        one by one, rather than with a single query, so that tokens that
+        are loaded know that they've been deleted.
+        """
+        now = scheduler.IScheduler(self.store).now()
+        for token in list(self.store.query(Token, Token.expiresAt <= now)):
+            token.deleteFromStore()
+
+        remaining = self.store.query(Token, sort=Token.expiresAt.ascending,
+                                     limit=1)
+        for token in remaining:
+            self.nextSweep = max(token.expiresAt, now + self.interval)
+            return self.nextSweep
+
+        self.nextSweep = None
 
 
 
 class _TokenInvalidator(item.Item):
     """
     When run, invalidates a token by deleting it from the store.
+
+    Tokens are no longer given an invalidator, but invalidators scheduled
+    for older tokens still run.
     """
     token = attributes.reference(allowNone=False)
 
@@ -99,6 +200,250 @@ class _TokenInvalidator(item.Item):
 
 
 
+class ITokenStore(interface.Interface):
+    """
+    Somewhere to keep users' authentication tokens.
+
+    A root store may have a token store powerup. Otherwise, tokens are kept
+    as ``Token`` items in the users' stores.
+    """
+    def issue(user, source):
+        """
+        Issues a new token for a user.
+
+        :param user: The user the token is for.
+        :type user: ``User``
+        :param source: The authentication method that created the token.
+        :type source: ``bytes``
+        :return: The identifier of the new token.
+        :rtype: ``bytes``
+        """
+
+
+    def getSources(user, identifiers):
+        """
+        Gets the sources of a user's tokens that have these identifiers and
+        haven't expired. Identifiers without such a token are ignored.
+
+        :type user: ``User``
+        :param identifiers: The token identifiers.
+        :return: The sources, one for each valid token.
+        :rtype: ``list`` of ``bytes``
+        """
+
+
+
+@interface.implementer(ITokenStore)
+class StoredTokens(object):
+    """
+    Keeps tokens as ``Token`` items in the users' stores.
+    """
+    def issue(self, user, source):
+        userStore = user.store
+        return userStore.transact(
+            lambda: Token(store=userStore, source=source).identifier)
+
+
+    def getSources(self, user, identifiers):
+        presented = Token.identifier.oneOf(identifiers)
+        valid = attributes.AND(presented, Token.expiresAt > extime.Time())
+        return list(user.store.query(Token, valid).getColumn("source"))
+
+
+
+class _TimingWheel(object):
+    """
+    Keeps track of when keys expire, in slots of ``resolution`` seconds.
+
+    Adding a key takes constant time, and so does expiring the keys in a
+    slot, however many keys there are. Keys can expire at most
+    ``size - 1`` slots from now.
+    """
+    def __init__(self, clock, resolution=1, size=64):
+        self.resolution = resolution
+        self._clock = clock
+        self._slots = [set() for _ in xrange(size)]
+        self._tick = self._now()
+
+
+    def _now(self):
+        """
+        Gets the current tick.
+        """
+        return int(self._clock.seconds() // self.resolution)
+
+
+    def _slotFor(self, expiresAt):
+        """
+        Gets the slot for keys that expire at the given time, or ``None`` if
+        they have already expired.
+
+        :raises ValueError: If that time is too far in the future.
+        """
+        tick = int(ceil(expiresAt / self.resolution))
+        if tick <= self._tick:
+            return None
+        if tick - self._tick >= len(self._slots):
+            raise ValueError("%r is too far in the future" % (expiresAt,))
+        return self._slots[tick % len(self._slots)]
+
+
+    def add(self, key, expiresAt):
+        """
+        Adds a key that expires at the given time.
+        """
+        slot = self._slotFor(expiresAt)
+        if slot is not None:
+            slot.add(key)
+
+
+    def advance(self):
+        """
+        Moves the wheel to the current time.
+
+        :return: The keys that have expired since the last call.
+        """
+        now = self._now()
+        last = min(now, self._tick + len(self._slots))
+        expired = set()
+        for tick in xrange(self._tick + 1, last + 1):
+            slot = self._slots[tick % len(self._slots)]
+            expired.update(slot)
+            slot.clear()
+        self._tick = now
+        return expired
+
+
+
+@interface.implementer(ITokenStore)
+class MemoryTokens(object):
+    """
+    Keeps tokens in memory, so that issuing and checking them doesn't touch
+    the disk. Tokens are lost when the process stops, which is fine since
+    they are only valid for a minute.
+
+    Tokens are kept in dictionaries by user identifier, spread over a number
+    of shards, and are expired by a timing wheel, as time passes.
+    """
+    def __init__(self, shardCount=16, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self._clock = clock
+        self._shards = [{} for _ in xrange(shardCount)]
+        size = int(Token.validity.total_seconds()) + 2
+        self._wheel = _TimingWheel(clock, size=size)
+
+
+    def _shardFor(self, userIdentifier):
+        """
+        Gets the shard with the tokens of a user.
+        """
+        return self._shards[hash(userIdentifier) % len(self._shards)]
+
+
+    def _expire(self):
+        """
+        Forgets the tokens that have expired.
+        """
+        for userIdentifier, identifier in self._wheel.advance():
+            shard = self._shardFor(userIdentifier)
+            tokens = shard[userIdentifier]
+            del tokens[identifier]
+            if not tokens:
+                del shard[userIdentifier]
+
+
+    def issue(self, user, source):
+        self._expire()
+        identifier = _createIdentifier()
+        expiresAt = self._clock.seconds() + Token.validity.total_seconds()
+        shard = self._shardFor(user.identifier)
+        shard.setdefault(user.identifier, {})[identifier] = source, expiresAt
+        self._wheel.add((user.identifier, identifier), expiresAt)
+        return identifier
+
+
+    def getSources(self, user, identifiers):
+        self._expire()
+        tokens = self._shardFor(user.identifier).get(user.identifier, {})
+        now = self._clock.seconds()
+        sources = []
+        for identifier in identifiers:
+            source, expiresAt = tokens.get(identifier, (None, now))
+            if expiresAt > now:
+                sources.append(source)
+        return sources
+
+
+
+_memoryTokens = weakref.WeakKeyDictionary()
+
+
+
+@interface.implementer(ITokenStore)
+class MemoryTokenStore(item.Item):
+    """
+    A root store powerup that keeps the tokens of its users in memory.
+
+    The tokens are kept by a ``MemoryTokens`` for the root store, which
+    outlives this item being reloaded.
+    """
+    powerupInterfaces = [ITokenStore]
+
+    shardCount = attributes.integer(allowNone=False, default=16)
+    """
+    The number of shards to spread the tokens over.
+    """
+
+    tokens = attributes.inmemory()
+    """
+    The tokens of the root store's users.
+
+    :type: ``MemoryTokens``
+    """
+
+    def activate(self):
+        try:
+            self.tokens = _memoryTokens[self.store]
+        except KeyError:
+            self.tokens = MemoryTokens(self.shardCount)
+            _memoryTokens[self.store] = self.tokens
+
+
+    def issue(self, user, source):
+        return self.tokens.issue(user, source)
+
+
+    def getSources(self, user, identifiers):
+        return self.tokens.getSources(user, identifiers)
+
+
+
+def getTokenStore(userStore):
+    """
+    Gets the token store for the users under the root store of the given
+    user store.
+    """
+    if userStore.parent is not None:
+        tokenStore = ITokenStore(userStore.parent, None)
+        if tokenStore is not None:
+            return tokenStore
+    return StoredTokens()
+
+
+
+def issueToken(user, source):
+    """
+    Issues a new token for a user, in the token store for that user.
+
+    :return: The identifier of the new token.
+    :rtype: ``bytes``
+    """
+    return getTokenStore(user.store).issue(user, source)
+
+
+
 class ITokenSet(credentials.ICredentials):
     """
     A set of tokens identifiers being used to log in.
@@ -147,15 +492,18 @@ class TokenCounter(item.Item):
 
     @_util.synchronous
     def requestAvatarId(self, credentials, mind=None):
-        identifiers, sources = set(), set()
-        for token in self.store.query(Token):
-            identifiers.add(token.identifier)
-            if token.source in sources:
-                raise error.UnauthorizedLogin()
-            else:
-                sources.add(token.source)
-
-        if len(identifiers & credentials.identifiers) >= self.requiredTokens:
-            return self.store.findUnique(User).identifier
+        """
+        Checks the presented tokens, in the token store for this user. Only
+        those tokens are looked up, so this doesn't get slower as a user has
+        more outstanding tokens. Expired tokens aren't accepted.
+        """
+        user = self.store.findUnique(User)
+        tokenStore = getTokenStore(self.store)
+        sources = tokenStore.getSources(user, credentials.identifiers)
+        if len(set(sources)) != len(sources):
+            raise error.UnauthorizedLogin()
+
+        if len(sources) >= self.requiredTokens:
+            return user.identifier
         else:
             raise error.UnauthorizedLogin()
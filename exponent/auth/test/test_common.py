@@ -2,11 +2,13 @@
 Tests for common authentication infrastructure.
 """
 from axiom import errors, scheduler, store
+from datetime import timedelta
 from epsilon import extime
 from exponent.auth import common
 from inspect import getargspec
 from os import urandom
 from twisted.cred import credentials
+from twisted.internet import task
 from twisted.trial import unittest
 from txampext import commandtests
 
@@ -166,6 +168,59 @@ class TokenInvalidationTests(unittest.TestCase):
         self.scheduler.tick()
 
 
+    def test_noInvalidatorPerToken(self):
+        """Tokens don't get an invalidator of their own; a single sweeper is
+        scheduled for all of them.
+
+        """
+        for _ in xrange(3):
+            common.Token(store=self.store, source="test")
+        self.assertEqual(self.store.count(common._TokenInvalidator), 0)
+        sweeper = self.store.findUnique(common._TokenSweeper)
+        self.assertEqual(len(list(self.scheduler.scheduledTimes(sweeper))), 1)
+
+
+    def test_sweepInBatches(self):
+        """The sweeper removes all expired tokens at once, and runs again for
+        the tokens that are left, until there are none.
+
+        """
+        first = common.Token(store=self.store, source="test")
+        second = common.Token(store=self.store, source="test")
+        later = common.Token(store=self.store, source="test",
+                             expiresAt=first.expiresAt + timedelta(seconds=1))
+
+        self.now = second.expiresAt
+        self.scheduler.tick()
+        self.assertIdentical(first.store, None)
+        self.assertIdentical(second.store, None)
+        self.assertIdentical(later.store, self.store)
+
+        sweeper = self.store.findUnique(common._TokenSweeper)
+        [nextSweep] = self.scheduler.scheduledTimes(sweeper)
+        self.assertEqual(nextSweep, self.now + sweeper.interval)
+
+        self.now = nextSweep
+        self.scheduler.tick()
+        self.assertIdentical(later.store, None)
+        self.assertEqual(list(self.scheduler.scheduledTimes(sweeper)), [])
+        self.assertIdentical(sweeper.nextSweep, None)
+
+
+    def test_legacyInvalidator(self):
+        """Invalidators that were scheduled for older tokens still remove
+        them.
+
+        """
+        token = common.Token(store=self.store, source="test",
+                             expiresAt=extime.Time() + timedelta(days=1))
+        invalidator = common._TokenInvalidator(store=self.store, token=token)
+        self.scheduler.schedule(invalidator, extime.Time() + token.validity)
+        self.now = extime.Time() + token.validity
+        self.scheduler.tick()
+        self.assertIdentical(token.store, None)
+
+
 
 class TokenTests(object):
     """Tests for token implementations.
@@ -326,3 +381,177 @@ class TokenCounterTests(unittest.TestCase):
         """
         otherToken = common.Token(store=self.store, source=self.token.source)
         self._assertNotAccepts([self.token.identifier, otherToken.identifier])
+
+
+    def test_ignoreTokensNotPresented(self):
+        """The token counter only looks at the presented tokens. Other tokens
+        with the same source don't stop them from being accepted.
+
+        """
+        common.Token(store=self.store, source=self.token.source)
+        self._assertAccepts([self.token.identifier])
+
+
+    def test_dontAcceptTokensFromAnotherStore(self):
+        """The token counter does not accept tokens of another user.
+
+        """
+        otherToken = common.Token(store=store.Store(), source="magic")
+        self._assertNotAccepts([otherToken.identifier])
+
+
+    def test_dontAcceptExpiredTokens(self):
+        """The token counter does not accept tokens that have expired, even
+        if they haven't been removed yet.
+
+        """
+        self.token.expiresAt = extime.Time() - timedelta(seconds=1)
+        self._assertNotAccepts([self.token.identifier])
+
+
+
+class TimingWheelTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = common._TimingWheel(self.clock, size=10)
+
+
+    def test_expire(self):
+        """Keys expire once their expiry time has passed.
+
+        """
+        self.wheel.add("a", 2)
+        self.wheel.add("b", 4.5)
+        self.clock.advance(2)
+        self.assertEqual(self.wheel.advance(), set(["a"]))
+        self.clock.advance(3)
+        self.assertEqual(self.wheel.advance(), set(["b"]))
+        self.assertEqual(self.wheel.advance(), set())
+
+
+    def test_advanceFarAhead(self):
+        """Advancing past the whole wheel expires everything.
+
+        """
+        self.wheel.add("a", 3)
+        self.wheel.add("b", 9)
+        self.clock.advance(100)
+        self.assertEqual(self.wheel.advance(), set(["a", "b"]))
+
+
+    def test_tooFarAhead(self):
+        """Keys can't expire further in the future than the wheel reaches.
+
+        """
+        self.assertRaises(ValueError, self.wheel.add, "a", 10)
+
+
+
+class TokenStoreTests(object):
+    """Tests for token store implementations.
+
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.rootStore = store.Store(self.mktemp())
+        self.installTokenStore()
+        userStore = common.User.createChildStore(self.rootStore, ["uid"])
+        self.user = common.User(store=userStore, identifier="uid")
+        self.tokenStore = common.getTokenStore(userStore)
+
+
+    def installTokenStore(self):
+        """Installs the token store being tested, if necessary.
+
+        """
+
+
+    def test_interface(self):
+        self.assertTrue(common.ITokenStore.providedBy(self.tokenStore))
+
+
+    def test_issueAndGetSources(self):
+        """The sources of issued tokens can be looked up by identifier.
+        Unknown identifiers are ignored.
+
+        """
+        a = common.issueToken(self.user, "password")
+        b = common.issueToken(self.user, "session")
+        sources = self.tokenStore.getSources(self.user, [a, b, "BOGUS"])
+        self.assertEqual(sorted(sources), ["password", "session"])
+
+
+    def test_login(self):
+        """The token counter checks tokens in the token store.
+
+        """
+        counter = common.TokenCounter(store=self.user.store)
+        identifier = common.issueToken(self.user, "password")
+        d = counter.requestAvatarId(common.TokenSet([identifier]))
+        self.assertEqual(self.successResultOf(d), "uid")
+
+
+
+class StoredTokensTests(TokenStoreTests, unittest.TestCase):
+    def test_default(self):
+        """Without a token store powerup, tokens are stored in the user's
+        store.
+
+        """
+        self.assertIsInstance(self.tokenStore, common.StoredTokens)
+        common.issueToken(self.user, "password")
+        self.assertEqual(self.user.store.count(common.Token), 1)
+
+
+
+class MemoryTokensTests(TokenStoreTests, unittest.TestCase):
+    def installTokenStore(self):
+        tokenStore = common.MemoryTokenStore(store=self.rootStore)
+        self.rootStore.powerUp(tokenStore)
+        tokens = common.MemoryTokens(clock=self.clock)
+        self.patch(common, "_memoryTokens", {self.rootStore: tokens})
+        tokenStore.tokens = tokens
+
+
+    def test_inMemory(self):
+        """Tokens aren't stored in the user's store.
+
+        """
+        common.issueToken(self.user, "password")
+        self.assertEqual(self.user.store.count(common.Token), 0)
+
+
+    def test_sharedTokens(self):
+        """Every instance of the powerup for a root store shares the same
+        tokens.
+
+        """
+        other = common.MemoryTokenStore(store=self.rootStore)
+        self.assertIdentical(other.tokens, self.tokenStore.tokens)
+
+
+    def test_expiry(self):
+        """Tokens expire after their validity period, and are then
+        forgotten.
+
+        """
+        identifier = common.issueToken(self.user, "password")
+        self.clock.advance(common.Token.validity.total_seconds() - 1)
+        self.assertEqual(self.tokenStore.getSources(self.user, [identifier]),
+                         ["password"])
+
+        self.clock.advance(1)
+        self.assertEqual(self.tokenStore.getSources(self.user, [identifier]),
+                         [])
+        self.assertEqual(sum(map(len, self.tokenStore.tokens._shards)), 0)
+
+
+    def test_usersAreSeparate(self):
+        """Users can't use each other's tokens.
+
+        """
+        otherStore = common.User.createChildStore(self.rootStore, ["other"])
+        other = common.User(store=otherStore, identifier="other")
+        identifier = common.issueToken(other, "password")
+        self.assertEqual(self.tokenStore.getSources(self.user, [identifier]),
+                         [])
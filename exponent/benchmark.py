@@ -0,0 +1,261 @@
+"""
+Benchmarks for long-term storage and write locks.
+
+Run ``python -m exponent.benchmark --help`` for usage. Results are written
+as JSON, so that runs can be compared.
+"""
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from axiom import attributes, item, store
+from exponent import archive, directory, storage
+from twisted.internet import defer, task
+from twisted.python import filepath, usage
+
+
+class _Payload(item.Item):
+    """
+    Synthetic data in a benchmark store.
+    """
+    data = attributes.bytes()
+
+
+
+def buildRootStore(path, stores, storeSize, itemSize=4096):
+    """
+    Builds a root store with a number of child stores of about the given
+    size each, filled with incompressible data.
+
+    :return: The root store, and the path segments of its child stores.
+    """
+    rootStore = store.Store(path)
+    allSegments = [["users", "user%06d" % (i,)] for i in xrange(stores)]
+    for pathSegments in allSegments:
+        childStore = store.Store(rootStore.filesdir.descendant(pathSegments))
+
+        def fill():
+            for _ in xrange(max(storeSize // itemSize, 1)):
+                _Payload(store=childStore, data=os.urandom(itemSize))
+
+        childStore.transact(fill)
+        childStore.close()
+
+    return rootStore, allSegments
+
+
+
+def _timed(f, *a, **kw):
+    """
+    Calls a function that returns a deferred, and measures how long it takes
+    until the deferred fires.
+
+    :return: A deferred that will fire with the number of seconds.
+    """
+    started = time.time()
+    d = defer.maybeDeferred(f, *a, **kw)
+    return d.addCallback(lambda _: time.time() - started)
+
+
+
+def summarize(samples):
+    """
+    Summarizes a list of latencies, in seconds.
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+
+    def percentile(p):
+        return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+    return {
+        "count": len(samples),
+        "min": samples[0],
+        "median": percentile(0.5),
+        "p99": percentile(0.99),
+        "max": samples[-1],
+        "mean": sum(samples) / len(samples),
+    }
+
+
+
+@defer.inlineCallbacks
+def benchmarkOpen(rootStore, allSegments):
+    """
+    Measures how long it takes long-term storage to get stores that aren't
+    open yet.
+    """
+    fakeStorage = storage.FakeStorage(store=rootStore)
+    samples = []
+    for pathSegments in allSegments:
+        samples.append((yield _timed(fakeStorage.get, pathSegments)))
+    defer.returnValue(summarize(samples))
+
+
+
+@defer.inlineCallbacks
+def benchmarkCache(rootStore, allSegments, requests, poolSize):
+    """
+    Measures the hit rate and latency of long-term storage's pool of open
+    stores, for requests where a few stores are much more popular than
+    others.
+    """
+    fakeStorage = storage.FakeStorage(store=rootStore)
+    fakeStorage.pool.maxSize = poolSize
+
+    samples = []
+    for _ in xrange(requests):
+        rank = min(int(random.paretovariate(1.0)) - 1, len(allSegments) - 1)
+        samples.append((yield _timed(fakeStorage.get, allSegments[rank])))
+
+    pool = fakeStorage.pool
+    defer.returnValue({
+        "latency": summarize(samples),
+        "hits": pool.hits,
+        "misses": pool.misses,
+        "evictions": pool.evictions,
+        "hitRate": float(pool.hits) / max(pool.hits + pool.misses, 1),
+    })
+
+
+
+@defer.inlineCallbacks
+def benchmarkLocks(rootStore, allSegments, operations, concurrency):
+    """
+    Measures the throughput of acquiring and releasing write locks, with a
+    number of concurrent workers.
+    """
+    lockDirectory = directory.LocalWriteLockDirectory(store=rootStore)
+    samples = []
+
+    @defer.inlineCallbacks
+    def worker(count):
+        for _ in xrange(count):
+            started = time.time()
+            lock = yield lockDirectory.acquire(random.choice(allSegments))
+            yield lock.release()
+            samples.append(time.time() - started)
+
+    started = time.time()
+    perWorker = max(operations // concurrency, 1)
+    yield defer.gatherResults([worker(perWorker)
+                               for _ in xrange(concurrency)])
+    elapsed = time.time() - started
+
+    defer.returnValue({
+        "concurrency": concurrency,
+        "latency": summarize(samples),
+        "operationsPerSecond": len(samples) / elapsed,
+    })
+
+
+
+@defer.inlineCallbacks
+def benchmarkWrite(rootStore, allSegments):
+    """
+    Measures the bandwidth of writing stores back to a directory archive,
+    both the first time and again without changes.
+    """
+    storeArchive = archive.DirectoryArchive(
+        store=rootStore, path=rootStore.newDirectory("archive"))
+    rootStore.powerUp(storeArchive, archive.IStoreArchive)
+    lockDirectory = directory.LocalWriteLockDirectory(store=rootStore)
+
+    results = {}
+    for name in ["initial", "unchanged"]:
+        totalBytes, totalTime = 0, 0.0
+        for pathSegments in allSegments:
+            lock = yield lockDirectory.acquire(pathSegments)
+            totalBytes += lock.store.dbdir.child("db.sqlite").getsize()
+            totalTime += yield _timed(lock.write)
+            yield lock.release()
+            lock.store.close()
+
+        results[name] = {
+            "bytes": totalBytes,
+            "seconds": totalTime,
+            "bytesPerSecond": totalBytes / totalTime if totalTime else None,
+        }
+
+    rootStore.powerDown(storeArchive, archive.IStoreArchive)
+    defer.returnValue(results)
+
+
+
+@defer.inlineCallbacks
+def runBenchmarks(config, path):
+    """
+    Builds a synthetic root store at the given path and runs all of the
+    benchmarks against it.
+
+    :return: A deferred that will fire with the results.
+    """
+    random.seed(config["seed"])
+    rootStore, allSegments = buildRootStore(path, config["stores"],
+                                            config["store-size"])
+
+    results = {
+        "parameters": dict(config),
+        "environment": {
+            "python": sys.version,
+            "platform": platform.platform(),
+            "time": time.time(),
+        },
+    }
+
+    results["open"] = yield benchmarkOpen(rootStore, allSegments)
+    results["cache"] = yield benchmarkCache(rootStore, allSegments,
+                                            config["requests"],
+                                            config["pool-size"])
+    results["locks"] = yield benchmarkLocks(rootStore, allSegments,
+                                            config["requests"],
+                                            config["concurrency"])
+    results["write"] = yield benchmarkWrite(rootStore, allSegments)
+    defer.returnValue(results)
+
+
+
+class Options(usage.Options):
+    """
+    The options for running the benchmarks.
+    """
+    optParameters = [
+        ["stores", "n", 100, "Number of child stores", int],
+        ["store-size", "s", 1024 * 1024, "Approximate bytes per store", int],
+        ["requests", "r", 1000, "Number of requests per benchmark", int],
+        ["pool-size", "p", 32, "Maximum number of pooled open stores", int],
+        ["concurrency", "c", 8, "Number of concurrent lock workers", int],
+        ["seed", None, 0, "Random seed", int],
+        ["directory", "d", None, "Directory to build stores in"],
+        ["output", "o", "benchmark.json", "File to write results to"],
+    ]
+
+
+
+def main(reactor, *argv):
+    """
+    Runs the benchmarks from the command line.
+    """
+    config = Options()
+    config.parseOptions(argv)
+
+    directoryPath = config["directory"] or tempfile.mkdtemp()
+    path = filepath.FilePath(directoryPath).child("root")
+    d = runBenchmarks(config, path)
+
+    @d.addCallback
+    def writeResults(results):
+        with open(config["output"], "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    return d
+
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
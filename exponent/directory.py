@@ -1,9 +1,13 @@
 """
 Lock directories.
 """
-from axiom import attributes, item, store
-from exponent import exceptions
-from twisted.internet import defer
+from collections import deque
+
+from axiom import attributes, item
+from exponent import archive, layout, locators, metrics, snapshot, warmup
+from exponent import _util
+from twisted.internet import defer, task
+from twisted.protocols import amp
 from zope import interface
 
 
@@ -35,6 +39,15 @@ class IWriteLock(interface.Interface):
         """
 
 
+    def snapshot(self):
+        """
+        Takes a consistent snapshot of the store, while it remains in use.
+
+        :return: A deferred that will fire with the snapshot.
+        :rtype: deferred ``exponent.snapshot.Snapshot``
+        """
+
+
     def release(self):
         """
         Releases the lock on the store.
@@ -46,6 +59,43 @@ class IWriteLock(interface.Interface):
 
 
 
+class IReadLockDirectory(interface.Interface):
+    """
+    A directory of shared read locks on stores.
+    """
+    def acquireShared(pathSegments):
+        """
+        Acquires a shared read lock on a store. Any number of read locks can
+        be held at the same time, including while a write lock is held.
+
+        :return: Deferred that will fire with the read lock for the requested
+            store.
+        :rtype: Deferred ``IReadLock``
+        :raises NoSuchStoreException: The requested store did not exist.
+        """
+
+
+
+class IReadLock(interface.Interface):
+    """
+    A shared read lock on a store.
+    """
+    store = interface.Attribute("""
+    A read-only handle to the store. Attempts to change it fail. Items
+    loaded through it aren't updated by later writes.
+    """)
+
+    def release():
+        """
+        Releases the lock on the store.
+
+        :return: A deferred that will fire when the lock has been released.
+        :raises AlreadyReleasedException: Raised when the lock was already
+            released.
+        """
+
+
+
 class AlreadyAcquiredException(Exception):
     """
     The requested lock has already been acquired somewhere else.
@@ -60,20 +110,396 @@ class AlreadyReleasedException(Exception):
 
 
 
-@interface.implementer(IWriteLockDirectory)
+DEFAULT_TIMEOUT = 30
+"""
+The default number of seconds to wait for a lock that is already held.
+"""
+
+
+
+class _LockTable(object):
+    """
+    An in-memory table of exclusive locks, with a FIFO queue of waiters
+    for each held lock.
+
+    When a lock is released and there are waiters, it is handed over to the
+    first of them directly, together with a value from the releaser, such
+    as the locked store.
+    """
+    def __init__(self, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self._clock = clock
+        self._waiters = {}
+
+
+    def isHeld(self, key):
+        """
+        Checks if the lock for the given key is held.
+        """
+        return key in self._waiters
+
+
+    def waiting(self, key):
+        """
+        Gets the number of waiters for the lock for the given key.
+        """
+        return len(self._waiters.get(key, ()))
+
+
+    def totalWaiting(self):
+        """
+        Gets the number of waiters for all locks.
+        """
+        return sum(len(waiters) for waiters in self._waiters.itervalues())
+
+
+    def acquire(self, key, timeout=None):
+        """
+        Acquires the lock for the given key, waiting for it in line if it is
+        already held.
+
+        :param timeout: The number of seconds to wait, or ``None`` to wait
+            indefinitely.
+        :return: A deferred that will fire with ``None`` if the lock wasn't
+            held, or with the value it was handed over with, or fail with
+            ``AlreadyAcquiredException`` if the lock is still held after the
+            timeout. Cancelling it removes the waiter from the queue.
+        """
+        if key not in self._waiters:
+            self._waiters[key] = deque()
+            return defer.succeed(None)
+
+        if timeout is not None and timeout <= 0:
+            return defer.fail(AlreadyAcquiredException())
+
+        waiters = self._waiters[key]
+        d = defer.Deferred(lambda d: self._remove(key, d))
+        waiters.append(d)
+
+        if timeout is not None:
+            def timedOut():
+                self._remove(key, d)
+                d.errback(AlreadyAcquiredException())
+
+            delayedCall = self._clock.callLater(timeout, timedOut)
+
+            @d.addBoth
+            def stopTimeout(result):
+                if delayedCall.active():
+                    delayedCall.cancel()
+                return result
+
+        return d
+
+
+    def _remove(self, key, d):
+        """
+        Removes a waiter from the queue.
+        """
+        self._waiters[key].remove(d)
+
+
+    def release(self, key, value=None):
+        """
+        Releases the lock for the given key. If there are waiters, the lock is
+        handed over to the first of them with the given value.
+        """
+        waiters = self._waiters[key]
+        if waiters:
+            waiters.popleft().callback(value)
+        else:
+            del self._waiters[key]
+
+
+
+@interface.implementer(IWriteLockDirectory, IReadLockDirectory)
 class LocalWriteLockDirectory(item.Item):
     """A local, filesystem-based write lock directory, suitable for a
     single server.
 
+    Write locks are exclusive. Requests for a write lock that is held wait
+    for it in the order they were made, and get the same store as the
+    previous holder.
+
+    Read locks are shared, and don't wait for write locks. Each read lock
+    has its own read-only handle to the store, which is closed when the lock
+    is released. Items that were loaded through it aren't updated by later
+    writes; a new read lock sees them.
+
+    :ivar metrics: The metrics of the write locks of this directory.
+    :type metrics: ``exponent.metrics.LockMetrics``
+
     """
     _dummy = attributes.boolean()
+    metrics = attributes.inmemory()
+    _locks = attributes.inmemory()
+    _fetching = attributes.inmemory()
+
+    def activate(self):
+        self.metrics = metrics.LockMetrics()
+        self._locks = _LockTable()
+        self._fetching = _util.Coalescer()
+
+
+    def acquire(self, pathSegments, timeout=DEFAULT_TIMEOUT):
+        """
+        Acquires a write lock on a store, waiting up to ``timeout`` seconds
+        if it is already held. If ``timeout`` is ``None``, waits
+        indefinitely.
+        """
+        storePath = layout.storePathFor(self.store, pathSegments)
+        storeArchive = archive.IStoreArchive(self.store, None)
+
+        waiting = None
+        if self._locks.isHeld(storePath):
+            waiting = self._locks.waiting(storePath)
+        requestedAt = self.metrics.requested(pathSegments, waiting)
+
+        d = self._locks.acquire(storePath, timeout)
+
+        @d.addCallback
+        def acquired(heldStore):
+            if heldStore is not None:
+                return heldStore
+
+            opened = self._open(pathSegments, storePath)
+
+            @opened.addErrback
+            def openFailed(failure):
+                self._locks.release(storePath)
+                return failure
+
+            return opened
+
+        @d.addCallback
+        def makeLock(lockedStore):
+            acquiredAt = self.metrics.acquired(requestedAt)
+
+            def release(lock):
+                self.metrics.released(acquiredAt)
+                self._locks.release(storePath, lock.store)
+
+            return LocalWriteLock(lockedStore, storeArchive, pathSegments,
+                                  release)
+
+        @d.addErrback
+        def failed(failure):
+            if failure.check(AlreadyAcquiredException):
+                self.metrics.timedOut()
+            return failure
+
+        return d
+
+
+    def _open(self, pathSegments, storePath):
+        """
+        Opens the store at the given path, fetching it from the root store's
+        archive if necessary, and warms it up with the root store's warmer.
+        """
+        d = archive.openStore(self.store, pathSegments, storePath)
+        return d.addCallback(warmup.warm, self.store)
+
+
+    def acquireShared(self, pathSegments):
+        storePath = layout.storePathFor(self.store, pathSegments)
+        d = self._fetching.call(storePath, self._fetch, pathSegments,
+                                storePath)
+        d.addCallback(lambda _: self._openShared(pathSegments, storePath))
+
+        @d.addCallback
+        def opened(readOnlyStore):
+            return LocalReadLock(readOnlyStore, pathSegments,
+                                 lambda lock: lock.store.close())
 
-    def acquire(self, pathSegments):
-        storePath = self.store.filesdir.descendant(pathSegments)
-        if not storePath.exists():
-            return defer.fail(exceptions.NoSuchStoreException())
-        lock = LocalWriteLock(store.Store(storePath))
-        return defer.succeed(lock)
+        return d
+
+
+    def _fetch(self, pathSegments, storePath):
+        """
+        Fetches the store at the given path from the root store's archive,
+        unless it is available locally, or there is no archive.
+        """
+        storeArchive = archive.IStoreArchive(self.store, None)
+        if storeArchive is None or storePath.exists():
+            return None
+        return storeArchive.fetch(pathSegments, storePath)
+
+
+    def _openShared(self, pathSegments, storePath):
+        """
+        Opens the store at the given path for reading only.
+
+        SQLite refuses all writes through the store's connection, but other
+        connections, such as the write lock holder's, can still write.
+        """
+        d = archive.openStore(self.store, pathSegments, storePath)
+
+        @d.addCallback
+        def makeReadOnly(openedStore):
+            openedStore.executeSQL("PRAGMA query_only = 1")
+            _queryMissingTablesAsEmpty(openedStore)
+            return openedStore
+
+        return d
+
+
+
+_EMPTY = "exponent_empty"
+
+
+
+def _queryMissingTablesAsEmpty(readOnlyStore):
+    """
+    Lets a read-only store query item types it has no table for, finding no
+    items. Axiom would create their tables in the store when they're first
+    queried, which is a write; instead, empty tables are created for them in
+    a private in-memory database attached to the read-only handle, and the
+    store itself is never written.
+    """
+    readOnlyStore.executeSQL("ATTACH DATABASE ':memory:' AS %s" % (_EMPTY,))
+    getTableName = readOnlyStore.getTableName
+
+    def getTableNameOrEmpty(tableClass):
+        key = tableClass.typeName, tableClass.schemaVersion
+        if (tableClass in readOnlyStore.typeToTableNameCache
+            or key in readOnlyStore.typenameAndVersionToID):
+            return getTableName(tableClass)
+
+        tableName = "%s.item_%s_v%d" % ((_EMPTY,) + key)
+        columns = ", ".join(
+            "%s %s" % (attribute.getShortColumnName(readOnlyStore),
+                       attribute.sqltype)
+            for _, attribute in tableClass.getSchema())
+        readOnlyStore.executeSQL("PRAGMA query_only = 0")
+        try:
+            readOnlyStore.executeSQL(
+                "CREATE TABLE %s (%s)" % (tableName, columns))
+        finally:
+            readOnlyStore.executeSQL("PRAGMA query_only = 1")
+        readOnlyStore.typeToTableNameCache[tableClass] = tableName
+        return tableName
+
+    readOnlyStore.getTableName = getTableNameOrEmpty
+
+
+
+_BUCKETS = amp.AmpList([("upperBound", amp.Float()),
+                        ("count", amp.Integer())])
+
+
+
+class GetLockMetrics(amp.Command):
+    """
+    Gets the metrics of a lock directory.
+    """
+    arguments = [("top", amp.Integer())]
+    response = [
+        ("acquisitions", amp.Integer()),
+        ("timeouts", amp.Integer()),
+        ("waiting", amp.Integer()),
+        ("waitTimes", _BUCKETS),
+        ("holdTimes", _BUCKETS),
+        ("queueLengths", _BUCKETS),
+        ("contended", amp.AmpList([("path", amp.String()),
+                                   ("count", amp.Integer())])),
+        ("report", amp.String())
+    ]
+
+
+
+class LockMetricsLocator(locators.Locator):
+    """
+    A locator for administrative commands about the local write lock
+    directory in its store.
+    """
+    @GetLockMetrics.responder
+    def getLockMetrics(self, top):
+        lockDirectory = self.store.findUnique(LocalWriteLockDirectory)
+        lockMetrics = lockDirectory.metrics
+
+        def buckets(histogram):
+            return [{"upperBound": float(bound), "count": count}
+                    for bound, count in histogram.buckets()]
+
+        return {
+            "acquisitions": lockMetrics.acquisitions,
+            "timeouts": lockMetrics.timeouts,
+            "waiting": lockDirectory._locks.totalWaiting(),
+            "waitTimes": buckets(lockMetrics.waitTimes),
+            "holdTimes": buckets(lockMetrics.holdTimes),
+            "queueLengths": buckets(lockMetrics.queueLengths),
+            "contended": [{"path": path, "count": count}
+                          for path, count in lockMetrics.topContended(top)],
+            "report": lockMetrics.dump(top)
+        }
+
+
+
+class BulkAcquisition(object):
+    """
+    The outcome of acquiring many locks at once.
+
+    :ivar acquired: The number of locks that were acquired and handled.
+    :ivar failed: A list of ``(pathSegments, failure)`` pairs, for the
+        stores that couldn't be locked or whose locks couldn't be handled.
+    """
+    def __init__(self):
+        self.acquired = 0
+        self.failed = []
+
+
+
+def acquireMany(lockDirectory, allPathSegments, onAcquired, concurrency=10,
+                cooperator=task):
+    """
+    Acquires write locks on many stores, with at most ``concurrency``
+    acquisitions in progress at the same time.
+
+    Locks are passed to ``onAcquired(pathSegments, lock)`` as they are
+    granted, in whatever order that happens. If it returns a deferred, the
+    slot isn't used for another acquisition until that fires, so a batch job
+    can handle (and release) each lock while other locks are being acquired.
+    If it fails, the lock is released for it.
+
+    :param allPathSegments: An iterable of path segments. It is consumed
+        lazily, so it may be a generator.
+    :param cooperator: The cooperator that runs the acquisitions.
+    :return: A deferred that will fire with a ``BulkAcquisition`` once
+        every store has been tried.
+    """
+    result = BulkAcquisition()
+
+    def attempt(pathSegments):
+        d = lockDirectory.acquire(pathSegments)
+
+        @d.addCallback
+        def acquired(lock):
+            handled = defer.maybeDeferred(onAcquired, pathSegments, lock)
+
+            @handled.addErrback
+            def release(failure):
+                released = defer.maybeDeferred(lock.release)
+                released.addErrback(
+                    lambda f: f.trap(AlreadyReleasedException))
+                return released.addCallback(lambda _: failure)
+
+            return handled
+
+        @d.addCallback
+        def succeeded(_):
+            result.acquired += 1
+
+        @d.addErrback
+        def failed(failure):
+            result.failed.append((pathSegments, failure))
+
+        return d
+
+    work = (attempt(pathSegments) for pathSegments in allPathSegments)
+    ds = [cooperator.cooperate(work).whenDone() for _ in xrange(concurrency)]
+    return defer.gatherResults(ds).addCallback(lambda _: result)
 
 
 
@@ -81,25 +507,63 @@ class LocalWriteLockDirectory(item.Item):
 class LocalWriteLock(object):
     """
     A local write lock.
+
+    If the lock has a store archive, writing pushes a snapshot of the locked
+    store to it.
     """
-    def __init__(self, lockedStore):
+    def __init__(self, lockedStore, storeArchive=None, pathSegments=None,
+                 onRelease=None):
         self.store = lockedStore
+        self.storeArchive = storeArchive
+        self.pathSegments = pathSegments
+        self.onRelease = onRelease
         self.released = False
 
 
     def write(self):
         """
-        Pretends to write the long-term storage.
+        Writes a snapshot of the locked store to the store archive, or
+        pretends to write the long-term storage if there is no archive.
 
         :returns: A deferred fired with C{None}.
         :rtype: deferred ``None``
         """
-        return defer.succeed(None)
+        if self.storeArchive is None:
+            return defer.succeed(None)
+
+        d = self.snapshot()
+
+        @d.addCallback
+        def push(storeSnapshot):
+            pushed = self._push(storeSnapshot.path)
+            pushed.addBoth(_passthrough(storeSnapshot.remove))
+            return pushed
+
+        return d.addCallback(lambda _manifest: None)
+
+
+    def _push(self, snapshotPath):
+        """
+        Pushes a snapshot of the locked store to the store archive.
+        """
+        return self.storeArchive.push(self.pathSegments, snapshotPath)
+
+
+    def snapshot(self):
+        """
+        Takes a snapshot of the locked store, next to the store itself.
+
+        :returns: A deferred fired with the snapshot.
+        :rtype: deferred ``exponent.snapshot.Snapshot``
+        """
+        storePath = self.store.dbdir
+        destination = storePath.temporarySibling(".snapshot")
+        return snapshot.snapshot(storePath, destination)
 
 
     def release(self):
         """
-        Releases the fake lock.
+        Releases the lock, and calls ``onRelease`` with it, if given.
 
         :returns: A deferred fired with C{None} or failed with an exception
             noted below.
@@ -111,4 +575,48 @@ class LocalWriteLock(object):
             return defer.fail(AlreadyReleasedException())
 
         self.released = True
+        if self.onRelease is not None:
+            self.onRelease(self)
+        return defer.succeed(None)
+
+
+
+@interface.implementer(IReadLock)
+class LocalReadLock(object):
+    """
+    A local read lock.
+    """
+    def __init__(self, readOnlyStore, pathSegments=None, onRelease=None):
+        self.store = readOnlyStore
+        self.pathSegments = pathSegments
+        self.onRelease = onRelease
+        self.released = False
+
+
+    def release(self):
+        """
+        Releases the lock, and calls ``onRelease`` with it, if given.
+
+        :raises AlreadyReleasedException: If this lock has been released
+            before.
+        """
+        if self.released:
+            return defer.fail(AlreadyReleasedException())
+
+        self.released = True
+        if self.onRelease is not None:
+            self.onRelease(self)
         return defer.succeed(None)
+
+
+
+def _passthrough(f):
+    """
+    Wraps a nullary function so that it can be added as a callback that
+    passes its result through.
+    """
+    def callback(result):
+        f()
+        return result
+
+    return callback
@@ -0,0 +1,266 @@
+"""
+On-disk layouts for stores under a root store.
+"""
+import hashlib
+import os
+
+from axiom import attributes, item, substore
+from zope import interface
+
+
+class IPathLayout(interface.Interface):
+    """
+    Decides where stores live on disk, relative to the root store's files
+    directory.
+
+    Long-term storage, lock directories and child stores use the
+    ``IPathLayout`` powerup of their root store, if there is one.
+    """
+    def segmentsFor(pathSegments):
+        """
+        Gets the on-disk path segments for a store.
+
+        :param pathSegments: The path segments the store is known by.
+        :return: The path segments of the store on disk.
+        :rtype: ``list``
+        """
+
+
+    def pathSegmentsFor(diskSegments):
+        """
+        Gets the path segments a store is known by from its on-disk path
+        segments. This is the inverse of ``segmentsFor``.
+        """
+
+
+
+@interface.implementer(IPathLayout)
+class _FlatLayout(object):
+    """
+    A layout that puts stores directly at their path segments.
+    """
+    def segmentsFor(self, pathSegments):
+        return list(pathSegments)
+
+
+    def pathSegmentsFor(self, diskSegments):
+        return list(diskSegments)
+
+
+
+flatLayout = _FlatLayout()
+"""
+The layout that is used when there is no ``IPathLayout`` powerup.
+"""
+
+
+
+@interface.implementer(IPathLayout)
+class HashPrefixLayout(item.Item):
+    """
+    A layout that fans stores out over nested directories named after a
+    prefix of the hash of their path segments, so that no single directory
+    has too many entries.
+
+    For example, with two levels of width two, ``["users", "alice"]`` is
+    stored at ``users/dc/db/alice``.
+    """
+    powerupInterfaces = [IPathLayout]
+
+    levels = attributes.integer(allowNone=False, default=2)
+    """
+    The number of nested fan-out directories.
+    """
+
+    width = attributes.integer(allowNone=False, default=2)
+    """
+    The number of hexadecimal digits in the name of a fan-out directory.
+    """
+
+    def segmentsFor(self, pathSegments):
+        pathSegments = list(pathSegments)
+        digest = hashlib.sha1("/".join(pathSegments)).hexdigest()
+        prefix = [digest[level * self.width:(level + 1) * self.width]
+                  for level in xrange(self.levels)]
+        return pathSegments[:-1] + prefix + pathSegments[-1:]
+
+
+    def pathSegmentsFor(self, diskSegments):
+        diskSegments = list(diskSegments)
+        return diskSegments[:-self.levels - 1] + diskSegments[-1:]
+
+
+
+def getLayout(rootStore):
+    """
+    Gets the layout for stores under the given root store.
+    """
+    return IPathLayout(rootStore, flatLayout)
+
+
+
+def storePathFor(rootStore, pathSegments):
+    """
+    Gets the on-disk path of a store under the given root store.
+    """
+    diskSegments = getLayout(rootStore).segmentsFor(pathSegments)
+    return rootStore.filesdir.descendant(diskSegments)
+
+
+
+TEMPORARY_EXTENSION = ".tmp"
+"""
+The extension of the temporary siblings that stores are built in before
+they are moved into place.
+"""
+
+
+
+_NOT_STORES = (TEMPORARY_EXTENSION, ".snapshot")
+"""
+The extensions of directories under the files directory that look like
+stores, but are temporary copies of them.
+"""
+
+
+
+def _findStores(path):
+    """
+    Finds the directories of stores at or under the given path, without
+    looking inside stores, and skipping temporary copies of stores.
+    """
+    if path.child("db.sqlite").isfile():
+        yield path
+        return
+
+    for child in path.children():
+        if child.isdir() and not child.basename().endswith(_NOT_STORES):
+            for found in _findStores(child):
+                yield found
+
+
+
+def _removeEmptyParents(path, top):
+    """
+    Removes the parents of the given path that are empty, up to but not
+    including ``top``.
+    """
+    parent = path.parent()
+    while parent != top and parent.isdir() and not parent.listdir():
+        parent.remove()
+        parent = parent.parent()
+
+
+
+class _Migration(item.Item):
+    """
+    A migration to a new layout that hasn't finished yet, so that it can be
+    resumed if it is interrupted.
+    """
+    newLayout = attributes.reference()
+    """
+    The new layout, or ``None`` for the flat layout.
+    """
+
+
+
+class _MovedStore(item.Item):
+    """
+    A store that has been moved to the new layout by an unfinished
+    migration.
+    """
+    migration = attributes.reference(
+        allowNone=False, whenDeleted=attributes.reference.CASCADE)
+    storepath = attributes.path(allowNone=False)
+
+
+
+def _startMigration(rootStore, newLayout):
+    """
+    Gets the unfinished migration of the root store to a new layout, or
+    records a new one.
+
+    :raises ValueError: If there is an unfinished migration to a different
+        layout.
+    """
+    target = None if newLayout is flatLayout else newLayout
+    migration = rootStore.findUnique(_Migration, default=None)
+    if migration is None:
+        return _Migration(store=rootStore, newLayout=target)
+    if migration.newLayout is not target:
+        raise ValueError("unfinished migration to %r"
+                         % (migration.newLayout or flatLayout,))
+    return migration
+
+
+
+def migrate(rootStore, newLayout):
+    """
+    Moves all of the stores under the root store from its current layout
+    to a new layout, in place, and then makes the new layout the root
+    store's layout.
+
+    Each store is recorded as moved before it is moved, so that if the
+    migration is interrupted, migrating to the same layout again resumes
+    it, without moving stores that were already moved. Temporary copies of
+    stores are left where they are.
+
+    Stores must not be in use while they are being migrated. Child stores
+    that are open are closed.
+
+    :param newLayout: The new layout. If it is an item, it must be in the
+        root store.
+    :return: The number of stores that were moved.
+    :raises ValueError: If an interrupted migration to a different layout
+        hasn't been finished.
+    """
+    oldLayout = getLayout(rootStore)
+    filesdir = rootStore.filesdir
+    migration = rootStore.transact(_startMigration, rootStore, newLayout)
+    alreadyMoved = set(rootStore.query(
+        _MovedStore, _MovedStore.migration == migration).getColumn(
+            "storepath"))
+    subStores = dict((s.storepath, s) for s in rootStore.query(
+        substore.SubStore, substore.SubStore.storepath != None))
+
+    moved = 0
+    for oldPath in list(_findStores(filesdir)):
+        if oldPath in alreadyMoved:
+            continue
+
+        diskSegments = oldPath.segmentsFrom(filesdir)
+        pathSegments = oldLayout.pathSegmentsFor(diskSegments)
+        newPath = filesdir.descendant(newLayout.segmentsFor(pathSegments))
+        if newPath == oldPath:
+            continue
+
+        subStore = subStores.get(oldPath)
+        if subStore is not None and hasattr(subStore, "substore"):
+            subStore.close()
+
+        def record():
+            _MovedStore(store=rootStore, migration=migration,
+                        storepath=newPath)
+            if subStore is not None:
+                subStore.storepath = newPath
+
+        rootStore.transact(record)
+
+        if not newPath.parent().isdir():
+            newPath.parent().makedirs()
+        os.rename(oldPath.path, newPath.path)
+        _removeEmptyParents(oldPath, filesdir)
+        moved += 1
+
+    def finish():
+        if oldLayout is not flatLayout:
+            rootStore.powerDown(oldLayout, IPathLayout)
+        if newLayout is not flatLayout:
+            rootStore.powerUp(newLayout, IPathLayout)
+        migration.deleteFromStore()
+
+    rootStore.transact(finish)
+
+    from exponent.substore import clearCache
+    clearCache(rootStore)
+    return moved
@@ -0,0 +1,776 @@
+"""
+A networked write lock directory, based on leases.
+
+A lease server hands out time-bounded leases on stores over AMP. Each
+lease has a fencing token, which is larger than that of every lease
+before it; writes made with a lease check with the server that its token
+is still current, so that a host that has lost its lease (for example,
+during a network partition) can't write.
+
+A lock can also be handed off to another host, together with its store,
+without writing the store back to long-term storage.
+"""
+import os
+
+from axiom import attributes, item
+from exponent import archive, directory, layout, locators, warmup
+from twisted.internet import defer, task, threads
+from twisted.protocols import amp
+from twisted.python import log
+from zope import interface
+
+
+_HANDOFF_KEY = "handoff"
+"""
+The key that handed off stores are archived under.
+"""
+
+
+
+_PIECE_SIZE = 60000
+"""
+The maximum size of the pieces that objects are sent in; AMP values can't
+be larger than 64 KiB.
+"""
+
+
+
+_PIECE_WINDOW = 16
+"""
+The maximum number of pieces that are in flight to a peer at once.
+"""
+
+
+
+class StaleLeaseException(Exception):
+    """
+    The lease has expired, or has been superseded by a newer lease.
+    """
+
+
+
+class IHandoffWriteLock(directory.IWriteLock):
+    """
+    A write lock that can be handed off to another host.
+    """
+    def handoff(peerName):
+        """
+        Hands this lock off to a peer, together with its store.
+
+        :return: A deferred that will fire when the peer holds the lock.
+        """
+
+
+
+class AcquireLease(amp.Command):
+    """
+    Acquires a lease on a store.
+    """
+    arguments = [
+        ("pathSegments", amp.ListOf(amp.String())),
+        ("owner", amp.String()),
+        ("duration", amp.Float())
+    ]
+    response = [("token", amp.Integer())]
+    errors = {directory.AlreadyAcquiredException: "ALREADY_ACQUIRED"}
+
+
+
+_RENEWAL_BATCH_SIZE = 2000
+"""
+The maximum number of leases renewed by one ``RenewLeases`` command; the
+list of their tokens has to fit in a single AMP value.
+"""
+
+
+
+class RenewLeases(amp.Command):
+    """
+    Renews a batch of leases of an owner at once.
+    """
+    arguments = [
+        ("owner", amp.String()),
+        ("tokens", amp.ListOf(amp.Integer())),
+        ("duration", amp.Float())
+    ]
+    response = [("renewed", amp.ListOf(amp.Integer()))]
+
+
+
+class CheckLease(amp.Command):
+    """
+    Checks that a lease on a store is still current.
+    """
+    arguments = [
+        ("pathSegments", amp.ListOf(amp.String())),
+        ("token", amp.Integer())
+    ]
+    response = []
+    errors = {StaleLeaseException: "STALE_LEASE"}
+
+
+
+class ReleaseLease(amp.Command):
+    """
+    Releases a lease on a store. Releasing a lease that is no longer
+    current does nothing.
+    """
+    arguments = [
+        ("pathSegments", amp.ListOf(amp.String())),
+        ("token", amp.Integer())
+    ]
+    response = []
+
+
+
+class TransferLease(amp.Command):
+    """
+    Transfers a lease on a store to another owner. The new owner gets a new
+    lease, with a new fencing token.
+    """
+    arguments = [
+        ("pathSegments", amp.ListOf(amp.String())),
+        ("token", amp.Integer()),
+        ("newOwner", amp.String()),
+        ("duration", amp.Float())
+    ]
+    response = [("token", amp.Integer())]
+    errors = {StaleLeaseException: "STALE_LEASE"}
+
+
+
+class SendHandoffPiece(amp.Command):
+    """
+    Sends a piece of an object of a store that is being handed off. Objects
+    are sent in pieces, because AMP values are limited in size.
+    """
+    arguments = [
+        ("handoff", amp.String()),
+        ("name", amp.String()),
+        ("data", amp.String()),
+        ("last", amp.Boolean())
+    ]
+    response = []
+
+
+
+class AcceptHandoff(amp.Command):
+    """
+    Tells a host to take over a lock on a store, whose objects have all
+    been sent.
+    """
+    arguments = [
+        ("handoff", amp.String()),
+        ("pathSegments", amp.ListOf(amp.String())),
+        ("token", amp.Integer()),
+        ("validFor", amp.Float())
+    ]
+    response = []
+
+
+
+class _Lease(object):
+    """
+    A lease held by an owner, until it expires.
+    """
+    def __init__(self, token, owner, expires):
+        self.token = token
+        self.owner = owner
+        self.expires = expires
+
+
+
+class LeaseServer(item.Item):
+    """
+    Keeps track of leases on stores.
+
+    Leases are kept in memory, by store and by token; the last fencing
+    token is stored, so that tokens keep increasing when the server is
+    restarted.
+    """
+    lastToken = attributes.integer(allowNone=False, default=0)
+    """
+    The fencing token of the last lease that was handed out.
+    """
+
+    _leases = attributes.inmemory()
+    _stores = attributes.inmemory()
+    _clock = attributes.inmemory()
+
+    def activate(self):
+        from twisted.internet import reactor
+        self._leases = {}
+        self._stores = {}
+        self._clock = reactor
+
+
+    def _current(self, pathSegments):
+        """
+        Gets the current lease on a store, or ``None`` if there is no lease
+        or it has expired.
+        """
+        key = tuple(pathSegments)
+        lease = self._leases.get(key)
+        if lease is not None and lease.expires <= self._clock.seconds():
+            self._remove(key)
+            lease = None
+        return lease
+
+
+    def _add(self, pathSegments, owner, duration):
+        """
+        Hands out a new lease on a store, replacing the current one.
+
+        :return: The fencing token of the new lease.
+        """
+        key = tuple(pathSegments)
+        if key in self._leases:
+            self._remove(key)
+
+        self.lastToken += 1
+        expires = self._clock.seconds() + duration
+        self._leases[key] = _Lease(self.lastToken, owner, expires)
+        self._stores[self.lastToken] = key
+        return self.lastToken
+
+
+    def _remove(self, key):
+        """
+        Removes the lease on a store.
+        """
+        lease = self._leases.pop(key)
+        del self._stores[lease.token]
+
+
+    def acquire(self, pathSegments, owner, duration):
+        """
+        Acquires a lease on a store for ``duration`` seconds.
+
+        :return: The fencing token of the new lease.
+        :raises AlreadyAcquiredException: If there is already a current
+            lease on the store.
+        """
+        if self._current(pathSegments) is not None:
+            raise directory.AlreadyAcquiredException()
+        return self._add(pathSegments, owner, duration)
+
+
+    def renew(self, owner, tokens, duration):
+        """
+        Renews the current leases of an owner with the given tokens for
+        another ``duration`` seconds. Only those leases are looked at.
+
+        :return: The tokens of the leases that were renewed.
+        """
+        expires = self._clock.seconds() + duration
+
+        renewed = []
+        for token in set(tokens):
+            key = self._stores.get(token)
+            if key is None:
+                continue
+            lease = self._current(key)
+            if lease is not None and lease.owner == owner:
+                lease.expires = expires
+                renewed.append(lease.token)
+
+        return sorted(renewed)
+
+
+    def check(self, pathSegments, token):
+        """
+        Checks that the current lease on a store has the given token.
+
+        :raises StaleLeaseException: If it doesn't.
+        """
+        lease = self._current(pathSegments)
+        if lease is None or lease.token != token:
+            raise StaleLeaseException()
+
+
+    def transfer(self, pathSegments, token, newOwner, duration):
+        """
+        Transfers the current lease on a store to a new owner, for
+        ``duration`` seconds.
+
+        :return: The fencing token of the new owner's lease.
+        :raises StaleLeaseException: If the lease with the given token isn't
+            current.
+        """
+        self.check(pathSegments, token)
+        return self._add(pathSegments, newOwner, duration)
+
+
+    def release(self, pathSegments, token):
+        """
+        Releases the lease on a store with the given token, if it is
+        current.
+        """
+        lease = self._current(pathSegments)
+        if lease is not None and lease.token == token:
+            self._remove(tuple(pathSegments))
+
+
+
+class LeaseLocator(locators.Locator):
+    """
+    A locator for lease commands, served by the lease server in its store.
+    """
+    @property
+    def _server(self):
+        return self.store.findOrCreate(LeaseServer)
+
+
+    @AcquireLease.responder
+    def acquireLease(self, pathSegments, owner, duration):
+        acquire = self._server.acquire
+        token = self.store.transact(acquire, pathSegments, owner, duration)
+        return {"token": token}
+
+
+    @RenewLeases.responder
+    def renewLeases(self, owner, tokens, duration):
+        return {"renewed": self._server.renew(owner, tokens, duration)}
+
+
+    @CheckLease.responder
+    def checkLease(self, pathSegments, token):
+        self._server.check(pathSegments, token)
+        return {}
+
+
+    @TransferLease.responder
+    def transferLease(self, pathSegments, token, newOwner, duration):
+        transfer = self._server.transfer
+        newToken = self.store.transact(transfer, pathSegments, token,
+                                       newOwner, duration)
+        return {"token": newToken}
+
+
+    @ReleaseLease.responder
+    def releaseLease(self, pathSegments, token):
+        self._server.release(pathSegments, token)
+        return {}
+
+
+
+class HandoffLocator(amp.CommandLocator):
+    """
+    A locator for receiving locks that are handed off by other hosts, for
+    a lease client.
+    """
+    def __init__(self, client):
+        self.client = client
+        self._pieces = {}
+
+
+    @SendHandoffPiece.responder
+    def receivePiece(self, handoff, name, data, last):
+        key = handoff, name
+        self._pieces.setdefault(key, []).append(data)
+        if last:
+            objectStore = archive.DirectoryObjectStore(
+                self.client._handoffPath(handoff))
+            objectStore.put(name, "".join(self._pieces.pop(key)))
+        return {}
+
+
+    @AcceptHandoff.responder
+    def acceptHandoff(self, handoff, pathSegments, token, validFor):
+        d = self.client._accept(handoff, pathSegments, token, validFor)
+        return d.addCallback(lambda _: {})
+
+
+
+@interface.implementer(directory.IWriteLockDirectory)
+class LeaseClient(object):
+    """
+    A write lock directory that acquires leases from a lease server.
+
+    All of the leases held by this client are renewed together in a single
+    heartbeat every ``renewInterval`` seconds. A lease that can't be
+    renewed, or whose renewal doesn't arrive before it expires, is lost:
+    writes made with its lock fail.
+
+    Locks can be handed off to peers: other lease clients, whose
+    ``HandoffLocator`` is served on the AMP connection to them.
+
+    :ivar remote: The AMP connection to the lease server.
+    :ivar owner: A name for this client, unique among the lease server's
+        clients.
+    :ivar peers: AMP connections to peers, by owner name.
+    :ivar onHandoff: If set, called with each lock that was handed off to
+        this client.
+    """
+    def __init__(self, remote, owner, rootStore, duration=30,
+                 renewInterval=10, peers=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.remote = remote
+        self.owner = owner
+        self.rootStore = rootStore
+        self.duration = duration
+        self.renewInterval = renewInterval
+        self.peers = peers if peers is not None else {}
+        self.onHandoff = None
+        self._clock = clock
+
+        self._held = {}
+        self._heartbeat = None
+
+
+    def acquire(self, pathSegments):
+        pathSegments = list(pathSegments)
+        requested = self._clock.seconds()
+        d = self.remote.callRemote(AcquireLease, pathSegments=pathSegments,
+                                   owner=self.owner,
+                                   duration=float(self.duration))
+
+        @d.addCallback
+        def leased(response):
+            token = response["token"]
+            storePath = layout.storePathFor(self.rootStore, pathSegments)
+            opened = archive.openStore(self.rootStore, pathSegments,
+                                       storePath)
+            opened.addCallback(warmup.warm, self.rootStore)
+            opened.addCallback(self._adopt, pathSegments, token,
+                               requested + self.duration)
+
+            @opened.addErrback
+            def openFailed(failure):
+                self.remote.callRemote(ReleaseLease,
+                                       pathSegments=pathSegments,
+                                       token=token).addErrback(log.err)
+                return failure
+
+            return opened
+
+        return d
+
+
+    def _adopt(self, lockedStore, pathSegments, token, expires):
+        """
+        Makes a lock for a store that this client holds a lease on.
+        """
+        storeArchive = archive.IStoreArchive(self.rootStore, None)
+        lock = LeasedWriteLock(lockedStore, storeArchive, pathSegments, self,
+                               token, expires)
+        self._held[token] = lock
+        self._startHeartbeat()
+        return lock
+
+
+    def _startHeartbeat(self):
+        """
+        Starts renewing leases, unless that's already happening.
+        """
+        if self._heartbeat is None:
+            self._heartbeat = task.LoopingCall(self.renew)
+            self._heartbeat.clock = self._clock
+            self._heartbeat.start(self.renewInterval, now=False)
+
+
+    def _stopHeartbeat(self):
+        """
+        Stops renewing leases.
+        """
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
+
+
+    def renew(self):
+        """
+        Renews all of the held leases, in batches of at most
+        ``_RENEWAL_BATCH_SIZE`` leases per command. Leases that aren't
+        renewed are lost.
+
+        :return: A deferred that will fire when the leases have been
+            renewed.
+        """
+        if not self._held:
+            return defer.succeed(None)
+
+        requested = self._clock.seconds()
+        tokens = sorted(self._held)
+        d = defer.gatherResults([
+            self._renewBatch(tokens[start:start + _RENEWAL_BATCH_SIZE],
+                             requested)
+            for start in xrange(0, len(tokens), _RENEWAL_BATCH_SIZE)])
+
+        @d.addCallback
+        def renewed(_):
+            if not self._held:
+                self._stopHeartbeat()
+
+        return d
+
+
+    def _renewBatch(self, tokens, requested):
+        """
+        Renews a batch of held leases with a single command.
+        """
+        d = self.remote.callRemote(RenewLeases, owner=self.owner,
+                                   tokens=tokens,
+                                   duration=float(self.duration))
+
+        @d.addCallback
+        def renewed(response):
+            renewedTokens = set(response["renewed"])
+            for token in tokens:
+                lock = self._held.get(token)
+                if lock is None:
+                    continue
+                if token in renewedTokens:
+                    lock.expires = requested + self.duration
+                else:
+                    lock.lost = True
+                    del self._held[token]
+
+        d.addErrback(log.err, "couldn't renew leases")
+        return d
+
+
+    def _check(self, lock):
+        """
+        Checks that a lock's lease is still current, locally and with the
+        lease server.
+        """
+        if lock.lost or lock.expires <= self._clock.seconds():
+            return defer.fail(StaleLeaseException())
+        return self.remote.callRemote(CheckLease,
+                                      pathSegments=lock.pathSegments,
+                                      token=lock.token)
+
+
+    def _release(self, lock):
+        """
+        Releases a lock's lease.
+        """
+        self._held.pop(lock.token, None)
+        if not self._held:
+            self._stopHeartbeat()
+
+        d = self.remote.callRemote(ReleaseLease,
+                                   pathSegments=lock.pathSegments,
+                                   token=lock.token)
+        return d.addCallback(lambda _: None)
+
+
+    def _handoffPath(self, handoff):
+        """
+        Gets the path that the objects of a handoff are received in.
+        """
+        return self.rootStore.newTemporaryFilePath("handoffs", handoff)
+
+
+    @defer.inlineCallbacks
+    def _handOff(self, lock, peerName):
+        """
+        Hands a lock off to a peer: sends it a snapshot of the store, transfers
+        the lease to it and tells it to take over.
+
+        Changes to the store are rejected with ``ChangeRejected`` from before
+        the snapshot is taken, so that none are lost, and the store is closed
+        once the lease has been transferred. If the handoff fails before that,
+        the store can be changed again.
+        """
+        peer = self.peers[peerName]
+        handoff = os.urandom(8).encode("hex")
+
+        lock.store._rejectChanges += 1
+        try:
+            storeSnapshot = yield lock.snapshot()
+            objectStore = archive.DirectoryObjectStore(
+                storeSnapshot.path.temporarySibling(".handoff"))
+            try:
+                yield threads.deferToThread(archive.pack, storeSnapshot.path,
+                                            objectStore, _HANDOFF_KEY)
+                yield _sendObjects(peer, handoff, objectStore)
+            finally:
+                storeSnapshot.remove()
+                if objectStore.path.exists():
+                    objectStore.path.remove()
+
+            requested = self._clock.seconds()
+            response = yield self.remote.callRemote(
+                TransferLease, pathSegments=lock.pathSegments,
+                token=lock.token, newOwner=peerName,
+                duration=float(self.duration))
+        except:
+            lock.store._rejectChanges -= 1
+            raise
+
+        lock.lost = lock.released = True
+        self._held.pop(lock.token, None)
+        if not self._held:
+            self._stopHeartbeat()
+
+        validFor = requested + self.duration - self._clock.seconds()
+        try:
+            yield peer.callRemote(AcceptHandoff, handoff=handoff,
+                                  pathSegments=lock.pathSegments,
+                                  token=response["token"],
+                                  validFor=float(validFor))
+        finally:
+            lock.store.close()
+
+
+    def _accept(self, handoff, pathSegments, token, validFor):
+        """
+        Takes over a lock that was handed off to this client, restoring its
+        store from the objects that were sent.
+        """
+        received = self._clock.seconds()
+        objectStore = archive.DirectoryObjectStore(self._handoffPath(handoff))
+        storePath = layout.storePathFor(self.rootStore, pathSegments)
+
+        def restore():
+            try:
+                if storePath.exists():
+                    storePath.remove()
+                archive.unpack(objectStore, _HANDOFF_KEY, storePath)
+            finally:
+                objectStore.path.remove()
+
+        d = threads.deferToThread(restore)
+        d.addCallback(lambda _: archive.openStore(self.rootStore,
+                                                  pathSegments, storePath))
+        d.addCallback(warmup.warm, self.rootStore)
+        d.addCallback(self._adopt, pathSegments, token, received + validFor)
+
+        @d.addCallback
+        def handedOff(lock):
+            if self.onHandoff is not None:
+                self.onHandoff(lock)
+            return lock
+
+        return d
+
+
+    def stop(self):
+        """
+        Stops renewing leases. Held leases will expire.
+        """
+        self._stopHeartbeat()
+
+
+
+
+@interface.implementer(IHandoffWriteLock)
+class LeasedWriteLock(directory.LocalWriteLock):
+    """
+    A write lock backed by a lease.
+
+    Before writing, the lease's fencing token is checked with the lease
+    server, so that writes fail once the lease has been lost. The token is
+    also pushed along with the store, so that the archive rejects the write
+    if the lease was lost while it was being made, and a newer lease has
+    written the store since.
+
+    :ivar token: The fencing token of the lease.
+    :ivar expires: When the lease expires, as far as this host knows.
+    :ivar lost: Whether the lease is known to have been lost.
+    """
+    def __init__(self, lockedStore, storeArchive, pathSegments, client,
+                 token, expires):
+        directory.LocalWriteLock.__init__(self, lockedStore, storeArchive,
+                                          pathSegments)
+        self.client = client
+        self.token = token
+        self.expires = expires
+        self.lost = False
+
+
+    def write(self):
+        """
+        Checks the lease, and then writes the store.
+
+        :raises StaleLeaseException: If the lease is no longer current.
+        """
+        d = self.client._check(self)
+        return d.addCallback(lambda _: directory.LocalWriteLock.write(self))
+
+
+    def _push(self, snapshotPath):
+        """
+        Pushes a snapshot of the store, with this lease's fencing token.
+        """
+        d = self.storeArchive.push(self.pathSegments, snapshotPath,
+                                   self.token)
+
+        @d.addErrback
+        def stale(failure):
+            failure.trap(archive.StaleTokenException)
+            raise StaleLeaseException()
+
+        return d
+
+
+    def handoff(self, peerName):
+        """
+        Hands this lock off to a peer, which takes over the store while it is
+        still warm. Afterwards, this lock is released, its writes fail, and
+        its store is closed.
+
+        Changes to the store are rejected with ``ChangeRejected`` while the
+        handoff is in progress, so that every change is sent to the peer.
+
+        :param peerName: The owner name of the peer.
+        :return: A deferred that will fire when the peer holds the lock.
+        :raises StaleLeaseException: If the lease is no longer current.
+        """
+        if self.released:
+            return defer.fail(directory.AlreadyReleasedException())
+        return self.client._handOff(self, peerName)
+
+
+    def release(self):
+        """
+        Releases the lease.
+        """
+        if self.released:
+            return defer.fail(directory.AlreadyReleasedException())
+
+        self.released = True
+        return self.client._release(self)
+
+
+
+@defer.inlineCallbacks
+def _sendObjects(peer, handoff, objectStore):
+    """
+    Sends the objects of a handoff to a peer, in pieces. Up to
+    ``_PIECE_WINDOW`` pieces are in flight at once, rather than waiting for
+    each to be acknowledged; AMP delivers them in order.
+
+    Once a piece fails, no more are sent, and the first failure is raised.
+    """
+    def pieces():
+        names = (objectStore.list(_HANDOFF_KEY + "/chunks")
+                 + objectStore.list(_HANDOFF_KEY))
+        for name in names:
+            data = objectStore.get(name)
+            for offset in xrange(0, max(len(data), 1), _PIECE_SIZE):
+                last = offset + _PIECE_SIZE >= len(data)
+                yield name, data[offset:offset + _PIECE_SIZE], last
+
+    window = defer.DeferredSemaphore(_PIECE_WINDOW)
+    failures = []
+    sent = []
+
+    for name, piece, last in pieces():
+        yield window.acquire()
+        if failures:
+            break
+
+        d = peer.callRemote(SendHandoffPiece, handoff=handoff, name=name,
+                            data=piece, last=last)
+        d.addErrback(failures.append)
+        d.addCallback(lambda _: window.release())
+        sent.append(d)
+
+    yield defer.DeferredList(sent)
+    if failures:
+        failures[0].raiseException()
@@ -0,0 +1,157 @@
+"""
+Metrics for lock directories.
+"""
+import bisect
+
+
+TIME_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+"""
+The default bucket upper bounds for histograms of durations, in seconds.
+"""
+
+
+
+LENGTH_BOUNDS = (1, 2, 5, 10, 20, 50, 100)
+"""
+The default bucket upper bounds for histograms of queue lengths.
+"""
+
+
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets. The last bucket has no upper bound.
+
+    :ivar count: The number of observed values.
+    :ivar total: The sum of the observed values.
+    """
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds) + (float("inf"),)
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.total = 0
+
+
+    def observe(self, value):
+        """
+        Adds a value to the histogram.
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+
+    def buckets(self):
+        """
+        Gets the upper bound and count of each bucket.
+        """
+        return zip(self.bounds, self.counts)
+
+
+    def dump(self):
+        """
+        Describes the histogram as lines of text.
+        """
+        lines = []
+        for bound, count in self.buckets():
+            lines.append("  <= %-8s %d" % (bound, count))
+        mean = float(self.total) / self.count if self.count else 0
+        lines.append("  count %d, mean %.6f" % (self.count, mean))
+        return lines
+
+
+
+class LockMetrics(object):
+    """
+    Metrics for a lock directory.
+
+    :ivar acquisitions: The number of locks that were acquired.
+    :ivar timeouts: The number of acquisitions that timed out.
+    :ivar waitTimes: A histogram of how long acquisitions took.
+    :ivar holdTimes: A histogram of how long locks were held.
+    :ivar queueLengths: A histogram of the number of waiters ahead of each
+        request for a lock that was already held.
+    :ivar contention: The number of requests for locks that were already
+        held, by ``/``-separated path.
+    """
+    def __init__(self, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self._clock = clock
+        self.acquisitions = self.timeouts = 0
+        self.waitTimes = Histogram(TIME_BOUNDS)
+        self.holdTimes = Histogram(TIME_BOUNDS)
+        self.queueLengths = Histogram(LENGTH_BOUNDS)
+        self.contention = {}
+
+
+    def requested(self, pathSegments, waiting=None):
+        """
+        Records a request for a lock.
+
+        :param waiting: The number of waiters ahead of this request, or
+            ``None`` if the lock wasn't held.
+        :return: The time of the request.
+        """
+        if waiting is not None:
+            path = "/".join(pathSegments)
+            self.contention[path] = self.contention.get(path, 0) + 1
+            self.queueLengths.observe(waiting)
+        return self._clock.seconds()
+
+
+    def acquired(self, requestedAt):
+        """
+        Records that a lock that was requested at the given time has been
+        acquired.
+
+        :return: The time the lock was acquired.
+        """
+        now = self._clock.seconds()
+        self.acquisitions += 1
+        self.waitTimes.observe(now - requestedAt)
+        return now
+
+
+    def timedOut(self):
+        """
+        Records that a request for a lock timed out.
+        """
+        self.timeouts += 1
+
+
+    def released(self, acquiredAt):
+        """
+        Records that a lock that was acquired at the given time has been
+        released.
+        """
+        self.holdTimes.observe(self._clock.seconds() - acquiredAt)
+
+
+    def topContended(self, n=10):
+        """
+        Gets the ``n`` most contended paths, with their contention counts,
+        most contended first.
+        """
+        paths = sorted(self.contention.iteritems(),
+                       key=lambda (path, count): (-count, path))
+        return paths[:n]
+
+
+    def dump(self, n=10):
+        """
+        Describes the metrics as text.
+        """
+        lines = ["acquisitions: %d" % (self.acquisitions,),
+                 "timeouts: %d" % (self.timeouts,),
+                 "wait times (seconds):"]
+        lines.extend(self.waitTimes.dump())
+        lines.append("hold times (seconds):")
+        lines.extend(self.holdTimes.dump())
+        lines.append("queue lengths:")
+        lines.extend(self.queueLengths.dump())
+        lines.append("most contended paths:")
+        for path, count in self.topContended(n):
+            lines.append("  %d %s" % (count, path))
+        return "\n".join(lines) + "\n"
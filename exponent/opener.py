@@ -0,0 +1,135 @@
+"""
+Opening stores that already exist on disk.
+"""
+from axiom import attributes, item, store
+from exponent import exceptions, _util
+from twisted.internet import defer, threads
+from twisted.python import threadpool
+from zope import interface
+
+
+class IStoreOpener(interface.Interface):
+    """
+    Opens existing stores.
+
+    Long-term storage and lock directories use the ``IStoreOpener``
+    powerup of their root store to open stores, if there is one.
+    """
+    def open(storePath):
+        """
+        Opens the store at the given path.
+
+        :param storePath: The path of the store.
+        :type storePath: ``FilePath``
+        :return: A deferred that will fire with the store, or fail with
+            ``NoSuchStoreException`` if the store does not exist.
+        :rtype: deferred ``axiom.store.Store``
+        """
+
+
+
+def openStore(storePath):
+    """
+    Synchronously opens the store at the given path.
+
+    :raises NoSuchStoreException: If the store does not exist.
+    """
+    if not storePath.exists():
+        raise exceptions.NoSuchStoreException()
+    return store.Store(storePath)
+
+
+
+@interface.implementer(IStoreOpener)
+class _SynchronousOpener(object):
+    """
+    Opens stores synchronously, in the calling thread.
+    """
+    def open(self, storePath):
+        return defer.maybeDeferred(openStore, storePath)
+
+
+
+synchronousOpener = _SynchronousOpener()
+"""
+The store opener that is used when there is no ``IStoreOpener`` powerup.
+"""
+
+
+
+def getOpener(rootStore):
+    """
+    Gets the store opener for the given root store.
+    """
+    return IStoreOpener(rootStore, synchronousOpener)
+
+
+
+def _probe(storePath):
+    """
+    Checks that the store at the given path exists, and reads its
+    database file, so that it is in the page cache when it is opened.
+
+    :raises NoSuchStoreException: If the store does not exist.
+    """
+    if not storePath.exists():
+        raise exceptions.NoSuchStoreException()
+    _util.readAhead(storePath.child("db.sqlite"))
+
+
+
+@interface.implementer(IStoreOpener)
+class ThreadPoolOpener(item.Item):
+    """
+    A store opener that checks for stores and reads in their database file
+    in a bounded thread pool, keeping the slow filesystem work off the
+    reactor thread.
+
+    The store is then opened in the reactor thread, because SQLite
+    connections can only be used from the thread that created them.
+    """
+    powerupInterfaces = [IStoreOpener]
+
+    maxThreads = attributes.integer(allowNone=False, default=4)
+    """
+    The maximum number of threads used for filesystem work.
+    """
+
+    _reactor = attributes.inmemory()
+    _threadpool = attributes.inmemory()
+
+    def activate(self):
+        from twisted.internet import reactor
+        self._reactor = reactor
+        self._threadpool = None
+
+
+    def open(self, storePath):
+        threadpool = self._getThreadPool()
+        d = threads.deferToThreadPool(self._reactor, threadpool,
+                                      _probe, storePath)
+        return d.addCallback(lambda _: store.Store(storePath))
+
+
+    def _getThreadPool(self):
+        """
+        Gets the thread pool, starting it if necessary.
+
+        The thread pool is stopped when the reactor shuts down.
+        """
+        if self._threadpool is None:
+            name = "exponent-opener"
+            self._threadpool = threadpool.ThreadPool(0, self.maxThreads, name)
+            self._threadpool.start()
+            self._reactor.addSystemEventTrigger("during", "shutdown",
+                                                self.stop)
+        return self._threadpool
+
+
+    def stop(self):
+        """
+        Stops the thread pool, if it was started.
+        """
+        if self._threadpool is not None:
+            self._threadpool.stop()
+            self._threadpool = None
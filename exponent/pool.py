@@ -0,0 +1,215 @@
+"""
+Pools of open stores.
+"""
+import weakref
+
+from collections import OrderedDict
+
+
+class StorePool(object):
+    """
+    A bounded pool that keeps recently used stores open, keyed by path.
+
+    The pool holds strong references to at most ``maxSize`` stores. When
+    it is full, the least recently used store that is not pinned is
+    evicted. Stores that have not been used for ``idleTimeout`` seconds
+    are evicted as well.
+
+    Evicting a store only drops the pool's reference to it. A store that
+    is still referenced elsewhere keeps being returned by the pool until
+    it is garbage collected, so two callers never get different store
+    objects for the same path.
+
+    :ivar hits: The number of lookups that found an open store.
+    :ivar misses: The number of lookups that did not.
+    :ivar evictions: The number of stores evicted from the pool.
+    """
+    def __init__(self, maxSize=1024, idleTimeout=300, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self._clock = clock
+
+        self._entries = OrderedDict()
+        self._pins = {}
+        self._lastUsed = {}
+        self._referenced = weakref.WeakValueDictionary()
+
+        self.hits = self.misses = self.evictions = 0
+
+
+    def __len__(self):
+        """
+        The number of stores the pool is keeping open.
+        """
+        return len(self._entries)
+
+
+    def __contains__(self, key):
+        return key in self._entries or key in self._referenced
+
+
+    def get(self, key):
+        """
+        Gets the open store for this key, marking it as recently used.
+
+        :raises KeyError: If there is no open store for this key.
+        """
+        self.evictIdle()
+
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            try:
+                value = self._referenced[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+        self.hits += 1
+        self._add(key, value)
+        return value
+
+
+    def put(self, key, value):
+        """
+        Adds an open store to the pool, evicting other stores if the pool is
+        full.
+        """
+        self._entries.pop(key, None)
+        self._add(key, value)
+
+
+    def discard(self, key):
+        """
+        Forgets the store for this key, if there is one, for example because
+        it has been closed or deleted. Pins are forgotten as well.
+        """
+        self._entries.pop(key, None)
+        self._lastUsed.pop(key, None)
+        self._pins.pop(key, None)
+        self._referenced.pop(key, None)
+
+
+    def _add(self, key, value):
+        """
+        Adds the store as the most recently used one, then makes room.
+        """
+        self._entries[key] = self._referenced[key] = value
+        self._lastUsed[key] = self._clock.seconds()
+        self._shrink()
+
+
+    def pin(self, key):
+        """
+        Pins the store for this key, so that it is not evicted until it is
+        unpinned. Pins nest.
+
+        :raises KeyError: If there is no open store for this key.
+        """
+        if key not in self._entries:
+            raise KeyError(key)
+        self._pins[key] = self._pins.get(key, 0) + 1
+
+
+    def unpin(self, key):
+        """
+        Undoes a previous ``pin``.
+
+        :raises KeyError: If the store for this key is not pinned.
+        """
+        remaining = self._pins.pop(key) - 1
+        if remaining:
+            self._pins[key] = remaining
+        else:
+            self._add(key, self._entries.pop(key))
+
+
+    def isPinned(self, key):
+        """
+        Checks if the store for this key is pinned.
+        """
+        return key in self._pins
+
+
+    def evictIdle(self):
+        """
+        Evicts every unpinned store that has been idle for longer than the
+        idle timeout.
+
+        This is called on every lookup, but can also be called periodically
+        (for example, with a ``LoopingCall``) to evict stores when there is
+        no traffic.
+        """
+        deadline = self._clock.seconds() - self.idleTimeout
+        for key in list(self._entries):
+            if self._lastUsed[key] >= deadline:
+                break # entries are in order of use, the rest is newer
+            if key not in self._pins:
+                self._evict(key)
+
+
+    def _shrink(self):
+        """
+        Evicts the least recently used unpinned stores until the pool is no
+        longer over its maximum size.
+        """
+        if len(self._entries) <= self.maxSize:
+            return
+
+        for key in list(self._entries):
+            if key not in self._pins:
+                self._evict(key)
+                if len(self._entries) <= self.maxSize:
+                    return
+
+
+    def _evict(self, key):
+        """
+        Drops the pool's reference to the store for this key.
+        """
+        del self._entries[key]
+        del self._lastUsed[key]
+        self.evictions += 1
+
+
+
+class ClosingStorePool(StorePool):
+    """
+    A store pool that closes stores when it evicts them, so that it bounds
+    the number of stores (and their file descriptors) that are open, and not
+    just the number it refers to.
+
+    Evicted stores are closed and forgotten, so the next lookup misses and
+    the store has to be opened again. A store that is in use for a while
+    should be pinned, so that it isn't closed from under its user.
+
+    :ivar opens: The number of stores that were added to the pool.
+    :ivar closes: The number of stores the pool closed.
+    """
+    def __init__(self, close, maxSize=1024, idleTimeout=300, clock=None):
+        """
+        :param close: Called with a store to close it.
+        """
+        StorePool.__init__(self, maxSize, idleTimeout, clock)
+        self._close = close
+        self.opens = self.closes = 0
+
+
+    def put(self, key, value):
+        if key not in self:
+            self.opens += 1
+        StorePool.put(self, key, value)
+
+
+    def _evict(self, key):
+        """
+        Closes and forgets the store for this key.
+        """
+        value = self._entries[key]
+        StorePool._evict(self, key)
+        self._referenced.pop(key, None)
+        self._close(value)
+        self.closes += 1
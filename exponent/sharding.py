@@ -0,0 +1,233 @@
+"""
+Spreading stores over several write lock directories.
+"""
+import bisect
+import hashlib
+
+from exponent import directory
+from zope import interface
+
+
+def _hash(key):
+    """
+    Hashes a key to a position on the ring.
+    """
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+
+class HashRing(object):
+    """
+    A consistent hash ring with virtual nodes.
+
+    Every node is placed on the ring ``virtualNodes`` times; a key belongs
+    to the first node at or after its position. Adding or removing a node
+    only moves the keys that belong to that node.
+    """
+    def __init__(self, virtualNodes=100):
+        self.virtualNodes = virtualNodes
+        self._positions = []
+        self._nodes = []
+
+
+    def __len__(self):
+        return len(set(self._nodes))
+
+
+    def add(self, node):
+        """
+        Adds a node to the ring.
+        """
+        for i in xrange(self.virtualNodes):
+            position = _hash("%s-%d" % (node, i))
+            index = bisect.bisect(self._positions, position)
+            self._positions.insert(index, position)
+            self._nodes.insert(index, node)
+
+
+    def remove(self, node):
+        """
+        Removes a node from the ring.
+        """
+        remaining = [(p, n) for p, n in zip(self._positions, self._nodes)
+                     if n != node]
+        self._positions = [p for p, _ in remaining]
+        self._nodes = [n for _, n in remaining]
+
+
+    def get(self, key):
+        """
+        Gets the node a key belongs to.
+
+        :raises KeyError: If the ring is empty.
+        """
+        if not self._nodes:
+            raise KeyError(key)
+        index = bisect.bisect(self._positions, _hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+
+class ShardMetrics(object):
+    """
+    Request metrics for a shard.
+
+    :ivar requests: The number of acquisitions that were requested.
+    :ivar acquired: The number of those that succeeded.
+    :ivar failed: The number of those that failed.
+    """
+    def __init__(self):
+        self.requests = self.acquired = self.failed = 0
+
+
+
+class _ShardLock(object):
+    """
+    A lock acquired from a shard, which tells the sharded directory when it
+    is released. Everything else is passed on to the shard's lock.
+    """
+    def __init__(self, lock, onRelease):
+        self._lock = lock
+        self._onRelease = onRelease
+        interface.directlyProvides(self, interface.providedBy(lock))
+
+
+    def __getattr__(self, name):
+        return getattr(self._lock, name)
+
+
+    def _released(self):
+        """
+        Tells the sharded directory that this lock is gone, once.
+        """
+        onRelease, self._onRelease = self._onRelease, None
+        if onRelease is not None:
+            onRelease()
+
+
+    def release(self):
+        self._released()
+        return self._lock.release()
+
+
+    def handoff(self, peerName):
+        """
+        Hands the shard's lock off to a peer; once it has been, this lock is
+        gone as if it had been released.
+        """
+        d = self._lock.handoff(peerName)
+
+        @d.addCallback
+        def handedOff(result):
+            self._released()
+            return result
+
+        return d
+
+
+
+@interface.implementer(directory.IWriteLockDirectory)
+class ShardedWriteLockDirectory(object):
+    """
+    A write lock directory that spreads stores over several other write
+    lock directories (shards) by consistent hashing of their path segments.
+
+    Shards can be added and removed while locks are held. Stores that are
+    locked, or being locked, through this directory stay with the shard they
+    were locked in until all of those locks are released, so that this
+    directory never locks a store in two shards at once. Only then do they
+    move to their new shard. This routing is kept by each directory, so it
+    doesn't cover locks held through other directories, for example on
+    other application servers.
+
+    :ivar metrics: The request metrics of each shard, by name.
+    """
+    def __init__(self, virtualNodes=100):
+        self._ring = HashRing(virtualNodes)
+        self._shards = {}
+        self._routes = {}
+        self._removed = set()
+        self.metrics = {}
+
+
+    def addShard(self, name, lockDirectory):
+        """
+        Adds a shard. Only the stores that now belong to it move.
+
+        :raises ValueError: If there already is a shard with this name,
+            including one that was removed but still has locked stores.
+        """
+        if name in self._shards:
+            raise ValueError("shard %r already exists" % (name,))
+        self._shards[name] = lockDirectory
+        self.metrics[name] = ShardMetrics()
+        self._ring.add(name)
+
+
+    def removeShard(self, name):
+        """
+        Removes a shard. Only the stores that belonged to it move. The shard
+        is kept until the stores that are locked in it are released.
+        """
+        self._ring.remove(name)
+        self._removed.add(name)
+        self._forgetRemoved(name)
+
+
+    def _forgetRemoved(self, name):
+        """
+        Forgets a removed shard, unless stores are still locked in it.
+        """
+        if any(routed == name for routed, _ in self._routes.itervalues()):
+            return
+        self._removed.discard(name)
+        del self._shards[name]
+        del self.metrics[name]
+
+
+    def shardFor(self, pathSegments):
+        """
+        Gets the name of the shard that the store belongs to: the one it is
+        locked in, if it is, and the one it hashes to otherwise.
+        """
+        key = "/".join(pathSegments)
+        route = self._routes.get(key)
+        if route is not None:
+            return route[0]
+        return self._ring.get(key)
+
+
+    def _unroute(self, key):
+        """
+        Notes that a lock on a store has been released, or couldn't be
+        acquired.
+        """
+        route = self._routes[key]
+        route[1] -= 1
+        if not route[1]:
+            del self._routes[key]
+            if route[0] in self._removed:
+                self._forgetRemoved(route[0])
+
+
+    def acquire(self, pathSegments):
+        key = "/".join(pathSegments)
+        name = self.shardFor(pathSegments)
+        self._routes.setdefault(key, [name, 0])[1] += 1
+        metrics = self.metrics[name]
+        metrics.requests += 1
+
+        d = self._shards[name].acquire(pathSegments)
+
+        @d.addCallback
+        def acquired(lock):
+            metrics.acquired += 1
+            return _ShardLock(lock, lambda: self._unroute(key))
+
+        @d.addErrback
+        def failed(failure):
+            metrics.failed += 1
+            self._unroute(key)
+            return failure
+
+        return d
@@ -0,0 +1,169 @@
+"""
+Online snapshots of stores that are in use.
+"""
+import errno
+import os
+import shutil
+import struct
+
+from axiom import store
+from twisted.internet import task
+
+
+class Snapshot(object):
+    """
+    A consistent copy of a store, taken while it was in use.
+
+    :ivar path: The directory containing the copy.
+    :type path: ``FilePath``
+    :ivar restarts: The number of times copying had to start over because
+        the store changed while it was being copied.
+    :type restarts: ``int``
+    """
+    def __init__(self, path, restarts):
+        self.path = path
+        self.restarts = restarts
+
+
+    def open(self):
+        """
+        Opens the copy of the store.
+        """
+        return store.Store(self.path)
+
+
+    def remove(self):
+        """
+        Removes the copy of the store.
+        """
+        self.path.remove()
+
+
+
+def _readHeader(dbPath):
+    """
+    Reads the page size and file change counter from the header of an
+    SQLite database file.
+    """
+    with dbPath.open() as f:
+        header = f.read(28)
+    pageSize, = struct.unpack(">H", header[16:18])
+    changeCounter, = struct.unpack(">I", header[24:28])
+    return (65536 if pageSize == 1 else pageSize), changeCounter
+
+
+
+def _linkTree(source, destination):
+    """
+    Recreates the directory tree at ``source`` at ``destination``, hard
+    linking files where possible and copying them otherwise.
+    """
+    for directory, _, files in os.walk(source.path):
+        target = os.path.join(destination.path,
+                              os.path.relpath(directory, source.path))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            try:
+                os.link(os.path.join(directory, name),
+                        os.path.join(target, name))
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copy2(os.path.join(directory, name), target)
+
+
+
+class _Copier(object):
+    """
+    Copies a store incrementally, a few pages at a time, in the manner of
+    SQLite's online backup API: if the database changes while it is being
+    copied, copying starts over.
+    """
+    def __init__(self, storePath, destination, pagesPerStep, maxRestarts):
+        self.storePath = storePath
+        self.destination = destination
+        self.pagesPerStep = pagesPerStep
+        self.maxRestarts = maxRestarts
+        self.restarts = 0
+
+
+    def steps(self):
+        """
+        Copies the store, yielding between batches of pages.
+
+        Once the database has been copied without it changing, the files
+        directory is linked in the same step that checks for changes, so
+        that the files match the database. If the database keeps changing
+        after ``maxRestarts`` restarts, the last copy is made in a single
+        step.
+        """
+        source = self.storePath.child("db.sqlite")
+        target = self.destination.child("db.sqlite")
+        self.destination.makedirs()
+
+        while self.restarts < self.maxRestarts:
+            pageSize, changeCounter = _readHeader(source)
+            batchSize = pageSize * self.pagesPerStep
+
+            with source.open() as src, target.open("w") as dst:
+                for data in iter(lambda: src.read(batchSize), ""):
+                    dst.write(data)
+                    yield None
+                    if _readHeader(source)[1] != changeCounter:
+                        break
+                else:
+                    self._linkFiles()
+                    return
+
+            self.restarts += 1
+
+        source.copyTo(target)
+        self._linkFiles()
+
+
+    def _linkFiles(self):
+        """
+        Links the store's files directory into the snapshot.
+        """
+        filesPath = self.storePath.child("files")
+        if filesPath.isdir():
+            _linkTree(filesPath, self.destination.child("files"))
+
+
+
+def snapshot(storePath, destination, pagesPerStep=256, maxRestarts=10,
+             cooperator=task):
+    """
+    Takes a snapshot of a store that may be in use.
+
+    The database is copied a few pages at a time, interleaved with other
+    work in the reactor, so that the store's user isn't blocked. Transactions
+    committed while the snapshot is taken cause copying to start over.
+
+    Files in the files directory are hard linked where possible, so they
+    must be replaced rather than changed in place, as Axiom does.
+
+    :param storePath: The directory of the store.
+    :type storePath: ``FilePath``
+    :param destination: The directory to copy the store to. It must not
+        exist yet.
+    :type destination: ``FilePath``
+    :param pagesPerStep: The number of pages copied at a time.
+    :param maxRestarts: The number of times copying starts over before the
+        rest of the snapshot is taken in one go.
+    :param cooperator: The cooperator that interleaves copying with other
+        work.
+    :return: A deferred that will fire with the snapshot.
+    :rtype: deferred ``Snapshot``
+    """
+    copier = _Copier(storePath, destination, pagesPerStep, maxRestarts)
+    d = cooperator.cooperate(copier.steps()).whenDone()
+
+    @d.addErrback
+    def removePartialSnapshot(failure):
+        if destination.exists():
+            destination.remove()
+        return failure
+
+    return d.addCallback(lambda _: Snapshot(destination, copier.restarts))
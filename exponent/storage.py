@@ -1,10 +1,8 @@
 """
 Long-term storage for Axiom stores.
 """
-import weakref
-
-from axiom import attributes, item, store
-from exponent import exceptions
+from axiom import attributes, item, upgrade
+from exponent import archive, layout, pool, _util
 from twisted.internet import defer
 from zope import interface
 
@@ -22,22 +20,77 @@ class IStorage(interface.Interface):
 
 @interface.implementer(IStorage)
 class FakeStorage(item.Item):
+    """
+    Storage that uses stores directly under the root store's files
+    directory. Stores that aren't there are fetched from the root store's
+    ``IStoreArchive`` powerup, if it has one.
+
+    Opened stores are kept in a pool, so that getting the same store again
+    shortly after does not have to open it again.
+    """
+    schemaVersion = 2
+
     _dummy = attributes.boolean()
-    _cache = attributes.inmemory()
+
+    maxOpenStores = attributes.integer(allowNone=False, default=1024)
+    """
+    The maximum number of stores kept open by the pool.
+    """
+
+    idleTimeout = attributes.integer(allowNone=False, default=300)
+    """
+    The number of seconds after which an unused store is evicted from the
+    pool.
+    """
+
+    pool = attributes.inmemory()
+    """
+    The pool of open stores.
+
+    :type: ``exponent.pool.StorePool``
+    """
+
+    _opening = attributes.inmemory()
 
     def activate(self):
-        self._cache = weakref.WeakValueDictionary()
+        self.pool = pool.StorePool(self.maxOpenStores, self.idleTimeout)
+        self._opening = _util.Coalescer()
 
 
     def get(self, pathSegments):
-        storePath = self.store.filesdir.descendant(pathSegments)
+        storePath = layout.storePathFor(self.store, pathSegments)
         try:
-            return defer.succeed(self._cache[storePath])
+            return defer.succeed(self.pool.get(storePath))
         except KeyError:
             pass
 
-        if not storePath.exists():
-            return defer.fail(exceptions.NoSuchStoreException())
+        return self._opening.call(storePath, self._open, pathSegments,
+                                  storePath)
+
+
+    def _open(self, pathSegments, storePath):
+        """
+        Opens the store at the given path, fetching it from the root store's
+        archive if necessary, and adds it to the pool.
+
+        Concurrent calls for the same path are coalesced, so that the store
+        is only opened once.
+        """
+        d = archive.openStore(self.store, pathSegments, storePath)
+        return d.addCallback(self._opened, storePath)
+
+
+    def _opened(self, requestedStore, storePath):
+        """
+        Adds a freshly opened store to the pool.
+        """
+        self.pool.put(storePath, requestedStore)
+        return requestedStore
+
+
+
+item.declareLegacyItem(FakeStorage.typeName, 1, {
+    "_dummy": attributes.boolean()
+})
 
-        requestedStore = self._cache[storePath] = store.Store(storePath)
-        return defer.succeed(requestedStore)
+upgrade.registerAttributeCopyingUpgrader(FakeStorage, 1, 2)
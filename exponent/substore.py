@@ -1,7 +1,118 @@
 """
 Helpers for substores and items that are first-class children of root stores.
 """
-from axiom import substore
+import itertools
+import multiprocessing
+import signal
+import traceback
+
+from axiom import attributes, item, store, substore
+from exponent import layout, pool, _util
+from twisted.python import filepath
+
+
+CACHE_SIZE = 1024
+"""
+The maximum number of opened child stores kept open for each root store.
+Pinned stores don't count towards this.
+"""
+
+
+
+IDLE_TIMEOUT = 300
+"""
+The number of seconds after which an unused child store is closed.
+"""
+
+
+
+def _closeChildStore(childStore):
+    """
+    Closes a child store, so that its substore opens it again when it is
+    next needed.
+    """
+    childStore._openSubStore.close()
+
+
+
+def _cacheFor(rootStore):
+    """
+    Gets the cache of opened child stores of a root store.
+
+    The cache is kept on the root store itself, rather than in a mapping
+    keyed by it, since its child stores refer to the root store: that way,
+    the root store and its child stores can be collected together.
+    """
+    try:
+        return rootStore._childStoreCache
+    except AttributeError:
+        cache = rootStore._childStoreCache = pool.ClosingStorePool(
+            _closeChildStore, CACHE_SIZE, IDLE_TIMEOUT)
+        return cache
+
+
+
+def getChildStorePool(rootStore):
+    """
+    Gets the pool of open child stores of a root store.
+
+    Child stores that haven't been used for a while, or that are the least
+    recently used ones when there are too many, are closed, and reopened
+    when they are next gotten. Callers that keep using a child store, or
+    items in it, should hold it with ``holdChildStore``, which pins it in
+    this pool until it is released. The pool's counters show how often
+    stores are opened and closed, to tune its size and idle timeout.
+
+    :rtype: ``exponent.pool.ClosingStorePool``
+    """
+    return _cacheFor(rootStore)
+
+
+
+def clearCache(rootStore):
+    """
+    Forgets all of the opened child stores of a root store, for example
+    because they have been closed.
+    """
+    vars(rootStore).pop("_childStoreCache", None)
+
+
+
+def _pathKey(pathSegments):
+    """
+    Gets the key that a child store with the given path segments is known
+    by in its root store.
+    """
+    key = "/".join(pathSegments)
+    if isinstance(key, str):
+        key = key.decode("utf-8")
+    return key
+
+
+
+class ChildStoreReference(item.Item):
+    """
+    An index from the path segments of a child store to its substore.
+    """
+    path = attributes.text(allowNone=False, indexed=True)
+    """
+    The ``/``-separated path segments of the child store.
+    """
+
+    subStore = attributes.reference(allowNone=False,
+                                    whenDeleted=attributes.reference.CASCADE)
+    """
+    The substore of the child store.
+    """
+
+    def deleted(self):
+        """
+        Forgets the child store, once it has been deleted.
+        """
+        cache = getattr(self.store, "_childStoreCache", None)
+        if cache is not None:
+            cache.discard(self.path)
+
 
 
 def createChildStore(rootStore, pathSegments):
@@ -9,20 +120,421 @@ def createChildStore(rootStore, pathSegments):
     Creates amd returns substore under the given root store with the given
     path segments.
     """
-    return substore.SubStore.createNew(rootStore, pathSegments).open()
+    diskSegments = layout.getLayout(rootStore).segmentsFor(pathSegments)
+
+    def create():
+        subStore = substore.SubStore.createNew(rootStore, diskSegments)
+        ChildStoreReference(store=rootStore, path=_pathKey(pathSegments),
+                            subStore=subStore)
+        return subStore
+
+    childStore = rootStore.transact(create).open()
+    _cacheFor(rootStore).put(_pathKey(pathSegments), childStore)
+    return childStore
+
+
+
+class _Template(object):
+    """
+    How to build the template store for a type of child, and how to adapt
+    a copy of it into a new child store.
+    """
+    def __init__(self, build, fixup):
+        self.build = build
+        self.fixup = fixup
+
+
+
+_templates = {}
+
+
+
+def _templatePath(rootStore, typeName):
+    """
+    Gets the path of the template store for a type of child. Templates are
+    kept outside the files directory, so they aren't mistaken for child
+    stores.
+    """
+    return rootStore.dbdir.child("templates").child(typeName)
+
+
+
+def _getTemplate(rootStore, cls):
+    """
+    Gets the path of the template store for a type of child, building it
+    first if necessary.
+    """
+    templatePath = _templatePath(rootStore, cls.typeName)
+    if not templatePath.exists():
+        temporary = templatePath.temporarySibling()
+        if not temporary.parent().isdir():
+            temporary.parent().makedirs()
+        templateStore = store.Store(temporary)
+        templateStore.transact(_templates[cls].build, templateStore)
+        templateStore.close()
+        temporary.moveTo(templatePath)
+    return templatePath
+
+
+
+def cloneChildStore(rootStore, pathSegments, templatePath, fixup=None):
+    """
+    Creates a child store under the given root store by copying a template
+    store, and opens it.
+
+    :param fixup: If given, called with the new child store and its path
+        segments in a transaction, to adapt the copy.
+    """
+    diskSegments = layout.getLayout(rootStore).segmentsFor(pathSegments)
+    storePath = rootStore.newDirectory(*diskSegments)
+    temporary = storePath.temporarySibling(layout.TEMPORARY_EXTENSION)
+    _util.cloneTree(templatePath, temporary)
+    temporary.moveTo(storePath)
+
+    def create():
+        subStore = substore.SubStore(store=rootStore, storepath=storePath)
+        ChildStoreReference(store=rootStore, path=_pathKey(pathSegments),
+                            subStore=subStore)
+        return subStore
+
+    childStore = rootStore.transact(create).open()
+    if fixup is not None:
+        childStore.transact(fixup, childStore, pathSegments)
+    _cacheFor(rootStore).put(_pathKey(pathSegments), childStore)
+    return childStore
+
+
+
+def _initializeStore((path, templatePath)):
+    """
+    Creates a store at the given path, as a copy of the template store at
+    ``templatePath`` if it is given, or empty otherwise, and closes it.
+    """
+    if templatePath is None:
+        store.Store(path).close()
+    else:
+        temporary = filepath.FilePath(path).temporarySibling(
+            layout.TEMPORARY_EXTENSION)
+        _util.cloneTree(filepath.FilePath(templatePath), temporary)
+        temporary.moveTo(filepath.FilePath(path))
+
+
+
+def _fixUp(subStore, pathSegments, fixup):
+    """
+    Runs a template's fixup on a new child store, and closes it again.
+    """
+    childStore = subStore.open()
+    try:
+        childStore.transact(fixup, childStore, pathSegments)
+    finally:
+        subStore.close()
+
+
+
+def createChildStores(rootStore, allPathSegments, batchSize=1000,
+                      processes=None, templatePath=None, fixup=None):
+    """
+    Creates many child stores under the given root store at once.
+
+    The child stores' databases are created in parallel worker processes
+    first. Then their substores are created in the root store, in
+    transactions of ``batchSize`` stores each, instead of one transaction
+    per store.
+
+    :param allPathSegments: The path segments of the child stores.
+    :param processes: The number of worker processes, or ``None`` for one
+        per CPU. If it is ``0``, databases are created in this process.
+    :param templatePath: If given, the child stores are copies of the
+        template store at this path, as with ``cloneChildStore``.
+    :param fixup: If given, called with every new child store and its path
+        segments in a transaction, to adapt the copy.
+    :return: The number of child stores that were created.
+    """
+    allPathSegments = list(allPathSegments)
+    getSegments = layout.getLayout(rootStore).segmentsFor
+    storePaths = [rootStore.newDirectory(*getSegments(pathSegments))
+                  for pathSegments in allPathSegments]
+
+    if templatePath is not None:
+        templatePath = templatePath.path
+    tasks = [(storePath.path, templatePath) for storePath in storePaths]
+    if processes == 0:
+        for task in tasks:
+            _initializeStore(task)
+    else:
+        workers = multiprocessing.Pool(processes)
+        try:
+            workers.map(_initializeStore, tasks, chunksize=64)
+        finally:
+            workers.close()
+            workers.join()
+
+    def createBatch(batch):
+        subStores = []
+        for pathSegments, storePath in batch:
+            subStore = substore.SubStore(store=rootStore, storepath=storePath)
+            ChildStoreReference(store=rootStore, path=_pathKey(pathSegments),
+                                subStore=subStore)
+            subStores.append(subStore)
+        return subStores
+
+    pairs = zip(allPathSegments, storePaths)
+    for start in xrange(0, len(pairs), batchSize):
+        batch = pairs[start:start + batchSize]
+        subStores = rootStore.transact(createBatch, batch)
+        if fixup is not None:
+            for (pathSegments, _), subStore in zip(batch, subStores):
+                _fixUp(subStore, pathSegments, fixup)
+
+    return len(pairs)
+
+
+
+def _findSubStore(rootStore, pathSegments):
+    """
+    Finds the substore of a child store, by its path segments.
+
+    Substores that were created without a reference, by older versions, are
+    found by their path, and then get a reference.
+
+    :raises axiom.errors.ItemNotFound: If there is no such substore.
+    """
+    key = _pathKey(pathSegments)
+    reference = rootStore.findFirst(ChildStoreReference,
+                                    ChildStoreReference.path == key)
+    if reference is not None:
+        return reference.subStore
+
+    storePath = layout.storePathFor(rootStore, pathSegments)
+    withThisPath = substore.SubStore.storepath == storePath
+    subStore = rootStore.findUnique(substore.SubStore, withThisPath)
+    rootStore.transact(ChildStoreReference, store=rootStore, path=key,
+                       subStore=subStore)
+    return subStore
+
+
+
+def _backfillReferences(rootStore):
+    """
+    Gives the child stores that were created without a reference, by older
+    versions, a reference, so that they can be found by path prefix.
+    """
+    referenced = rootStore.query(ChildStoreReference).getColumn("subStore")
+    unreferenced = rootStore.query(
+        substore.SubStore, substore.SubStore.storeID.notOneOf(referenced))
+    pathSegmentsFor = layout.getLayout(rootStore).pathSegmentsFor
+
+    def backfill():
+        for subStore in unreferenced:
+            diskSegments = subStore.storepath.segmentsFrom(rootStore.filesdir)
+            pathSegments = pathSegmentsFor(diskSegments)
+            ChildStoreReference(store=rootStore, path=_pathKey(pathSegments),
+                                subStore=subStore)
+
+    rootStore.transact(backfill)
+
 
 
 def getChildStore(rootStore, pathSegments):
     """
     Gets a child store under the root store with these path segments.
 
+    Recently used child stores are kept open, so getting them again doesn't
+    reopen them. Others are closed, and reopened here; see
+    ``getChildStorePool``.
+
     Raises ``axiom.errors.ItemNotFound`` if no such store exists.
     """
-    storePath = rootStore.filesdir
-    for segment in pathSegments:
-        storePath = storePath.child(segment)
-    withThisPath = substore.SubStore.storepath == storePath
-    return rootStore.findUnique(substore.SubStore, withThisPath).open()
+    cache = _cacheFor(rootStore)
+    key = _pathKey(pathSegments)
+    try:
+        return cache.get(key)
+    except KeyError:
+        childStore = _findSubStore(rootStore, pathSegments).open()
+        cache.put(key, childStore)
+        return childStore
+
+
+
+class ChildStoreHandle(object):
+    """
+    Holds an open child store, which is pinned in its pool so that it isn't
+    closed until the handle is released.
+
+    Handles are context managers, which give the child store and release
+    the handle on exit.
+
+    :ivar store: The child store.
+    """
+    def __init__(self, rootStore, pathSegments):
+        self._pool = _cacheFor(rootStore)
+        self._key = _pathKey(pathSegments)
+        self.store = getChildStore(rootStore, pathSegments)
+        self._pool.pin(self._key)
+        self.released = False
+
+
+    def release(self):
+        """
+        Releases the child store, so that it can be closed again. Releasing
+        a handle more than once does nothing.
+        """
+        if self.released:
+            return
+        self.released = True
+        if self._pool.isPinned(self._key):
+            self._pool.unpin(self._key)
+
+
+    def __enter__(self):
+        return self.store
+
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+
+def holdChildStore(rootStore, pathSegments):
+    """
+    Gets a child store under the root store with these path segments, and
+    keeps it open until the returned handle is released.
+
+    Raises ``axiom.errors.ItemNotFound`` if no such store exists.
+
+    :rtype: ``ChildStoreHandle``
+    """
+    return ChildStoreHandle(rootStore, pathSegments)
+
+
+
+def deleteChildStore(rootStore, pathSegments):
+    """
+    Deletes a child store under the root store with these path segments,
+    including its files on disk.
+
+    Raises ``axiom.errors.ItemNotFound`` if no such store exists.
+    """
+    subStore = _findSubStore(rootStore, pathSegments)
+    storePath = subStore.storepath
+    if hasattr(subStore, "substore"):
+        subStore.close()
+
+    rootStore.transact(subStore.deleteFromStore)
+    _cacheFor(rootStore).discard(_pathKey(pathSegments))
+    if storePath is not None and storePath.exists():
+        storePath.remove()
+
+
+
+def _initializeWorker():
+    """
+    Restores the default handler for ``SIGTERM`` in a worker process, which
+    may have inherited the reactor's, so that the pool can terminate it.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+
+class FanOutError(Exception):
+    """
+    A fan-out query failed on a child store.
+
+    The original exception is described by its formatted traceback, since
+    it may not survive being sent back from a worker process.
+    """
+
+
+
+def _queryStore((path, query, predicate, limit, aggregate)):
+    """
+    Runs a fan-out query on the store at the given path, and closes it
+    again.
+
+    :return: The (filtered, limited) results of the query, or their
+        aggregate.
+    :raises FanOutError: If the query fails.
+    """
+    try:
+        childStore = store.Store(path)
+        try:
+            results = query(childStore)
+            if predicate is not None:
+                results = itertools.ifilter(predicate, results)
+            results = list(itertools.islice(results, limit))
+            if aggregate is not None:
+                return aggregate(results)
+            return results
+        finally:
+            childStore.close()
+    except Exception:
+        raise FanOutError(path, traceback.format_exc())
+
+
+
+def fanOut(rootStore, query, prefix=(), predicate=None, limit=None,
+           aggregate=None, processes=None):
+    """
+    Runs a query on every child store under the given root store, in
+    parallel worker processes, and yields its results as they come in.
+
+    Child stores that were created without a reference, by older versions,
+    get one first, so that they are queried too.
+
+    All of the callables are sent to the worker processes, so they have to
+    be picklable, for example module-level functions, and so do the results
+    they produce.
+
+    :param query: Called with a child store. Returns an iterable of
+        results; items can't be sent back, so these would typically be
+        tuples of attribute values.
+    :param prefix: Only query the child stores whose path segments start
+        with these.
+    :param predicate: If given, only results for which this returns true
+        are yielded. It is called in the worker processes.
+    :param limit: If given, stop after this many results (or aggregates).
+    :param aggregate: If given, called in the worker processes with the list
+        of results of each child store; one partial aggregate per child
+        store is yielded instead of the results.
+    :param processes: The number of worker processes, or ``None`` for one
+        per CPU. If it is ``0``, queries are run in this process.
+    :return: An iterable of ``(pathSegments, result)`` pairs.
+    :raises FanOutError: If the query fails on a child store.
+    """
+    _backfillReferences(rootStore)
+    comparison = None
+    if prefix:
+        key = _pathKey(prefix) + u"/"
+        comparison = ChildStoreReference.path.startswith(key)
+    references = list(rootStore.query(ChildStoreReference, comparison))
+
+    paths = [reference.path.split(u"/") for reference in references]
+    storeLimit = limit if aggregate is None else None
+    tasks = [(reference.subStore.storepath.path, query, predicate,
+              storeLimit, aggregate)
+             for reference in references]
+
+    if processes == 0:
+        workers = None
+        allResults = itertools.imap(_queryStore, tasks)
+    else:
+        workers = multiprocessing.Pool(processes, _initializeWorker)
+        allResults = workers.imap(_queryStore, tasks)
+
+    try:
+        if aggregate is not None:
+            pairs = itertools.izip(paths, allResults)
+        else:
+            pairs = ((path, result)
+                     for path, results in itertools.izip(paths, allResults)
+                     for result in results)
+        for pair in itertools.islice(pairs, limit):
+            yield pair
+    finally:
+        if workers is not None:
+            workers.terminate()
+            workers.join()
 
 
 
@@ -30,13 +542,80 @@ class ChildMixin(object):
     """
     A mixin for Item classes that are first-class children of a root store.
     """
+    @classmethod
+    def registerTemplate(cls, build, fixup=None):
+        """
+        Registers a template for child stores of this type. New child stores
+        are then created by copying the template store, instead of being
+        set up from scratch.
+
+        The template store is built once for each root store, by calling
+        ``build`` with it in a transaction.
+
+        :param fixup: If given, called with every new child store and its
+            path segments in a transaction, to adapt the copy, for example by
+            filling in identifiers.
+        """
+        _templates[cls] = _Template(build, fixup)
+
+
+    @classmethod
+    def discardTemplate(cls, rootStore):
+        """
+        Discards the template store for this type under the root store, so
+        that it is built again, for example after its ``build`` changed.
+        """
+        templatePath = _templatePath(rootStore, cls.typeName)
+        if templatePath.exists():
+            templatePath.remove()
+
+
     @classmethod
     def createChildStore(cls, rootStore, pathSegments):
         """
         Creates a child store under the root store with these path segments.
+
+        If a template was registered for this type, the child store is a copy
+        of the template store.
         """
         pathSegments = [cls.typeName] + list(pathSegments)
-        return createChildStore(rootStore, pathSegments)
+        if cls not in _templates:
+            return createChildStore(rootStore, pathSegments)
+
+        templatePath = _getTemplate(rootStore, cls)
+        fixup = _templates[cls].fixup
+        return cloneChildStore(rootStore, pathSegments, templatePath, fixup)
+
+
+    @classmethod
+    def createChildStores(cls, rootStore, allPathSegments, **kwargs):
+        """
+        Creates many child stores under the root store at once, with the
+        given path segments. Takes the same keyword arguments as
+        ``createChildStores``.
+
+        If a template was registered for this type, the child stores are
+        copies of the template store.
+        """
+        allPathSegments = ([cls.typeName] + list(pathSegments)
+                           for pathSegments in allPathSegments)
+        if cls in _templates:
+            kwargs["templatePath"] = _getTemplate(rootStore, cls)
+            kwargs["fixup"] = _templates[cls].fixup
+        return createChildStores(rootStore, allPathSegments, **kwargs)
+
+
+    @classmethod
+    def fanOut(cls, rootStore, query, **kwargs):
+        """
+        Runs a query on every child store of this type under the root store.
+        Takes the same keyword arguments as ``fanOut``, and yields the same
+        pairs, with path segments that don't include the type name.
+        """
+        prefix = [cls.typeName] + list(kwargs.pop("prefix", ()))
+        for pathSegments, result in fanOut(rootStore, query, prefix=prefix,
+                                           **kwargs):
+            yield pathSegments[1:], result
 
 
     @classmethod
@@ -48,11 +627,27 @@ class ChildMixin(object):
         return getChildStore(rootStore, pathSegments)
 
 
+    @classmethod
+    def holdChildStore(cls, rootStore, pathSegments):
+        """
+        Gets a child store under the root store with these path segments,
+        and keeps it open until the returned handle is released.
+
+        :rtype: ``ChildStoreHandle``
+        """
+        pathSegments = [cls.typeName] + list(pathSegments)
+        return holdChildStore(rootStore, pathSegments)
+
+
     @classmethod
     def findUniqueChild(cls, rootStore, pathSegments):
         """
         Finds a unique instance of ``cls`` in a child store of ``rootStore``
         with the given path segments.
+
+        The child store can be closed once it is evicted from its pool, so
+        callers that keep using the item should hold its store with
+        ``holdChildStore`` meanwhile.
         """
         childStore = cls.getChildStore(rootStore, pathSegments)
         return childStore.findUnique(cls)
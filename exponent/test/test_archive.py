@@ -0,0 +1,357 @@
+"""
+Tests for archiving stores to long-term object storage.
+"""
+import json
+import os
+import tarfile
+
+from axiom import attributes, item, store
+from contextlib import closing
+from exponent import archive, directory, exceptions, storage
+from StringIO import StringIO
+from twisted.internet import defer
+from twisted.trial import unittest
+
+
+class DirectoryObjectStoreTests(unittest.TestCase):
+    def setUp(self):
+        path = store.Store(self.mktemp()).filesdir
+        self.objectStore = archive.DirectoryObjectStore(path)
+
+
+    def test_interface(self):
+        """
+        The directory object store provides ``IObjectStore``.
+        """
+        self.assertTrue(archive.IObjectStore.providedBy(self.objectStore))
+
+
+    def test_putAndGet(self):
+        """
+        Stored objects can be retrieved, and replaced.
+        """
+        self.objectStore.put("a/b", "xyzzy")
+        self.assertTrue(self.objectStore.exists("a/b"))
+        self.assertEqual(self.objectStore.get("a/b"), "xyzzy")
+
+        self.objectStore.put("a/b", "plugh")
+        self.assertEqual(self.objectStore.get("a/b"), "plugh")
+
+
+    def test_getMissing(self):
+        """
+        Getting an object that doesn't exist raises ``KeyError``.
+        """
+        self.assertFalse(self.objectStore.exists("a/b"))
+        self.assertRaises(KeyError, self.objectStore.get, "a/b")
+
+
+    def test_listAndDelete(self):
+        """
+        Objects under a prefix can be listed and deleted.
+        """
+        self.assertEqual(self.objectStore.list("a"), [])
+        self.objectStore.put("a/b", "")
+        self.objectStore.put("a/c", "")
+        self.assertEqual(sorted(self.objectStore.list("a")), ["a/b", "a/c"])
+
+        self.objectStore.delete("a/b")
+        self.objectStore.delete("a/b")
+        self.assertEqual(self.objectStore.list("a"), ["a/c"])
+
+
+
+class PackTests(unittest.TestCase):
+    def setUp(self):
+        rootStore = store.Store(self.mktemp())
+        self.objectStore = archive.DirectoryObjectStore(rootStore.filesdir)
+
+        self.storePath = rootStore.newDirectory("original")
+        originalStore = store.Store(self.storePath)
+        _Thing(store=originalStore, value=u"xyzzy" * 1000)
+        originalStore.newFilePath("picture").setContent("\x00" * 10000)
+        originalStore.close()
+
+        self.restoredPath = rootStore.filesdir.child("restored")
+
+
+    def _pack(self):
+        return archive.pack(self.storePath, self.objectStore, "key", 1024)
+
+
+    def test_roundTrip(self):
+        """
+        A packed store is split into several chunks, and can be unpacked
+        again, including its files.
+        """
+        manifest = self._pack()
+        self.assertTrue(len(manifest["chunks"]) > 1)
+
+        archive.unpack(self.objectStore, "key", self.restoredPath)
+        restoredStore = store.Store(self.restoredPath)
+        self.assertEqual(restoredStore.findUnique(_Thing).value, u"xyzzy" * 1000)
+        picture = restoredStore.filesdir.child("picture")
+        self.assertEqual(picture.getContent(), "\x00" * 10000)
+
+
+    def test_fencingTokens(self):
+        """
+        The fencing token is recorded in the manifest. A store can't be
+        packed with an older token than the current archive's, but it can
+        with the same or a newer one, or without one.
+        """
+        def pack(token=None):
+            return archive.pack(self.storePath, self.objectStore, "key",
+                                token=token)
+
+        self.assertEqual(pack(2)["token"], 2)
+        self.assertEqual(pack(2)["token"], 2)
+        self.assertRaises(archive.StaleTokenException, pack, 1)
+        self.assertEqual(pack()["token"], 2)
+        self.assertEqual(pack(3)["token"], 3)
+
+
+    def test_packKeepsChunks(self):
+        """
+        Packing doesn't delete chunks, since readers of the previous archive
+        may still need them.
+        """
+        self._pack()
+        self.objectStore.put("key/chunks/stale", "")
+        self._pack()
+        self.assertTrue(self.objectStore.exists("key/chunks/stale"))
+
+
+    def test_collectGarbage(self):
+        """
+        Garbage collection removes the chunks that are used by neither the
+        current nor the previous archive of a store.
+        """
+        self._pack()
+        self.objectStore.put("key/chunks/stale", "")
+        extra = self.storePath.child("files").child("extra")
+        extra.setContent("plugh")
+        previous = self._pack()
+        extra.setContent("xyzzy")
+        current = self._pack()
+
+        self.assertTrue(archive.collectGarbage(self.objectStore, "key") > 0)
+        names = set(self.objectStore.list("key/chunks"))
+        self.assertEqual(names, set("key/chunks/" + checksum
+                                    for checksum, _
+                                    in previous["chunks"] + current["chunks"]))
+
+        archive.unpack(self.objectStore, "key", self.restoredPath)
+        restoredExtra = self.restoredPath.child("files").child("extra")
+        self.assertEqual(restoredExtra.getContent(), "xyzzy")
+
+
+    def test_differential(self):
+        """
+        Packing a store again only stores the chunks that changed.
+        """
+        first = self._pack()
+        self.assertTrue(first["uploaded"] > 0)
+
+        unchanged = self._pack()
+        self.assertEqual(unchanged["uploaded"], 0)
+        self.assertEqual(unchanged["chunks"], first["chunks"])
+
+        self.storePath.child("files").child("extra").setContent("plugh")
+        changed = self._pack()
+        self.assertTrue(0 < changed["uploaded"] < first["uploaded"])
+
+        archive.unpack(self.objectStore, "key", self.restoredPath)
+        extra = self.restoredPath.child("files").child("extra")
+        self.assertEqual(extra.getContent(), "plugh")
+
+
+    def test_unpackMissing(self):
+        """
+        Unpacking a store that was never packed fails.
+        """
+        self.assertRaises(exceptions.NoSuchStoreException, archive.unpack,
+                          self.objectStore, "key", self.restoredPath)
+
+
+    def test_unpackCorrupt(self):
+        """
+        Unpacking a store with a damaged chunk fails, and leaves nothing
+        behind.
+        """
+        manifest = self._pack()
+        checksum, _ = manifest["chunks"][-1]
+        self.objectStore.put("key/chunks/" + checksum, "BOGUS")
+
+        self.assertRaises(archive.CorruptArchiveException, archive.unpack,
+                          self.objectStore, "key", self.restoredPath)
+        self.assertFalse(self.restoredPath.exists())
+        self.assertEqual(self.restoredPath.parent().globChildren("*restored*"),
+                         [])
+
+
+    def test_unpackUnsafe(self):
+        """
+        Archives with members outside of the store are not unpacked.
+        """
+        writer = archive._ChunkWriter(self.objectStore, "key", 1024)
+        with closing(tarfile.open(fileobj=writer, mode="w|")) as tar:
+            member = tarfile.TarInfo("../escaped")
+            tar.addfile(member, StringIO(""))
+        writer.flush()
+        manifest = {"format": 1, "chunks": writer.chunks}
+        self.objectStore.put("key/manifest", json.dumps(manifest))
+
+        self.assertRaises(archive.CorruptArchiveException, archive.unpack,
+                          self.objectStore, "key", self.restoredPath)
+        self.assertFalse(self.restoredPath.parent().child("escaped").exists())
+
+
+
+class ChunkWriterTests(unittest.TestCase):
+    def setUp(self):
+        path = store.Store(self.mktemp()).filesdir
+        self.objectStore = archive.DirectoryObjectStore(path)
+
+
+    def _chunk(self, data):
+        """
+        Chunks the data and returns the chunk checksums.
+        """
+        writer = archive._ChunkWriter(self.objectStore, "key", 4096)
+        for start in range(0, len(data), 1000):
+            writer.write(data[start:start + 1000])
+        writer.flush()
+        self.assertEqual(sum(size for _, size in writer.chunks), len(data))
+        return [checksum for checksum, _ in writer.chunks]
+
+
+    def test_chunkSizes(self):
+        """
+        Chunks are between a quarter and four times the average chunk size,
+        except for the last one.
+        """
+        writer = archive._ChunkWriter(self.objectStore, "key", 4096)
+        writer.write(os.urandom(512 * 1024))
+        writer.flush()
+        sizes = [size for _, size in writer.chunks]
+        for size in sizes[:-1]:
+            self.assertTrue(1024 <= size <= 4 * 4096)
+            self.assertEqual(size % tarfile.BLOCKSIZE, 0)
+
+
+    def test_contentDefined(self):
+        """
+        Inserting blocks in the middle of the data only changes the chunks
+        around the insertion.
+        """
+        data = os.urandom(256 * 1024)
+        inserted = data[:100 * 1024] + os.urandom(1024) + data[100 * 1024:]
+
+        before, after = self._chunk(data), self._chunk(inserted)
+        self.assertTrue(len(set(before) & set(after)) >= len(before) - 3)
+
+
+    def test_knownChunksNotStored(self):
+        """
+        Known chunks are not stored.
+        """
+        data = os.urandom(64 * 1024)
+        checksums = self._chunk(data)
+
+        writer = archive._ChunkWriter(self.objectStore, "other", 4096,
+                                      frozenset(checksums))
+        writer.write(data)
+        writer.flush()
+        self.assertEqual(writer.uploaded, 0)
+        self.assertEqual(self.objectStore.list("other/chunks"), [])
+
+
+
+class DirectoryArchiveTests(unittest.TestCase):
+    def setUp(self):
+        self.rootStore = store.Store(self.mktemp())
+        self.archive = archive.DirectoryArchive(
+            store=self.rootStore,
+            path=self.rootStore.newDirectory("archive"))
+        self.rootStore.powerUp(self.archive, archive.IStoreArchive)
+
+        userStore = store.Store(self.rootStore.filesdir.child("xyzzy"))
+        _Thing(store=userStore, value=u"xyzzy")
+        userStore.close()
+
+        self.directory = directory.LocalWriteLockDirectory(store=self.rootStore)
+        self.storage = storage.FakeStorage(store=self.rootStore)
+
+
+    def test_interface(self):
+        """
+        The directory archive provides ``IStoreArchive``.
+        """
+        self.assertTrue(archive.IStoreArchive.providedBy(self.archive))
+
+
+    def test_writeAndFetch(self):
+        """
+        Writing with a write lock archives the store. Once archived, the
+        store is fetched when it isn't available locally.
+        """
+        d = self.directory.acquire(["xyzzy"])
+
+        @d.addCallback
+        def write(lock):
+            lock.store.close()
+            return lock.write().addCallback(lambda _: lock.release())
+
+        @d.addCallback
+        def removeLocalCopy(_):
+            self.rootStore.filesdir.child("xyzzy").remove()
+            return self.storage.get(["xyzzy"])
+
+        @d.addCallback
+        def checkFetched(fetchedStore):
+            self.assertEqual(fetchedStore.findUnique(_Thing).value, u"xyzzy")
+
+        return d
+
+
+    def test_pushesSerialized(self):
+        """
+        Pushes of the same store are done one at a time. Pushes of other
+        stores aren't held up.
+        """
+        calls = []
+
+        def deferToThread(f, *a):
+            calls.append(defer.Deferred())
+            return calls[-1]
+
+        self.patch(archive.threads, "deferToThread", deferToThread)
+        storePath = self.rootStore.filesdir.child("xyzzy")
+        first = self.archive.push(["xyzzy"], storePath)
+        second = self.archive.push(["xyzzy"], storePath)
+        self.archive.push(["other"], storePath)
+        self.assertEqual(len(calls), 2)
+
+        calls[0].callback(None)
+        self.successResultOf(first)
+        self.assertEqual(len(calls), 3)
+        self.assertNoResult(second)
+
+        calls[2].callback(None)
+        self.successResultOf(second)
+        calls[1].callback(None)
+        self.assertEqual(self.archive._locks, {})
+
+
+    def test_missing(self):
+        """
+        Stores that are neither local nor archived don't exist.
+        """
+        d = self.storage.get(["BOGUS"])
+        return self.assertFailure(d, exceptions.NoSuchStoreException)
+
+
+
+class _Thing(item.Item):
+    value = attributes.text()
@@ -0,0 +1,55 @@
+from exponent import benchmark
+from twisted.python import filepath
+from twisted.trial import unittest
+
+
+class SummarizeTests(unittest.TestCase):
+    def test_empty(self):
+        """
+        An empty list of samples is summarized as having no samples.
+        """
+        self.assertEqual(benchmark.summarize([]), {"count": 0})
+
+
+    def test_summarize(self):
+        """
+        Samples are summarized with their count, extremes, median, 99th
+        percentile and mean.
+        """
+        summary = benchmark.summarize([float(i) for i in xrange(100, 0, -1)])
+        self.assertEqual(summary, {
+            "count": 100,
+            "min": 1.0,
+            "median": 51.0,
+            "p99": 100.0,
+            "max": 100.0,
+            "mean": 50.5,
+        })
+
+
+
+class RunBenchmarksTests(unittest.TestCase):
+    def test_run(self):
+        """
+        Running the benchmarks against a small synthetic root store produces
+        results for every benchmark.
+        """
+        config = benchmark.Options()
+        config.parseOptions(["--stores", "3", "--store-size", "8192",
+                             "--requests", "10", "--concurrency", "2"])
+        path = filepath.FilePath(self.mktemp())
+        d = benchmark.runBenchmarks(config, path)
+
+        @d.addCallback
+        def checkResults(results):
+            self.assertEqual(results["parameters"]["stores"], 3)
+            self.assertEqual(results["open"]["count"], 3)
+
+            cache = results["cache"]
+            self.assertEqual(cache["hits"] + cache["misses"], 10)
+            self.assertEqual(results["locks"]["latency"]["count"], 10)
+
+            for name in ["initial", "unchanged"]:
+                self.assertTrue(results["write"][name]["bytes"] > 0)
+
+        return d
@@ -1,16 +1,115 @@
 """
 Tests for write locks and write lock directories.
 """
-from axiom import store
-from exponent import directory, exceptions
+from axiom import attributes, errors, item, store
+from exponent import directory, exceptions, metrics
+from twisted.internet import defer, task
+from twisted.protocols import amp
+from twisted.test import iosim
 from twisted.trial import unittest
 
 
+class LockTableTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.table = directory._LockTable(self.clock)
+
+
+    def test_acquireFree(self):
+        """
+        Acquiring a lock that isn't held succeeds immediately, with ``None``.
+        """
+        self.assertIdentical(self.successResultOf(self.table.acquire("a")),
+                             None)
+        self.assertTrue(self.table.isHeld("a"))
+        self.assertFalse(self.table.isHeld("b"))
+
+
+    def test_releaseFree(self):
+        """
+        Releasing a lock without waiters makes it free again.
+        """
+        self.table.acquire("a")
+        self.table.release("a")
+        self.assertFalse(self.table.isHeld("a"))
+
+
+    def test_fifo(self):
+        """
+        Waiters get the lock in the order they asked for it, with the value
+        the lock was released with.
+        """
+        self.table.acquire("a")
+        first, second = self.table.acquire("a"), self.table.acquire("a")
+        self.assertEqual(self.table.waiting("a"), 2)
+        self.assertNoResult(first)
+        self.assertNoResult(second)
+
+        self.table.release("a", 1)
+        self.assertEqual(self.successResultOf(first), 1)
+        self.assertNoResult(second)
+
+        self.table.release("a", 2)
+        self.assertEqual(self.successResultOf(second), 2)
+        self.assertTrue(self.table.isHeld("a"))
+
+
+    def test_timeout(self):
+        """
+        A waiter that doesn't get the lock within its timeout fails with
+        ``AlreadyAcquiredException``, and leaves the queue.
+        """
+        self.table.acquire("a")
+        d = self.table.acquire("a", timeout=5)
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(d).trap(directory.AlreadyAcquiredException)
+        self.assertEqual(self.table.waiting("a"), 0)
+
+
+    def test_noWait(self):
+        """
+        A zero timeout fails immediately if the lock is held.
+        """
+        self.table.acquire("a")
+        d = self.table.acquire("a", timeout=0)
+        self.failureResultOf(d).trap(directory.AlreadyAcquiredException)
+
+
+    def test_acquiredBeforeTimeout(self):
+        """
+        A waiter that gets the lock before its timeout doesn't time out.
+        """
+        self.table.acquire("a")
+        d = self.table.acquire("a", timeout=5)
+        self.table.release("a")
+        self.successResultOf(d)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_cancel(self):
+        """
+        Cancelling a waiter removes it from the queue.
+        """
+        self.table.acquire("a")
+        cancelled, waiting = self.table.acquire("a"), self.table.acquire("a")
+        cancelled.cancel()
+        self.failureResultOf(cancelled).trap(defer.CancelledError)
+
+        self.table.release("a", 1)
+        self.assertEqual(self.successResultOf(waiting), 1)
+
+
+
 class LocalWriteLockTests(unittest.TestCase):
     def setUp(self):
         rootStore = store.Store(self.mktemp())
         store.Store(rootStore.filesdir.child("xyzzy"))
         self.directory = directory.LocalWriteLockDirectory(store=rootStore)
+        self.clock = task.Clock()
+        self.directory._locks = directory._LockTable(self.clock)
+        self.directory.metrics = metrics.LockMetrics(self.clock)
 
 
     def test_implementsDirectoryInterface(self):
@@ -57,3 +156,384 @@ class LocalWriteLockTests(unittest.TestCase):
         """
         d = self.directory.acquire(["DOES", "NOT", "EXIST"])
         self.failureResultOf(d).trap(exceptions.NoSuchStoreException)
+
+
+    def test_exclusive(self):
+        """
+        A lock that is held can't be acquired again until it is released;
+        the next holder gets the same store.
+        """
+        lock = self.successResultOf(self.directory.acquire(["xyzzy"]))
+        d = self.directory.acquire(["xyzzy"])
+        self.assertNoResult(d)
+
+        lock.release()
+        nextLock = self.successResultOf(d)
+        self.assertIdentical(nextLock.store, lock.store)
+        self.assertFalse(nextLock.released)
+
+
+    def test_acquireTimeout(self):
+        """
+        Acquiring a lock that stays held fails with
+        ``AlreadyAcquiredException`` after the timeout.
+        """
+        self.directory.acquire(["xyzzy"])
+        d = self.directory.acquire(["xyzzy"], timeout=10)
+        self.clock.advance(10)
+        self.failureResultOf(d).trap(directory.AlreadyAcquiredException)
+
+
+    def test_metrics(self):
+        """
+        Wait times, hold times, timeouts and contention are recorded.
+        """
+        lockMetrics = self.directory.metrics
+        lock = self.successResultOf(self.directory.acquire(["xyzzy"]))
+        waiting = self.directory.acquire(["xyzzy"])
+        timingOut = self.directory.acquire(["xyzzy"], timeout=1)
+        self.assertEqual(self.directory._locks.totalWaiting(), 2)
+
+        self.clock.advance(1)
+        self.failureResultOf(timingOut)
+        self.clock.advance(1)
+        lock.release()
+        self.successResultOf(waiting)
+
+        self.assertEqual(lockMetrics.acquisitions, 2)
+        self.assertEqual(lockMetrics.timeouts, 1)
+        self.assertEqual(lockMetrics.waitTimes.total, 2)
+        self.assertEqual(lockMetrics.holdTimes.total, 2)
+        self.assertEqual(lockMetrics.topContended(), [("xyzzy", 2)])
+        self.assertEqual(lockMetrics.queueLengths.total, 1)
+
+
+    def test_metricsCommand(self):
+        """
+        The metrics can be queried over AMP.
+        """
+        self.directory.acquire(["xyzzy"])
+        self.directory.acquire(["xyzzy"])
+
+        locator = directory.LockMetricsLocator(self.directory.store)
+        client, _, pump = iosim.connectedServerAndClient(
+            lambda: amp.AMP(locator=locator), amp.AMP)
+        d = client.callRemote(directory.GetLockMetrics, top=5)
+        pump.flush()
+        response = self.successResultOf(d)
+
+        self.assertEqual(response["acquisitions"], 1)
+        self.assertEqual(response["waiting"], 1)
+        self.assertEqual(response["contended"],
+                         [{"path": "xyzzy", "count": 1}])
+        self.assertEqual(sum(b["count"] for b in response["waitTimes"]), 1)
+        self.assertEqual(response["waitTimes"][-1]["upperBound"],
+                         float("inf"))
+        self.assertIn("acquisitions: 1\n", response["report"])
+
+
+    def test_doesNotExistReleases(self):
+        """
+        When a store can't be opened, the lock on it is released, so that
+        waiters can try again.
+        """
+        d = self.directory.acquire(["DOES", "NOT", "EXIST"])
+        self.failureResultOf(d).trap(exceptions.NoSuchStoreException)
+        self.assertFalse(self.directory._locks.isHeld(
+            self.directory.store.filesdir.descendant(["DOES", "NOT", "EXIST"])))
+
+
+
+class _FakeDirectory(object):
+    """
+    A lock directory whose acquisitions only complete when told to.
+    """
+    def __init__(self):
+        self.pending = []
+
+
+    def acquire(self, pathSegments):
+        d = defer.Deferred()
+        self.pending.append((pathSegments, d))
+        return d
+
+
+
+class AcquireManyTests(unittest.TestCase):
+    def setUp(self):
+        self.ticks = []
+        self.cooperator = task.Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self.ticks.append)
+        self.directory = _FakeDirectory()
+        self.acquired = []
+
+
+    def _acquireMany(self, allPathSegments, onAcquired=None, concurrency=2):
+        if onAcquired is None:
+            onAcquired = lambda pathSegments, lock: \
+                self.acquired.append((pathSegments, lock))
+        return directory.acquireMany(self.directory, allPathSegments,
+                                     onAcquired, concurrency,
+                                     cooperator=self.cooperator)
+
+
+    def _tick(self):
+        while self.ticks:
+            self.ticks.pop(0)()
+
+
+    def test_concurrency(self):
+        """
+        No more than the given number of acquisitions are in progress at the
+        same time; locks are passed on as they are granted.
+        """
+        d = self._acquireMany(iter([["a"], ["b"], ["c"]]))
+        self._tick()
+        self.assertEqual([p for p, _ in self.directory.pending],
+                         [["a"], ["b"]])
+
+        self.directory.pending[1][1].callback("lockB")
+        self._tick()
+        self.assertEqual(self.acquired, [(["b"], "lockB")])
+        self.assertEqual(len(self.directory.pending), 3)
+
+        self.directory.pending[0][1].callback("lockA")
+        self.directory.pending[2][1].callback("lockC")
+        self._tick()
+
+        result = self.successResultOf(d)
+        self.assertEqual(result.acquired, 3)
+        self.assertEqual(result.failed, [])
+
+
+    def test_partialFailure(self):
+        """
+        Stores that can't be locked are reported, without stopping the
+        other acquisitions.
+        """
+        d = self._acquireMany([["a"], ["b"]])
+        self._tick()
+        self.directory.pending[0][1].errback(_TestError())
+        self.directory.pending[1][1].callback("lockB")
+        self._tick()
+
+        result = self.successResultOf(d)
+        self.assertEqual(result.acquired, 1)
+        [(pathSegments, failure)] = result.failed
+        self.assertEqual(pathSegments, ["a"])
+        failure.trap(_TestError)
+
+
+    def test_waitsForHandler(self):
+        """
+        When the handler returns a deferred, its slot isn't reused until that
+        deferred fires. Failures of the handler are reported.
+        """
+        handled = []
+
+        def onAcquired(pathSegments, lock):
+            d = defer.Deferred()
+            handled.append(d)
+            return d
+
+        d = self._acquireMany([["a"], ["b"]], onAcquired, concurrency=1)
+        self._tick()
+        lockA = directory.LocalWriteLock(None)
+        self.directory.pending[0][1].callback(lockA)
+        self._tick()
+        self.assertEqual(len(self.directory.pending), 1)
+
+        handled[0].errback(_TestError())
+        self.assertTrue(lockA.released)
+        self._tick()
+        self.directory.pending[1][1].callback("lockB")
+        handled[1].callback(None)
+        self._tick()
+
+        result = self.successResultOf(d)
+        self.assertEqual(result.acquired, 1)
+        self.assertEqual([p for p, _ in result.failed], [["a"]])
+
+
+    def test_localDirectory(self):
+        """
+        Locks can be acquired from a local write lock directory in bulk.
+        """
+        rootStore = store.Store(self.mktemp())
+        for name in ["a", "b"]:
+            store.Store(rootStore.filesdir.child(name))
+        self.directory = directory.LocalWriteLockDirectory(store=rootStore)
+
+        d = self._acquireMany([["a"], ["b"], ["c"]])
+        self._tick()
+
+        result = self.successResultOf(d)
+        self.assertEqual(result.acquired, 2)
+        self.assertEqual(sorted(p for p, _ in self.acquired), [["a"], ["b"]])
+        [(pathSegments, failure)] = result.failed
+        failure.trap(exceptions.NoSuchStoreException)
+
+
+    def test_failedHandlerReleases(self):
+        """
+        When the handler fails, the lock is released, so that the store can
+        be locked again. Locks the handler released itself are fine.
+        """
+        rootStore = store.Store(self.mktemp())
+        for name in ["a", "b"]:
+            store.Store(rootStore.filesdir.child(name))
+        self.directory = directory.LocalWriteLockDirectory(store=rootStore)
+
+        def onAcquired(pathSegments, lock):
+            if pathSegments == ["b"]:
+                lock.release()
+            raise _TestError()
+
+        d = self._acquireMany([["a"], ["b"]], onAcquired)
+        self._tick()
+
+        result = self.successResultOf(d)
+        self.assertEqual(result.acquired, 0)
+        self.assertEqual(len(result.failed), 2)
+        for pathSegments, failure in result.failed:
+            failure.trap(_TestError)
+            lock = self.successResultOf(
+                self.directory.acquire(pathSegments, timeout=1))
+            lock.release()
+
+
+
+class _TestError(Exception):
+    """
+    An exception raised in tests.
+    """
+
+
+
+class _Thing(item.Item):
+    """
+    An item in a store that is read while it is written.
+    """
+    value = attributes.integer()
+
+
+
+class _Other(item.Item):
+    """
+    An item of a type that a store has no table for.
+    """
+    value = attributes.integer()
+
+
+
+class ReadLockTests(unittest.TestCase):
+    def setUp(self):
+        rootStore = store.Store(self.mktemp())
+        userStore = store.Store(rootStore.filesdir.child("xyzzy"))
+        _Thing(store=userStore, value=1)
+        userStore.close()
+        self.directory = directory.LocalWriteLockDirectory(store=rootStore)
+
+
+    def test_implementsInterfaces(self):
+        """
+        The local directory is a read lock directory, and its read locks
+        provide ``IReadLock``.
+        """
+        IRLD = directory.IReadLockDirectory
+        self.assertTrue(IRLD.providedBy(self.directory))
+        self.assertTrue(directory.IReadLock.implementedBy(
+            directory.LocalReadLock))
+
+
+    def test_readOnly(self):
+        """
+        Read locks give read-only stores.
+        """
+        lock = self.successResultOf(self.directory.acquireShared(["xyzzy"]))
+        self.assertEqual(lock.store.findUnique(_Thing).value, 1)
+        self.assertRaises(errors.SQLError,
+                          lock.store.transact, _Thing, store=lock.store)
+
+
+    def test_missingTable(self):
+        """
+        Item types the store has no table for yet can be queried, and have
+        no items. Creating them still fails, and the store isn't given a
+        table for them.
+        """
+        lock = self.successResultOf(self.directory.acquireShared(["xyzzy"]))
+        self.assertEqual(list(lock.store.query(_Other)), [])
+        self.assertRaises(errors.SQLError,
+                          lock.store.transact, _Other, store=lock.store)
+        self.assertEqual(lock.store.query(_Other).count(), 0)
+
+        tables = lock.store.querySQL(
+            "SELECT name FROM main.sqlite_master WHERE name LIKE ?",
+            ["%" + _Other.typeName + "%"])
+        self.assertEqual(tables, [])
+
+
+    def test_shared(self):
+        """
+        Many read locks can be held at once, each with its own handle.
+        """
+        first = self.successResultOf(self.directory.acquireShared(["xyzzy"]))
+        second = self.successResultOf(self.directory.acquireShared(["xyzzy"]))
+        self.assertNotIdentical(first.store, second.store)
+
+
+    def test_alongsideWriter(self):
+        """
+        Read locks can be acquired while a write lock is held. Items loaded
+        through a read lock aren't updated by later writes, but read locks
+        acquired afterwards see the writer's committed changes.
+        """
+        writeLock = self.successResultOf(self.directory.acquire(["xyzzy"]))
+        readLock = self.successResultOf(
+            self.directory.acquireShared(["xyzzy"]))
+        loaded = readLock.store.findUnique(_Thing)
+        self.assertEqual(loaded.value, 1)
+
+        thing = writeLock.store.findUnique(_Thing)
+        writeLock.store.transact(setattr, thing, "value", 2)
+        self.assertEqual(readLock.store.findUnique(_Thing).value, 1)
+
+        newReadLock = self.successResultOf(
+            self.directory.acquireShared(["xyzzy"]))
+        self.assertEqual(newReadLock.store.findUnique(_Thing).value, 2)
+
+
+    def test_release(self):
+        """
+        A read lock's store is closed when it is released, and only then.
+        """
+        first = self.successResultOf(self.directory.acquireShared(["xyzzy"]))
+        second = self.successResultOf(self.directory.acquireShared(["xyzzy"]))
+        closed = []
+        self.patch(first.store, "close", lambda: closed.append(first))
+        self.patch(second.store, "close", lambda: closed.append(second))
+
+        self.successResultOf(first.release())
+        self.assertEqual(closed, [first])
+        self.successResultOf(second.release())
+        self.assertEqual(closed, [first, second])
+
+
+    def test_multipleRelease(self):
+        """
+        Releasing the same read lock twice fails.
+        """
+        lock = self.successResultOf(self.directory.acquireShared(["xyzzy"]))
+        lock.release()
+        self.failureResultOf(lock.release()).trap(
+            directory.AlreadyReleasedException)
+
+
+    def test_doesNotExist(self):
+        """
+        Read locks on stores that don't exist can't be acquired.
+        """
+        d = self.directory.acquireShared(["DOES", "NOT", "EXIST"])
+        self.failureResultOf(d).trap(exceptions.NoSuchStoreException)
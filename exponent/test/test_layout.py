@@ -0,0 +1,210 @@
+"""
+Tests for on-disk store layouts.
+"""
+import os
+
+from axiom import store
+from exponent import directory, layout, storage, substore
+from twisted.trial import unittest
+
+
+class FlatLayoutTests(unittest.TestCase):
+    def test_default(self):
+        """
+        Without an ``IPathLayout`` powerup, stores are laid out flat.
+        """
+        rootStore = store.Store(self.mktemp())
+        self.assertIdentical(layout.getLayout(rootStore), layout.flatLayout)
+        storePath = layout.storePathFor(rootStore, ["a", "b"])
+        self.assertEqual(storePath, rootStore.filesdir.child("a").child("b"))
+
+
+    def test_segments(self):
+        """
+        The flat layout uses path segments as on-disk path segments.
+        """
+        self.assertEqual(layout.flatLayout.segmentsFor(("a", "b")), ["a", "b"])
+        self.assertEqual(layout.flatLayout.pathSegmentsFor(["a"]), ["a"])
+
+
+
+class HashPrefixLayoutTests(unittest.TestCase):
+    def setUp(self):
+        self.rootStore = store.Store(self.mktemp())
+        self.layout = layout.HashPrefixLayout(store=self.rootStore)
+        self.rootStore.powerUp(self.layout, layout.IPathLayout)
+
+
+    def test_interface(self):
+        """
+        The hash prefix layout is an ``IPathLayout``, and is used as the root
+        store's layout once powered up.
+        """
+        self.assertTrue(layout.IPathLayout.providedBy(self.layout))
+        self.assertIdentical(layout.getLayout(self.rootStore), self.layout)
+
+
+    def test_segments(self):
+        """
+        Stores are put in nested fan-out directories named after the hash of
+        their path segments, and their path segments can be recovered from
+        that.
+        """
+        diskSegments = self.layout.segmentsFor(["users", "alice"])
+        self.assertEqual(diskSegments, ["users", "dc", "db", "alice"])
+        pathSegments = self.layout.pathSegmentsFor(diskSegments)
+        self.assertEqual(pathSegments, ["users", "alice"])
+
+
+    def test_levelsAndWidth(self):
+        """
+        The number of fan-out directories and the length of their names are
+        configurable.
+        """
+        self.layout.levels, self.layout.width = 1, 3
+        diskSegments = self.layout.segmentsFor(["alice"])
+        self.assertEqual(diskSegments, ["522", "alice"])
+        self.assertEqual(self.layout.pathSegmentsFor(diskSegments), ["alice"])
+
+
+    def test_storageAndDirectory(self):
+        """
+        Long-term storage and lock directories find stores in the layout.
+        """
+        storePath = layout.storePathFor(self.rootStore, ["users", "alice"])
+        store.Store(storePath)
+
+        fakeStorage = storage.FakeStorage(store=self.rootStore)
+        gotStore = self.successResultOf(fakeStorage.get(["users", "alice"]))
+        self.assertEqual(gotStore.dbdir, storePath)
+
+        lockDirectory = directory.LocalWriteLockDirectory(store=self.rootStore)
+        lock = self.successResultOf(lockDirectory.acquire(["users", "alice"]))
+        self.assertEqual(lock.store.dbdir, storePath)
+
+
+    def test_childStores(self):
+        """
+        Child stores are created and found in the layout.
+        """
+        created = substore.createChildStore(self.rootStore, ["users", "alice"])
+        retrieved = substore.getChildStore(self.rootStore, ["users", "alice"])
+        storePath = layout.storePathFor(self.rootStore, ["users", "alice"])
+        self.assertEqual(created.dbdir, storePath)
+        self.assertEqual(retrieved.dbdir, storePath)
+
+
+
+class MigrateTests(unittest.TestCase):
+    def setUp(self):
+        self.rootStore = store.Store(self.mktemp())
+        store.Store(self.rootStore.filesdir.child("xyzzy"))
+        substore.createChildStore(self.rootStore, ["users", "alice"])
+        substore.createChildStore(self.rootStore, ["users", "bob"])
+
+
+    def _assertStoresFound(self):
+        """
+        Asserts that all of the test stores can be found.
+        """
+        fakeStorage = storage.FakeStorage(store=self.rootStore)
+        self.successResultOf(fakeStorage.get(["xyzzy"]))
+        for name in ["alice", "bob"]:
+            childStore = substore.getChildStore(self.rootStore, ["users", name])
+            self.assertTrue(childStore.dbdir.child("db.sqlite").exists())
+
+
+    def test_migrate(self):
+        """
+        Stores can be migrated to a new layout and back.
+        """
+        hashLayout = layout.HashPrefixLayout(store=self.rootStore)
+        self.assertEqual(layout.migrate(self.rootStore, hashLayout), 3)
+        self.assertIdentical(layout.getLayout(self.rootStore), hashLayout)
+        self.assertEqual(sorted(self.rootStore.filesdir.child("users").listdir()),
+                         sorted(set(hashLayout.segmentsFor(["users", name])[1]
+                                    for name in ["alice", "bob"])))
+        self._assertStoresFound()
+
+        self.assertEqual(layout.migrate(self.rootStore, layout.flatLayout), 3)
+        self.assertIdentical(layout.getLayout(self.rootStore), layout.flatLayout)
+        self.assertEqual(sorted(self.rootStore.filesdir.child("users").listdir()),
+                         ["alice", "bob"])
+        self._assertStoresFound()
+
+
+    def test_migrateToSameLayout(self):
+        """
+        Migrating to the current layout doesn't move anything.
+        """
+        self.assertEqual(layout.migrate(self.rootStore, layout.flatLayout), 0)
+        self._assertStoresFound()
+
+
+    def _interruptedMigration(self, newLayout):
+        """
+        Starts migrating to a new layout, but crashes while moving the
+        second store, after it has been recorded as moved.
+        """
+        rename = os.rename
+        renames = []
+
+        def crashingRename(source, destination):
+            renames.append(source)
+            if len(renames) == 2:
+                raise OSError("crashed")
+            rename(source, destination)
+
+        self.patch(os, "rename", crashingRename)
+        self.assertRaises(OSError, layout.migrate, self.rootStore, newLayout)
+        self.patch(os, "rename", rename)
+
+
+    def test_resumeInterruptedMigration(self):
+        """
+        Migrating again after a migration was interrupted moves the stores
+        that weren't moved yet, and leaves the others where they are.
+        """
+        hashLayout = layout.HashPrefixLayout(store=self.rootStore)
+        self._interruptedMigration(hashLayout)
+        self.assertIdentical(layout.getLayout(self.rootStore),
+                             layout.flatLayout)
+
+        self.assertEqual(layout.migrate(self.rootStore, hashLayout), 2)
+        self.assertIdentical(layout.getLayout(self.rootStore), hashLayout)
+        self.assertEqual(
+            sorted(self.rootStore.filesdir.child("users").listdir()),
+            sorted(set(hashLayout.segmentsFor(["users", name])[1]
+                       for name in ["alice", "bob"])))
+        self._assertStoresFound()
+
+        self.assertEqual(layout.migrate(self.rootStore, layout.flatLayout), 3)
+        self._assertStoresFound()
+
+
+    def test_unfinishedMigrationToOtherLayout(self):
+        """
+        While a migration is unfinished, migrating to a different layout
+        fails.
+        """
+        hashLayout = layout.HashPrefixLayout(store=self.rootStore)
+        self._interruptedMigration(hashLayout)
+        otherLayout = layout.HashPrefixLayout(store=self.rootStore, levels=1)
+        self.assertRaises(ValueError,
+                          layout.migrate, self.rootStore, otherLayout)
+
+
+    def test_temporaryCopiesNotMoved(self):
+        """
+        Temporary copies of stores, such as snapshots, aren't moved.
+        """
+        users = self.rootStore.filesdir.child("users")
+        for name in ["alice.snapshot", "bob" + layout.TEMPORARY_EXTENSION]:
+            store.Store(users.child(name)).close()
+
+        hashLayout = layout.HashPrefixLayout(store=self.rootStore)
+        self.assertEqual(layout.migrate(self.rootStore, hashLayout), 3)
+        self.assertTrue(users.child("alice.snapshot").isdir())
+        self.assertTrue(
+            users.child("bob" + layout.TEMPORARY_EXTENSION).isdir())
+        self._assertStoresFound()
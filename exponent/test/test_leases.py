@@ -0,0 +1,497 @@
+"""
+Tests for the networked, lease-based write lock directory.
+"""
+import os
+
+from axiom import attributes, errors, item, store
+from exponent import archive, directory, leases
+from twisted.internet import defer, task
+from twisted.protocols import amp, loopback
+from twisted.test import iosim
+from twisted.trial import unittest
+
+
+class LeaseServerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.server = leases.LeaseServer(store=store.Store())
+        self.server._clock = self.clock
+
+
+    def test_tokensIncrease(self):
+        """
+        Every lease gets a larger fencing token than the one before.
+        """
+        first = self.server.acquire(["a"], "x", 10)
+        self.server.release(["a"], first)
+        second = self.server.acquire(["a"], "x", 10)
+        third = self.server.acquire(["b"], "x", 10)
+        self.assertTrue(first < second < third)
+        self.assertEqual(self.server.lastToken, third)
+
+
+    def test_exclusive(self):
+        """
+        A store with a current lease can't be leased again.
+        """
+        self.server.acquire(["a"], "x", 10)
+        self.assertRaises(directory.AlreadyAcquiredException,
+                          self.server.acquire, ["a"], "y", 10)
+
+
+    def test_expiry(self):
+        """
+        Once a lease has expired, the store can be leased again, and the old
+        lease is stale.
+        """
+        old = self.server.acquire(["a"], "x", 10)
+        self.clock.advance(10)
+        new = self.server.acquire(["a"], "y", 10)
+        self.server.check(["a"], new)
+        self.assertRaises(leases.StaleLeaseException,
+                          self.server.check, ["a"], old)
+
+
+    def test_renew(self):
+        """
+        All of an owner's leases can be renewed at once. Leases of other
+        owners, and expired leases, aren't renewed.
+        """
+        a = self.server.acquire(["a"], "x", 10)
+        b = self.server.acquire(["b"], "x", 10)
+        c = self.server.acquire(["c"], "y", 10)
+        self.clock.advance(5)
+        d = self.server.acquire(["d"], "x", 1)
+        self.clock.advance(1)
+
+        renewed = self.server.renew("x", [a, b, c, d], 10)
+        self.assertEqual(renewed, [a, b])
+
+        self.clock.advance(8)
+        self.server.check(["a"], a)
+        self.assertRaises(leases.StaleLeaseException,
+                          self.server.check, ["c"], c)
+
+
+    def test_renewOnlyLooksAtPresentedLeases(self):
+        """
+        Renewing leases only looks at the leases with the given tokens, not
+        at every lease on the server.
+        """
+        for i in xrange(100):
+            self.server.acquire([str(i)], "other", 10)
+        token = self.server.acquire(["a"], "x", 10)
+
+        looked = []
+        current = leases.LeaseServer._current
+
+        def lookingCurrent(server, pathSegments):
+            looked.append(pathSegments)
+            return current(server, pathSegments)
+
+        self.patch(leases.LeaseServer, "_current", lookingCurrent)
+        self.assertEqual(self.server.renew("x", [token, 12345], 10), [token])
+        self.assertEqual(looked, [("a",)])
+
+
+    def test_transfer(self):
+        """
+        Transferring a lease gives the new owner a lease with a newer token,
+        and makes the old one stale.
+        """
+        old = self.server.acquire(["a"], "x", 10)
+        new = self.server.transfer(["a"], old, "y", 10)
+        self.assertTrue(new > old)
+        self.server.check(["a"], new)
+        self.assertRaises(leases.StaleLeaseException,
+                          self.server.check, ["a"], old)
+        self.assertEqual(self.server.renew("y", [new], 10), [new])
+
+
+    def test_transferStale(self):
+        """
+        A lease that isn't current can't be transferred.
+        """
+        old = self.server.acquire(["a"], "x", 10)
+        self.clock.advance(10)
+        self.assertRaises(leases.StaleLeaseException,
+                          self.server.transfer, ["a"], old, "y", 10)
+
+
+    def test_releaseStale(self):
+        """
+        Releasing a lease that has been superseded leaves the newer lease
+        alone.
+        """
+        old = self.server.acquire(["a"], "x", 10)
+        self.clock.advance(10)
+        new = self.server.acquire(["a"], "y", 10)
+        self.server.release(["a"], old)
+        self.server.check(["a"], new)
+
+
+
+class LeaseClientTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+
+        serverStore = store.Store()
+        self.server = leases.LeaseServer(store=serverStore)
+        self.server._clock = self.clock
+        locator = leases.LeaseLocator(serverStore)
+
+        self.rootStore = store.Store(self.mktemp())
+        store.Store(self.rootStore.filesdir.child("xyzzy"))
+
+        self.clients, self.pumps = [], []
+        for owner in ["a", "b"]:
+            remote, _, pump = iosim.connectedServerAndClient(
+                lambda: amp.AMP(locator=locator), amp.AMP)
+            client = leases.LeaseClient(remote, owner, self.rootStore,
+                                        duration=30, renewInterval=10,
+                                        clock=self.clock)
+            self.addCleanup(client.stop)
+            self.clients.append(client)
+            self.pumps.append(pump)
+
+
+    def _flush(self, d=None):
+        """
+        Delivers all messages between the clients and the server.
+
+        If a deferred is given, it is first chained to a new deferred that is
+        returned, so that AMP doesn't consider its failures unhandled.
+        """
+        if d is not None:
+            chained, d = d, defer.Deferred()
+            chained.chainDeferred(d)
+
+        for pump in self.pumps:
+            pump.flush()
+        return d
+
+
+    def _acquire(self, client=0):
+        return self._flush(self.clients[client].acquire(["xyzzy"]))
+
+
+    def test_implementsInterface(self):
+        """
+        The lease client is a write lock directory.
+        """
+        IWLD = directory.IWriteLockDirectory
+        self.assertTrue(IWLD.providedBy(self.clients[0]))
+
+
+    def test_acquireWriteAndRelease(self):
+        """
+        A client can acquire a lock, write with it and release it, after
+        which another client can acquire it with a larger token.
+        """
+        lock = self.successResultOf(self._acquire())
+        self.assertTrue(directory.IWriteLock.providedBy(lock))
+
+        d = self._flush(lock.write())
+        self.assertEqual(self.successResultOf(d), None)
+
+        d = self._flush(lock.release())
+        self.successResultOf(d)
+
+        otherLock = self.successResultOf(self._acquire(1))
+        self.assertTrue(otherLock.token > lock.token)
+
+
+    def test_exclusive(self):
+        """
+        A lock held by one client can't be acquired by another.
+        """
+        self._acquire()
+        d = self._acquire(1)
+        self.failureResultOf(d).trap(directory.AlreadyAcquiredException)
+
+
+    def test_multipleRelease(self):
+        """
+        Releasing the same lock twice fails.
+        """
+        lock = self.successResultOf(self._acquire())
+        lock.release()
+        self._flush()
+        failure = self.failureResultOf(lock.release())
+        failure.trap(directory.AlreadyReleasedException)
+
+
+    def test_heartbeat(self):
+        """
+        Held leases are renewed, so they remain usable after their original
+        duration.
+        """
+        lock = self.successResultOf(self._acquire())
+        for _ in xrange(10):
+            self.clock.advance(10)
+            self._flush()
+
+        d = self._flush(lock.write())
+        self.successResultOf(d)
+        self.failureResultOf(self._acquire(1))
+
+
+    def test_partitioned(self):
+        """
+        When renewals don't reach the server, the lease expires: another
+        client can acquire the lock, and writes with the old lock fail.
+        """
+        lock = self.successResultOf(self._acquire())
+        self.clock.advance(30)
+
+        newLock = self.successResultOf(self._acquire(1))
+        self.assertTrue(newLock.token > lock.token)
+
+        d = self._flush(lock.write())
+        self.failureResultOf(d).trap(leases.StaleLeaseException)
+
+
+    def test_fencing(self):
+        """
+        A host that wrongly believes it still holds a lease can't write with
+        it, because the server rejects its fencing token.
+        """
+        lock = self.successResultOf(self._acquire())
+        self.clock.advance(30)
+        self.successResultOf(self._acquire(1))
+
+        lock.expires = self.clock.seconds() + 30
+        d = self._flush(lock.write())
+        self.failureResultOf(d).trap(leases.StaleLeaseException)
+
+
+    @defer.inlineCallbacks
+    def test_fencedPush(self):
+        """
+        A write whose lease was lost after it was checked is rejected by the
+        archive, if a newer lease has written the store since.
+        """
+        storeArchive = archive.DirectoryArchive(
+            store=self.rootStore, path=self.rootStore.newDirectory("archive"))
+        self.rootStore.powerUp(storeArchive, archive.IStoreArchive)
+
+        lock = self.successResultOf(self._acquire())
+        self.clock.advance(30)
+        newLock = self.successResultOf(self._acquire(1))
+
+        self.patch(leases.LeaseClient, "_check",
+                   lambda client, lock: defer.succeed(None))
+        yield newLock.write()
+        yield self.assertFailure(lock.write(), leases.StaleLeaseException)
+
+
+    def test_renewInBatches(self):
+        """
+        Leases are renewed in batches that fit in AMP values, however many
+        are held.
+        """
+        client = self.clients[0]
+        batchSize = leases._RENEWAL_BATCH_SIZE
+        tokens = [2 ** 62 + i for i in xrange(batchSize * 2 + 1)]
+        for token in tokens:
+            client._held[token] = leases.LeasedWriteLock(
+                None, None, ["xyzzy"], client, token,
+                self.clock.seconds() + 30)
+
+        calls = []
+        self.patch(client.remote, "callRemote",
+                   lambda command, **kw: calls.append(kw["tokens"])
+                   or defer.succeed({"renewed": kw["tokens"]}))
+        self.successResultOf(client.renew())
+
+        self.assertEqual([len(batch) for batch in calls],
+                         [batchSize, batchSize, 1])
+        self.assertEqual(sum(calls, []), tokens)
+        for batch in calls:
+            leases.RenewLeases.makeArguments(
+                {"owner": "a", "tokens": batch, "duration": 30.0},
+                None).serialize()
+            leases.RenewLeases.makeResponse({"renewed": batch},
+                                            None).serialize()
+
+
+    def test_lostOnRenewal(self):
+        """
+        A lease that the server doesn't renew is lost.
+        """
+        lock = self.successResultOf(self._acquire())
+        self.server.release(["xyzzy"], lock.token)
+        self.clock.advance(10)
+        self._flush()
+        self.assertTrue(lock.lost)
+
+        d = lock.write()
+        self.failureResultOf(d).trap(leases.StaleLeaseException)
+
+
+
+class _Thing(item.Item):
+    """
+    An item in a store that is handed off.
+    """
+    value = attributes.text()
+    data = attributes.bytes()
+
+
+
+class HandoffTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        serverStore = store.Store()
+        self.server = leases.LeaseServer(store=serverStore)
+        self.server._clock = self.clock
+        locator = leases.LeaseLocator(serverStore)
+
+        self.clients = {}
+        for owner in ["a", "b"]:
+            rootStore = store.Store(self.mktemp())
+            remote = self._connect(locator)
+            client = leases.LeaseClient(remote, owner, rootStore,
+                                        clock=self.clock)
+            self.addCleanup(client.stop)
+            self.clients[owner] = client
+
+        sender, receiver = self.clients["a"], self.clients["b"]
+        sender.peers["b"] = self._connect(leases.HandoffLocator(receiver))
+        self.handedOff = []
+        receiver.onHandoff = self.handedOff.append
+
+        userStore = store.Store(sender.rootStore.filesdir.child("xyzzy"))
+        self.data = os.urandom(200000)
+        _Thing(store=userStore, value=u"hello", data=self.data)
+        userStore.close()
+
+
+    def _connect(self, locator):
+        """
+        Connects an AMP client to an AMP server with the given locator,
+        delivering data asynchronously.
+        """
+        server, client = amp.AMP(locator=locator), amp.AMP()
+        done = loopback.loopbackAsync(server, client)
+
+        def disconnect():
+            client.transport.loseConnection()
+            return done
+
+        self.addCleanup(disconnect)
+        return client
+
+
+    @defer.inlineCallbacks
+    def test_handoff(self):
+        """
+        A lock can be handed off to a peer, which gets the store and a lease
+        with a newer token. The old holder can't write anymore.
+        """
+        lock = yield self.clients["a"].acquire(["xyzzy"])
+        self.assertTrue(leases.IHandoffWriteLock.providedBy(lock))
+        yield lock.handoff("b")
+
+        [newLock] = self.handedOff
+        self.assertTrue(newLock.token > lock.token)
+        thing = newLock.store.findUnique(_Thing)
+        self.assertEqual(thing.value, u"hello")
+        self.assertEqual(thing.data, self.data)
+        self.assertEqual(self.server.lastToken, newLock.token)
+
+        self.assertTrue(lock.released)
+        yield self.assertFailure(lock.write(), leases.StaleLeaseException)
+        yield newLock.write()
+
+        handoffs = self.clients["b"].rootStore.newTemporaryFilePath("handoffs")
+        self.assertEqual(handoffs.listdir() if handoffs.exists() else [], [])
+
+
+    @defer.inlineCallbacks
+    def test_handoffFencesWrites(self):
+        """
+        Changes to the store are rejected with ``ChangeRejected`` once the
+        handoff has started, and the store is closed when it is done.
+        """
+        lock = yield self.clients["a"].acquire(["xyzzy"])
+        thing = lock.store.findUnique(_Thing)
+        snapshot = lock.snapshot
+
+        def fencedSnapshot():
+            self.assertRaises(errors.ChangeRejected,
+                              _Thing, store=lock.store, value=u"lost")
+            self.assertRaises(errors.ChangeRejected,
+                              setattr, thing, "value", u"lost")
+            return snapshot()
+
+        lock.snapshot = fencedSnapshot
+        yield lock.handoff("b")
+
+        self.assertIdentical(lock.store.connection, None)
+        [newLock] = self.handedOff
+        [newThing] = newLock.store.query(_Thing)
+        self.assertEqual(newThing.value, u"hello")
+
+
+    @defer.inlineCallbacks
+    def test_piecesPipelined(self):
+        """
+        Pieces are sent to the peer without waiting for each to be
+        acknowledged, up to ``_PIECE_WINDOW`` at once.
+        """
+        self.patch(leases, "_PIECE_WINDOW", 2)
+        peer = self.clients["a"].peers["b"]
+        callRemote = peer.callRemote
+        inFlight = []
+
+        def countingCallRemote(command, **kw):
+            d = callRemote(command, **kw)
+            if command is leases.SendHandoffPiece:
+                inFlight.append(1)
+                self.assertTrue(len(inFlight) <= 2)
+                countingCallRemote.most = max(countingCallRemote.most,
+                                              len(inFlight))
+
+                @d.addBoth
+                def acknowledged(result):
+                    inFlight.pop()
+                    return result
+
+            return d
+
+        countingCallRemote.most = 0
+        peer.callRemote = countingCallRemote
+
+        lock = yield self.clients["a"].acquire(["xyzzy"])
+        yield lock.handoff("b")
+
+        self.assertEqual(countingCallRemote.most, 2)
+        [newLock] = self.handedOff
+        self.assertEqual(newLock.store.findUnique(_Thing).data, self.data)
+
+
+    @defer.inlineCallbacks
+    def test_failedHandoffUnfences(self):
+        """
+        If the handoff fails, the store can be changed again.
+        """
+        lock = yield self.clients["a"].acquire(["xyzzy"])
+        peer = self.clients["a"].peers["b"]
+        peer.callRemote = lambda *a, **kw: defer.fail(RuntimeError())
+        yield self.assertFailure(lock.handoff("b"), RuntimeError)
+
+        self.assertFalse(lock.released)
+        _Thing(store=lock.store, value=u"kept")
+        self.assertEqual(lock.store.query(_Thing).count(), 2)
+
+
+    @defer.inlineCallbacks
+    def test_handoffAfterRelease(self):
+        """
+        A lock that has been released can't be handed off.
+        """
+        lock = yield self.clients["a"].acquire(["xyzzy"])
+        yield lock.release()
+        yield self.assertFailure(lock.handoff("b"),
+                                 directory.AlreadyReleasedException)
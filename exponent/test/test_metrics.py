@@ -0,0 +1,81 @@
+from exponent import metrics
+from twisted.internet import task
+from twisted.trial import unittest
+
+
+class HistogramTests(unittest.TestCase):
+    def test_observe(self):
+        """
+        Values are counted in the first bucket whose upper bound they don't
+        exceed; values beyond all bounds go in the last bucket.
+        """
+        histogram = metrics.Histogram([1, 10])
+        for value in [0.5, 1, 5, 100]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.buckets(),
+                         [(1, 2), (10, 1), (float("inf"), 1)])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.total, 106.5)
+
+
+    def test_dump(self):
+        """
+        Histograms can be described as text.
+        """
+        histogram = metrics.Histogram([1])
+        histogram.observe(3)
+        self.assertEqual(histogram.dump(), ["  <= 1        0",
+                                            "  <= inf      1",
+                                            "  count 1, mean 3.000000"])
+
+
+
+class LockMetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.metrics = metrics.LockMetrics(self.clock)
+
+
+    def test_waitAndHold(self):
+        """
+        The time between requesting and acquiring a lock is its wait time;
+        the time between acquiring and releasing it is its hold time.
+        """
+        requestedAt = self.metrics.requested(["a"])
+        self.clock.advance(2)
+        acquiredAt = self.metrics.acquired(requestedAt)
+        self.clock.advance(20)
+        self.metrics.released(acquiredAt)
+
+        self.assertEqual(self.metrics.acquisitions, 1)
+        self.assertEqual(self.metrics.waitTimes.total, 2)
+        self.assertEqual(self.metrics.holdTimes.total, 20)
+        self.assertEqual(self.metrics.contention, {})
+
+
+    def test_contention(self):
+        """
+        Requests for held locks are counted by path, and their queue lengths
+        are recorded.
+        """
+        self.metrics.requested(["users", "a"], 0)
+        self.metrics.requested(["users", "a"], 1)
+        self.metrics.requested(["users", "b"], 0)
+        self.metrics.requested(["users", "c"])
+
+        self.assertEqual(self.metrics.topContended(),
+                         [("users/a", 2), ("users/b", 1)])
+        self.assertEqual(self.metrics.topContended(1), [("users/a", 2)])
+        self.assertEqual(self.metrics.queueLengths.count, 3)
+
+
+    def test_dump(self):
+        """
+        The metrics can be dumped as text.
+        """
+        self.metrics.requested(["a"], 0)
+        self.metrics.timedOut()
+        report = self.metrics.dump()
+        self.assertIn("timeouts: 1\n", report)
+        self.assertIn("most contended paths:\n  1 a\n", report)
@@ -0,0 +1,103 @@
+"""
+Tests for opening existing stores.
+"""
+from axiom import store
+from exponent import directory, exceptions, opener, storage
+from twisted.internet import defer
+from twisted.trial import unittest
+
+
+class SynchronousOpenerTests(unittest.TestCase):
+    def setUp(self):
+        self.rootStore = store.Store(self.mktemp())
+        store.Store(self.rootStore.filesdir.child("xyzzy"))
+
+
+    def test_default(self):
+        """
+        Without an ``IStoreOpener`` powerup, stores are opened synchronously.
+        """
+        getOpener = opener.getOpener
+        self.assertIdentical(getOpener(self.rootStore), opener.synchronousOpener)
+
+
+    def test_open(self):
+        """
+        The synchronous opener opens existing stores.
+        """
+        storePath = self.rootStore.filesdir.child("xyzzy")
+        d = opener.synchronousOpener.open(storePath)
+        self.assertEqual(self.successResultOf(d).dbdir, storePath)
+
+
+    def test_openNonexistent(self):
+        """
+        The synchronous opener fails to open stores that don't exist.
+        """
+        storePath = self.rootStore.filesdir.child("BOGUS")
+        d = opener.synchronousOpener.open(storePath)
+        self.failureResultOf(d, exceptions.NoSuchStoreException)
+        self.assertFalse(storePath.exists())
+
+
+
+class ThreadPoolOpenerTests(unittest.TestCase):
+    def setUp(self):
+        self.rootStore = store.Store(self.mktemp())
+        store.Store(self.rootStore.filesdir.child("xyzzy"))
+
+        self.opener = opener.ThreadPoolOpener(store=self.rootStore)
+        self.rootStore.powerUp(self.opener, opener.IStoreOpener)
+        self.addCleanup(self.opener.stop)
+
+
+    def test_interface(self):
+        """
+        The thread pool opener is an ``IStoreOpener``, and is used as the
+        root store's opener once installed.
+        """
+        self.assertTrue(opener.IStoreOpener.providedBy(self.opener))
+        self.assertIdentical(opener.getOpener(self.rootStore), self.opener)
+
+
+    def test_open(self):
+        """
+        The thread pool opener opens existing stores.
+        """
+        storePath = self.rootStore.filesdir.child("xyzzy")
+        d = self.opener.open(storePath)
+        d.addCallback(lambda s: self.assertEqual(s.dbdir, storePath))
+        return d
+
+
+    def test_openNonexistent(self):
+        """
+        The thread pool opener fails to open stores that don't exist.
+        """
+        storePath = self.rootStore.filesdir.child("BOGUS")
+        d = self.opener.open(storePath)
+        return self.assertFailure(d, exceptions.NoSuchStoreException)
+
+
+    def test_storage(self):
+        """
+        Long-term storage opens stores with the thread pool opener.
+        """
+        fakeStorage = storage.FakeStorage(store=self.rootStore)
+        first, second = [fakeStorage.get(["xyzzy"]) for _ in range(2)]
+        self.assertNoResult(first)
+
+        def check((firstStore, secondStore)):
+            self.assertIdentical(firstStore, secondStore)
+
+        return defer.gatherResults([first, second]).addCallback(check)
+
+
+    def test_directory(self):
+        """
+        Lock directories open stores with the thread pool opener.
+        """
+        lockDirectory = directory.LocalWriteLockDirectory(store=self.rootStore)
+        d = lockDirectory.acquire(["xyzzy"])
+        self.assertNoResult(d)
+        return d.addCallback(lambda lock: lock.release())
@@ -0,0 +1,180 @@
+"""
+Tests for pools of open stores.
+"""
+from exponent import pool
+from twisted.internet import task
+from twisted.trial import unittest
+
+
+class StorePoolTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = pool.StorePool(maxSize=2, idleTimeout=10, clock=self.clock)
+
+
+    def test_missAndHit(self):
+        """
+        Getting a store that isn't in the pool raises ``KeyError`` and counts
+        as a miss. Getting it after it has been added counts as a hit.
+        """
+        self.assertRaises(KeyError, self.pool.get, "a")
+        store = _Store()
+        self.pool.put("a", store)
+        self.assertIdentical(self.pool.get("a"), store)
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 1))
+
+
+    def test_evictLeastRecentlyUsed(self):
+        """
+        When the pool is full, the least recently used store is evicted.
+        """
+        self.pool.put("a", _Store())
+        self.pool.put("b", _Store())
+        self.pool.get("a")
+        self.pool.put("c", _Store())
+
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(self.pool.evictions, 1)
+        self.assertRaises(KeyError, self.pool.get, "b")
+
+
+    def test_evictIdle(self):
+        """
+        Stores that have been idle for longer than the idle timeout are
+        evicted.
+        """
+        self.pool.put("a", _Store())
+        self.clock.advance(5)
+        self.pool.put("b", _Store())
+        self.clock.advance(6)
+        self.pool.evictIdle()
+
+        self.assertEqual(len(self.pool), 1)
+        self.assertRaises(KeyError, self.pool.get, "a")
+
+
+    def test_pinnedStoresAreNotEvicted(self):
+        """
+        Pinned stores are neither evicted when idle nor when the pool is
+        full. Once unpinned, they can be evicted again.
+        """
+        self.pool.put("a", _Store())
+        self.pool.pin("a")
+        self.clock.advance(20)
+        self.pool.put("b", _Store())
+        self.pool.put("c", _Store())
+        self.assertTrue(self.pool.isPinned("a"))
+        self.assertIn("a", self.pool)
+        self.assertRaises(KeyError, self.pool.get, "b")
+
+        self.pool.unpin("a")
+        self.assertFalse(self.pool.isPinned("a"))
+        self.clock.advance(20)
+        self.pool.evictIdle()
+        self.assertEqual(len(self.pool), 0)
+
+
+    def test_pinMissing(self):
+        """
+        Stores that aren't in the pool can't be pinned.
+        """
+        self.assertRaises(KeyError, self.pool.pin, "a")
+
+
+    def test_evictedButReferencedStore(self):
+        """
+        An evicted store that is still referenced elsewhere is still returned
+        by the pool, so there is only ever one store object for a key.
+        """
+        store = _Store()
+        self.pool.put("a", store)
+        self.pool.put("b", _Store())
+        self.pool.put("c", _Store())
+        self.assertEqual(self.pool.evictions, 1)
+        self.assertIdentical(self.pool.get("a"), store)
+
+
+    def test_discard(self):
+        """
+        A discarded store is forgotten, even if it is still referenced
+        elsewhere or pinned.
+        """
+        store = _Store()
+        self.pool.put("a", store)
+        self.pool.pin("a")
+        self.pool.discard("a")
+        self.assertNotIn("a", self.pool)
+        self.assertFalse(self.pool.isPinned("a"))
+        self.assertRaises(KeyError, self.pool.get, "a")
+        self.pool.discard("a")
+
+
+
+class ClosingStorePoolTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.closed = []
+        self.pool = pool.ClosingStorePool(self.closed.append, maxSize=2,
+                                          idleTimeout=10, clock=self.clock)
+
+
+    def test_closeEvicted(self):
+        """
+        Evicted stores are closed, and forgotten even if they are still
+        referenced elsewhere.
+        """
+        a, b, c = _Store(), _Store(), _Store()
+        for key, store in zip("abc", [a, b, c]):
+            self.pool.put(key, store)
+
+        self.assertEqual(self.closed, [a])
+        self.assertRaises(KeyError, self.pool.get, "a")
+        self.assertEqual((self.pool.opens, self.pool.closes), (3, 1))
+
+
+    def test_closeIdle(self):
+        """
+        Idle stores are closed.
+        """
+        a = _Store()
+        self.pool.put("a", a)
+        self.clock.advance(11)
+        self.pool.evictIdle()
+        self.assertEqual(self.closed, [a])
+        self.assertNotIn("a", self.pool)
+
+
+    def test_pinnedStoresAreNotClosed(self):
+        """
+        Pinned stores are kept open, even if that takes the pool over its
+        budget.
+        """
+        a = _Store()
+        self.pool.put("a", a)
+        self.pool.pin("a")
+        self.pool.put("b", _Store())
+        self.pool.put("c", _Store())
+        self.assertNotIn(a, self.closed)
+        self.assertIdentical(self.pool.get("a"), a)
+
+
+    def test_reopen(self):
+        """
+        Putting a store again after it was closed counts as another open.
+        Putting an open store again doesn't.
+        """
+        self.pool.put("a", _Store())
+        self.pool.put("a", self.pool.get("a"))
+        self.assertEqual(self.pool.opens, 1)
+
+        self.clock.advance(11)
+        self.pool.evictIdle()
+        self.pool.put("a", _Store())
+        self.assertEqual((self.pool.opens, self.pool.closes), (2, 1))
+
+
+
+class _Store(object):
+    """
+    A weakly referenceable stand-in for a store.
+    """
@@ -0,0 +1,230 @@
+from exponent import directory, sharding
+from twisted.internet import defer
+from twisted.trial import unittest
+from zope import interface
+
+
+class HashRingTests(unittest.TestCase):
+    def setUp(self):
+        self.ring = sharding.HashRing()
+        self.keys = ["user%d" % (i,) for i in xrange(2000)]
+
+
+    def _assignments(self):
+        return dict((key, self.ring.get(key)) for key in self.keys)
+
+
+    def test_empty(self):
+        """
+        Looking up a key in an empty ring fails.
+        """
+        self.assertRaises(KeyError, self.ring.get, "a")
+
+
+    def test_balanced(self):
+        """
+        Keys are spread roughly evenly over the nodes.
+        """
+        for node in "abcd":
+            self.ring.add(node)
+        self.assertEqual(len(self.ring), 4)
+
+        counts = {}
+        for node in self._assignments().itervalues():
+            counts[node] = counts.get(node, 0) + 1
+        for count in counts.itervalues():
+            self.assertTrue(300 < count < 700, counts)
+
+
+    def test_addMovesFewKeys(self):
+        """
+        Adding a node only moves keys to that node, and about as many as
+        it should own.
+        """
+        for node in "abcd":
+            self.ring.add(node)
+        before = self._assignments()
+        self.ring.add("e")
+        after = self._assignments()
+
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(all(after[key] == "e" for key in moved))
+        self.assertTrue(200 < len(moved) < 600, len(moved))
+
+
+    def test_removeMovesFewKeys(self):
+        """
+        Removing a node only moves the keys that belonged to it.
+        """
+        for node in "abcd":
+            self.ring.add(node)
+        before = self._assignments()
+        self.ring.remove("b")
+        after = self._assignments()
+
+        for key in self.keys:
+            if before[key] != "b":
+                self.assertEqual(before[key], after[key])
+            else:
+                self.assertNotEqual(after[key], "b")
+
+
+
+class _FakeDirectory(object):
+    """
+    A lock directory that grants locks, unless told not to.
+    """
+    def __init__(self):
+        self.acquired = []
+        self.fail = False
+
+
+    def acquire(self, pathSegments):
+        self.acquired.append(pathSegments)
+        if self.fail:
+            return defer.fail(directory.AlreadyAcquiredException())
+        return defer.succeed(_FakeLock())
+
+
+
+@interface.implementer(directory.IWriteLock)
+class _FakeLock(object):
+    def release(self):
+        return defer.succeed(None)
+
+
+    def handoff(self, peerName):
+        return defer.succeed(None)
+
+
+
+class ShardedWriteLockDirectoryTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = sharding.ShardedWriteLockDirectory()
+        self.shards = {}
+        for name in ["a", "b", "c"]:
+            self.shards[name] = _FakeDirectory()
+            self.directory.addShard(name, self.shards[name])
+
+
+    def test_implementsInterface(self):
+        IWLD = directory.IWriteLockDirectory
+        self.assertTrue(IWLD.providedBy(self.directory))
+
+
+    def test_acquire(self):
+        """
+        Acquiring a lock delegates to the shard the store belongs to, and is
+        counted in that shard's metrics.
+        """
+        pathSegments = ["users", "alice"]
+        name = self.directory.shardFor(pathSegments)
+        self.successResultOf(self.directory.acquire(pathSegments))
+
+        self.assertEqual(self.shards[name].acquired, [pathSegments])
+        metrics = self.directory.metrics[name]
+        self.assertEqual((metrics.requests, metrics.acquired, metrics.failed),
+                         (1, 1, 0))
+
+
+    def test_acquireFails(self):
+        """
+        Failed acquisitions are passed on, and counted.
+        """
+        pathSegments = ["users", "alice"]
+        name = self.directory.shardFor(pathSegments)
+        self.shards[name].fail = True
+
+        d = self.directory.acquire(pathSegments)
+        self.failureResultOf(d).trap(directory.AlreadyAcquiredException)
+        self.assertEqual(self.directory.metrics[name].failed, 1)
+
+
+    def test_duplicateShard(self):
+        """
+        Shards can't be added twice.
+        """
+        self.assertRaises(ValueError,
+                          self.directory.addShard, "a", _FakeDirectory())
+
+
+    def test_removeShard(self):
+        """
+        Stores of a removed shard go to the remaining shards.
+        """
+        self.directory.removeShard("a")
+        self.assertNotIn("a", self.directory.metrics)
+        for i in xrange(100):
+            name = self.directory.shardFor(["users", "user%d" % (i,)])
+            self.assertIn(name, ["b", "c"])
+
+
+    def test_lockedStoresStayWhenAddingShards(self):
+        """
+        A locked store stays with its shard when a shard is added, so that it
+        can't be locked in both. It moves once all its locks are released.
+        """
+        ring = sharding.HashRing()
+        for name in "abcd":
+            ring.add(name)
+        pathSegments = next(["users", "user%d" % (i,)] for i in xrange(1000)
+                            if ring.get("users/user%d" % (i,)) == "d")
+        old = self.directory.shardFor(pathSegments)
+        first = self.successResultOf(self.directory.acquire(pathSegments))
+
+        self.shards["d"] = _FakeDirectory()
+        self.directory.addShard("d", self.shards["d"])
+        self.assertEqual(self.directory.shardFor(pathSegments), old)
+        second = self.successResultOf(self.directory.acquire(pathSegments))
+        self.assertEqual(self.shards[old].acquired, [pathSegments] * 2)
+        self.assertEqual(self.shards["d"].acquired, [])
+
+        first.release()
+        self.assertEqual(self.directory.shardFor(pathSegments), old)
+        second.release()
+        second.release()
+        self.assertEqual(self.directory.shardFor(pathSegments), "d")
+
+
+    def test_removedShardKeptWhileLocked(self):
+        """
+        A removed shard keeps its locked stores until they are released.
+        Then it is forgotten, and its stores move.
+        """
+        pathSegments = ["users", "alice"]
+        name = self.directory.shardFor(pathSegments)
+        lock = self.successResultOf(self.directory.acquire(pathSegments))
+        self.assertTrue(directory.IWriteLock.providedBy(lock))
+
+        self.directory.removeShard(name)
+        self.assertEqual(self.directory.shardFor(pathSegments), name)
+        self.assertIn(name, self.directory.metrics)
+
+        self.successResultOf(lock.release())
+        self.assertNotIn(name, self.directory.metrics)
+        self.assertNotEqual(self.directory.shardFor(pathSegments), name)
+
+
+    def test_handedOffLockIsForgotten(self):
+        """
+        A lock that is handed off no longer keeps its store, or a removed
+        shard, around.
+        """
+        pathSegments = ["users", "alice"]
+        name = self.directory.shardFor(pathSegments)
+        lock = self.successResultOf(self.directory.acquire(pathSegments))
+        self.directory.removeShard(name)
+
+        self.successResultOf(lock.handoff("b"))
+        self.assertEqual(self.directory._routes, {})
+        self.assertNotIn(name, self.directory.metrics)
+
+
+    def test_failedAcquisitionIsForgotten(self):
+        """
+        A store whose lock couldn't be acquired isn't kept with its shard.
+        """
+        pathSegments = ["users", "alice"]
+        self.shards[self.directory.shardFor(pathSegments)].fail = True
+        self.directory.acquire(pathSegments).addErrback(lambda _: None)
+        self.assertEqual(self.directory._routes, {})
@@ -0,0 +1,127 @@
+"""
+Tests for online snapshots of stores.
+"""
+from axiom import attributes, item, store
+from exponent import directory, snapshot
+from twisted.internet import task
+from twisted.trial import unittest
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.storePath = self.mktemp()
+        self.store = store.Store(self.storePath)
+        for i in range(100):
+            _Thing(store=self.store, value=i)
+        self.store.newFilePath("picture").setContent("xyzzy")
+
+        self.destination = self.store.dbdir.sibling("snapshot")
+
+        self.ticks = []
+        self.cooperator = task.Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self.ticks.append)
+
+
+    def _snapshot(self, **kwargs):
+        """
+        Starts taking a snapshot of the test store, one page at a time.
+        """
+        kwargs.setdefault("pagesPerStep", 1)
+        return snapshot.snapshot(self.store.dbdir, self.destination,
+                                 cooperator=self.cooperator, **kwargs)
+
+
+    def _tick(self):
+        """
+        Copies one batch of pages.
+        """
+        self.ticks.pop(0)()
+
+
+    def _finish(self, d):
+        """
+        Copies batches of pages until the snapshot is done.
+        """
+        while self.ticks:
+            self._tick()
+        return self.successResultOf(d)
+
+
+    def test_snapshot(self):
+        """
+        A snapshot is a copy of the store, including its files, that takes
+        several steps to make.
+        """
+        d = self._snapshot()
+        self._tick()
+        self.assertNoResult(d)
+
+        storeSnapshot = self._finish(d)
+        self.assertEqual(storeSnapshot.restarts, 0)
+        self.assertEqual(storeSnapshot.path, self.destination)
+
+        copy = storeSnapshot.open()
+        self.assertEqual(copy.query(_Thing).count(), 100)
+        picture = copy.filesdir.child("picture")
+        self.assertEqual(picture.getContent(), "xyzzy")
+
+        storeSnapshot.remove()
+        self.assertFalse(self.destination.exists())
+
+
+    def test_changedWhileCopying(self):
+        """
+        When the store changes while a snapshot is being taken, copying
+        starts over, and the snapshot includes the change.
+        """
+        d = self._snapshot()
+        self._tick()
+        self._tick()
+        _Thing(store=self.store, value=100)
+
+        storeSnapshot = self._finish(d)
+        self.assertEqual(storeSnapshot.restarts, 1)
+        self.assertEqual(storeSnapshot.open().query(_Thing).count(), 101)
+
+
+    def test_tooManyRestarts(self):
+        """
+        When the store keeps changing, the snapshot is eventually taken in
+        one go.
+        """
+        d = self._snapshot(maxRestarts=2)
+        for value in range(100, 102):
+            self._tick()
+            self._tick()
+            _Thing(store=self.store, value=value)
+
+        storeSnapshot = self._finish(d)
+        self.assertEqual(storeSnapshot.restarts, 2)
+        self.assertEqual(storeSnapshot.open().query(_Thing).count(), 102)
+
+
+
+class WriteLockSnapshotTests(unittest.TestCase):
+    def test_snapshot(self):
+        """
+        Local write locks take snapshots next to their store.
+        """
+        rootStore = store.Store(self.mktemp())
+        userStore = store.Store(rootStore.filesdir.child("xyzzy"))
+        _Thing(store=userStore, value=1)
+
+        lock = directory.LocalWriteLock(userStore)
+        d = lock.snapshot()
+
+        @d.addCallback
+        def check(storeSnapshot):
+            self.assertEqual(storeSnapshot.path.parent(), rootStore.filesdir)
+            self.assertEqual(storeSnapshot.open().findUnique(_Thing).value, 1)
+
+        return d
+
+
+
+class _Thing(item.Item):
+    value = attributes.integer()
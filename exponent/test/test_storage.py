@@ -34,3 +34,17 @@ class LocalStorageTests(unittest.TestCase):
         """
         failure = self.failureResultOf(self.storage.get(["BOGUS"]))
         failure.trap(exceptions.NoSuchStoreException)
+
+
+    def test_pool(self):
+        """
+        Local storage keeps opened stores in a pool configured by its
+        attributes.
+        """
+        self.assertEqual(self.storage.pool.maxSize, 1024)
+        self.assertEqual(self.storage.pool.idleTimeout, 300)
+
+        self.successResultOf(self.storage.get(["xyzzy"]))
+        self.successResultOf(self.storage.get(["xyzzy"]))
+        self.assertEqual(self.storage.pool.misses, 1)
+        self.assertEqual(self.storage.pool.hits, 1)
@@ -1,4 +1,7 @@
-from axiom import attributes, errors, item, store
+import gc
+import weakref
+
+from axiom import attributes, errors, item, store, substore as axiomsubstore
 from exponent import substore
 from twisted.trial import unittest
 
@@ -34,6 +37,172 @@ class SubstoreTests(unittest.TestCase):
         self.assertRaises(errors.ItemNotFound, getBogus)
 
 
+    def test_reference(self):
+        """
+        Creating a child store also creates a reference to its substore, by
+        its path segments.
+        """
+        substore.createChildStore(self.rootStore, ["a", "b"])
+        reference = self.rootStore.findUnique(substore.ChildStoreReference)
+        self.assertEqual(reference.path, u"a/b")
+        self.assertEqual(reference.subStore.storepath,
+                         self.rootStore.filesdir.descendant(["a", "b"]))
+
+
+    def test_cached(self):
+        """
+        Getting a child store again doesn't open it again.
+        """
+        created = substore.createChildStore(self.rootStore, ["a"])
+        opened = []
+        self.patch(axiomsubstore.SubStore, "open",
+                   lambda subStore: opened.append(subStore))
+
+        for _ in xrange(3):
+            retrieved = substore.getChildStore(self.rootStore, ["a"])
+            self.assertIdentical(retrieved, created)
+        self.assertEqual(opened, [])
+
+
+    def test_cacheIsBounded(self):
+        """
+        Only a limited number of child stores are kept open.
+        """
+        self.patch(substore, "CACHE_SIZE", 2)
+        for name in "abc":
+            substore.createChildStore(self.rootStore, [name])
+        self.assertEqual(len(substore._cacheFor(self.rootStore)), 2)
+
+
+    def test_rootStoreCollected(self):
+        """
+        A root store that is no longer referenced is collected, along with
+        its cached child stores.
+        """
+        rootStore = store.Store(self.mktemp())
+        childStore = substore.createChildStore(rootStore, ["a"])
+        references = weakref.ref(rootStore), weakref.ref(childStore)
+        del rootStore, childStore
+        gc.collect()
+        self.assertEqual([reference() for reference in references],
+                         [None, None])
+
+
+    def test_closeAndReopen(self):
+        """
+        Child stores that are evicted from the pool are closed, and reopened
+        when they are next gotten.
+        """
+        self.patch(substore, "CACHE_SIZE", 1)
+        a = substore.createChildStore(self.rootStore, ["a"])
+        storeID = a.transact(Child, store=a).storeID
+        connections = [a.connection]
+        del a
+        substore.createChildStore(self.rootStore, ["b"])
+
+        reopened = substore.getChildStore(self.rootStore, ["a"])
+        self.assertNotIn(reopened.connection, connections)
+        self.assertEqual(reopened.getItemByID(storeID).storeID, storeID)
+
+        pool = substore.getChildStorePool(self.rootStore)
+        self.assertEqual((pool.opens, pool.closes), (3, 2))
+
+
+    def test_heldNotClosed(self):
+        """
+        Child stores that are held aren't closed when they would be evicted,
+        and are closed once they are released and evicted.
+        """
+        self.patch(substore, "CACHE_SIZE", 2)
+        for name in "abc":
+            childStore = Child.createChildStore(self.rootStore, [name])
+            childStore.transact(Child, store=childStore)
+        pool = substore.getChildStorePool(self.rootStore)
+
+        with Child.holdChildStore(self.rootStore, ["a"]) as a:
+            child = a.findUnique(Child)
+            Child.findUniqueChild(self.rootStore, ["b"])
+            Child.findUniqueChild(self.rootStore, ["c"])
+            child.store.transact(Child, store=child.store)
+            self.assertIdentical(Child.getChildStore(self.rootStore, ["a"]),
+                                 a)
+
+        self.assertNotIdentical(a.connection, None)
+        Child.findUniqueChild(self.rootStore, ["b"])
+        Child.findUniqueChild(self.rootStore, ["c"])
+        self.assertIdentical(a.connection, None)
+        self.assertNotIn(Child.typeName + u"/a", pool)
+
+
+    def test_releaseHandleTwice(self):
+        """
+        Releasing a handle more than once only unpins its store once.
+        """
+        substore.createChildStore(self.rootStore, ["a"])
+        first = substore.holdChildStore(self.rootStore, ["a"])
+        second = substore.holdChildStore(self.rootStore, ["a"])
+        first.release()
+        first.release()
+        self.assertTrue(substore.getChildStorePool(self.rootStore)
+                        .isPinned(u"a"))
+        second.release()
+        self.assertFalse(substore.getChildStorePool(self.rootStore)
+                         .isPinned(u"a"))
+
+
+    def test_pinnedNotClosed(self):
+        """
+        Pinned child stores aren't closed.
+        """
+        self.patch(substore, "CACHE_SIZE", 1)
+        a = substore.createChildStore(self.rootStore, ["a"])
+        substore.getChildStorePool(self.rootStore).pin(u"a")
+        substore.createChildStore(self.rootStore, ["b"])
+        self.assertIdentical(substore.getChildStore(self.rootStore, ["a"]), a)
+        self.assertNotIdentical(a.connection, None)
+
+
+    def test_legacySubstore(self):
+        """
+        Child stores created without a reference can still be found, and get
+        a reference when they are.
+        """
+        path = ["legacy"]
+        self.rootStore.transact(axiomsubstore.SubStore.createNew,
+                                self.rootStore, path)
+        childStore = substore.getChildStore(self.rootStore, path)
+        storePath = self.rootStore.filesdir.child("legacy")
+        self.assertEqual(childStore.dbdir, storePath)
+        reference = self.rootStore.findUnique(substore.ChildStoreReference)
+        self.assertEqual(reference.path, u"legacy")
+
+
+    def test_delete(self):
+        """
+        Deleting a child store removes it, its reference and its files, and
+        forgets it, so that getting it fails.
+        """
+        substore.createChildStore(self.rootStore, ["a"])
+        substore.deleteChildStore(self.rootStore, ["a"])
+        self.assertFalse(self.rootStore.filesdir.child("a").exists())
+        self.assertEqual(self.rootStore.count(substore.ChildStoreReference), 0)
+        self.assertEqual(self.rootStore.count(axiomsubstore.SubStore), 0)
+        self.assertRaises(errors.ItemNotFound,
+                          substore.getChildStore, self.rootStore, ["a"])
+
+
+    def test_deletedElsewhere(self):
+        """
+        A child store whose substore is deleted directly is forgotten too.
+        """
+        substore.createChildStore(self.rootStore, ["a"])
+        subStore = self.rootStore.findUnique(axiomsubstore.SubStore)
+        subStore.close()
+        self.rootStore.transact(subStore.deleteFromStore)
+        self.assertRaises(errors.ItemNotFound,
+                          substore.getChildStore, self.rootStore, ["a"])
+
+
 
 class ChildMixinTests(unittest.TestCase):
     def setUp(self):
@@ -60,3 +229,265 @@ class ChildMixinTests(unittest.TestCase):
 
 class Child(item.Item, substore.ChildMixin):
     _dummy = attributes.boolean()
+
+
+
+class CreateChildStoresTests(unittest.TestCase):
+    def setUp(self):
+        self.rootStore = store.Store(self.mktemp())
+        substore.createChildStore(self.rootStore, ["existing"])
+        self.transactions = 0
+        transact = self.rootStore.transact
+
+        def countingTransact(*a, **kw):
+            self.transactions += 1
+            return transact(*a, **kw)
+
+        self.patch(self.rootStore, "transact", countingTransact)
+
+
+    def _assertCreated(self, allPathSegments):
+        for pathSegments in allPathSegments:
+            childStore = substore.getChildStore(self.rootStore, pathSegments)
+            storePath = self.rootStore.filesdir.descendant(pathSegments)
+            self.assertEqual(childStore.dbdir, storePath)
+
+
+    def test_batched(self):
+        """
+        Child stores are created in batches of root store transactions.
+        """
+        allPathSegments = [["users", str(i)] for i in xrange(5)]
+        created = substore.createChildStores(self.rootStore, allPathSegments,
+                                             batchSize=2, processes=0)
+        self.assertEqual(created, 5)
+        self.assertEqual(self.transactions, 3)
+        self._assertCreated(allPathSegments)
+
+
+    def test_workerProcesses(self):
+        """
+        The child stores' databases can be created in worker processes.
+        """
+        allPathSegments = [["users", str(i)] for i in xrange(3)]
+        substore.createChildStores(self.rootStore, allPathSegments,
+                                   processes=2)
+        self._assertCreated(allPathSegments)
+
+
+    def test_childMixin(self):
+        """
+        Child stores for a child type are created under its type name.
+        """
+        Child.createChildStores(self.rootStore, [["a"], ["b"]], processes=0)
+        self.assertNotIdentical(Child.getChildStore(self.rootStore, ["b"]),
+                                None)
+
+
+
+class TemplateChild(item.Item, substore.ChildMixin):
+    name = attributes.text()
+
+
+
+class TemplateTests(unittest.TestCase):
+    def setUp(self):
+        self.rootStore = store.Store(self.mktemp())
+        self.built = []
+        TemplateChild.registerTemplate(self._build, self._fixup)
+        self.addCleanup(substore._templates.pop, TemplateChild)
+
+
+    def _build(self, templateStore):
+        self.built.append(templateStore)
+        TemplateChild(store=templateStore, name=u"template")
+
+
+    def _fixup(self, childStore, pathSegments):
+        childStore.findUnique(TemplateChild).name = pathSegments[-1]
+
+
+    def test_cloned(self):
+        """
+        Child stores of a type with a template are copies of the template
+        store, adapted by the fixup.
+        """
+        TemplateChild.createChildStore(self.rootStore, [u"a"])
+        TemplateChild.createChildStore(self.rootStore, [u"b"])
+        self.assertEqual(len(self.built), 1)
+
+        for name in [u"a", u"b"]:
+            child = TemplateChild.findUniqueChild(self.rootStore, [name])
+            self.assertEqual(child.name, name)
+            self.assertEqual(child.store.parent, self.rootStore)
+
+        path = TemplateChild.typeName + u"/a"
+        reference = self.rootStore.findFirst(
+            substore.ChildStoreReference,
+            substore.ChildStoreReference.path == path)
+        self.assertNotIdentical(reference, None)
+
+
+    def test_clonedStoreIsIndependent(self):
+        """
+        Changing a cloned child store doesn't change the template.
+        """
+        childStore = TemplateChild.createChildStore(self.rootStore, [u"a"])
+        childStore.transact(TemplateChild, store=childStore, name=u"extra")
+        otherStore = TemplateChild.createChildStore(self.rootStore, [u"b"])
+        self.assertEqual(childStore.count(TemplateChild), 2)
+        self.assertEqual(otherStore.count(TemplateChild), 1)
+
+
+    def test_discardTemplate(self):
+        """
+        A discarded template is built again when it is next needed.
+        """
+        TemplateChild.createChildStore(self.rootStore, [u"a"])
+        TemplateChild.discardTemplate(self.rootStore)
+        TemplateChild.createChildStore(self.rootStore, [u"b"])
+        self.assertEqual(len(self.built), 2)
+
+
+    def test_createChildStores(self):
+        """
+        Child stores created in bulk are copies of the template too, adapted
+        by the fixup.
+        """
+        TemplateChild.createChildStores(self.rootStore, [[u"a"], [u"b"]],
+                                        processes=0)
+        self.assertEqual(len(self.built), 1)
+        for name in [u"a", u"b"]:
+            child = TemplateChild.findUniqueChild(self.rootStore, [name])
+            self.assertEqual(child.name, name)
+
+
+    def test_createChildStoresInWorkers(self):
+        """
+        Templates are copied in worker processes.
+        """
+        TemplateChild.createChildStores(self.rootStore, [[u"a"], [u"b"]],
+                                        processes=2)
+        for name in [u"a", u"b"]:
+            child = TemplateChild.findUniqueChild(self.rootStore, [name])
+            self.assertEqual(child.name, name)
+
+
+    def test_withoutTemplate(self):
+        """
+        Child stores of types without a template are still created empty.
+        """
+        childStore = Child.createChildStore(self.rootStore, ["a"])
+        self.assertEqual(childStore.count(Child), 0)
+        self.assertFalse(self.rootStore.dbdir.child("templates").exists())
+
+
+
+def _names(childStore):
+    """
+    A fan-out query for the names of all template children.
+    """
+    return [(child.name,) for child in childStore.query(TemplateChild)]
+
+
+
+def _isLong((name,)):
+    return len(name) > 1
+
+
+
+def _fail(childStore):
+    raise ValueError("xyzzy")
+
+
+
+class FanOutTests(unittest.TestCase):
+    def setUp(self):
+        self.rootStore = store.Store(self.mktemp())
+        for name in [u"a", u"bb", u"cc"]:
+            childStore = TemplateChild.createChildStore(self.rootStore, [name])
+            TemplateChild(store=childStore, name=name)
+            TemplateChild(store=childStore, name=name * 2)
+        substore.createChildStore(self.rootStore, ["other"])
+
+
+    def test_fanOut(self):
+        """
+        The query runs on every child store, and its results are yielded
+        with the path segments of their store.
+        """
+        results = substore.fanOut(self.rootStore, _names, processes=2)
+        typeName = TemplateChild.typeName
+        self.assertEqual(sorted(results),
+                         [([typeName, u"a"], (u"a",)),
+                          ([typeName, u"a"], (u"aa",)),
+                          ([typeName, u"bb"], (u"bb",)),
+                          ([typeName, u"bb"], (u"bbbb",)),
+                          ([typeName, u"cc"], (u"cc",)),
+                          ([typeName, u"cc"], (u"cccc",))])
+
+
+    def test_legacySubstores(self):
+        """
+        Child stores that were created without a reference, by older
+        versions, are queried too, and get a reference.
+        """
+        typeName = TemplateChild.typeName
+        subStore = self.rootStore.transact(axiomsubstore.SubStore.createNew,
+                                           self.rootStore,
+                                           [typeName, "legacy"])
+        childStore = subStore.open()
+        TemplateChild(store=childStore, name=u"legacy")
+
+        results = TemplateChild.fanOut(self.rootStore, _names, processes=0)
+        self.assertIn(([u"legacy"], (u"legacy",)), list(results))
+        path = typeName + u"/legacy"
+        self.assertEqual(self.rootStore.count(
+            substore.ChildStoreReference,
+            substore.ChildStoreReference.path == path), 1)
+
+
+    def test_childMixin(self):
+        """
+        Fan-out queries of a child type only run on stores of that type.
+        """
+        results = TemplateChild.fanOut(self.rootStore, _names, processes=0)
+        self.assertEqual(len(list(results)), 6)
+
+
+    def test_predicate(self):
+        """
+        Only results matching the predicate are yielded.
+        """
+        results = TemplateChild.fanOut(self.rootStore, _names,
+                                       predicate=_isLong, processes=0)
+        self.assertEqual(sorted(name for _, (name,) in results),
+                         [u"aa", u"bb", u"bbbb", u"cc", u"cccc"])
+
+
+    def test_limit(self):
+        """
+        No more results than the limit are yielded.
+        """
+        results = TemplateChild.fanOut(self.rootStore, _names, limit=3,
+                                       processes=2)
+        self.assertEqual(len(list(results)), 3)
+
+
+    def test_aggregate(self):
+        """
+        Results can be aggregated per store in the worker processes.
+        """
+        results = TemplateChild.fanOut(self.rootStore, _names, aggregate=len,
+                                       processes=2)
+        self.assertEqual(sorted(results),
+                         [([u"a"], 2), ([u"bb"], 2), ([u"cc"], 2)])
+
+
+    def test_failure(self):
+        """
+        Failing queries are reported with the original traceback.
+        """
+        results = TemplateChild.fanOut(self.rootStore, _fail, processes=2)
+        e = self.assertRaises(substore.FanOutError, list, results)
+        self.assertIn("xyzzy", e.args[1])
@@ -0,0 +1,113 @@
+"""
+Tests for internal utilities.
+"""
+from exponent import _util
+from twisted.internet import defer
+from twisted.python import filepath
+from twisted.trial import unittest
+
+
+class CoalescerTests(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = _util.Coalescer()
+        self.calls = []
+
+
+    def _call(self, key="key"):
+        """
+        Calls a function that records its call through the coalescer, and
+        returns a deferred that will fire with the function's result.
+        """
+        def f():
+            d = defer.Deferred()
+            self.calls.append(d)
+            return d
+
+        return self.coalescer.call(key, f)
+
+
+    def test_coalesce(self):
+        """
+        Concurrent calls with the same key only call the function once, and
+        all of them get its result.
+        """
+        first, second = self._call(), self._call()
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(self.coalescer.inFlight("key"))
+
+        result = object()
+        self.calls[0].callback(result)
+        self.assertIdentical(self.successResultOf(first), result)
+        self.assertIdentical(self.successResultOf(second), result)
+        self.assertFalse(self.coalescer.inFlight("key"))
+
+
+    def test_differentKeys(self):
+        """
+        Calls with different keys are not coalesced.
+        """
+        self._call("a"), self._call("b")
+        self.assertEqual(len(self.calls), 2)
+
+
+    def test_failure(self):
+        """
+        All of the callers waiting for a call that fails get the failure.
+        """
+        first, second = self._call(), self._call()
+        self.calls[0].errback(RuntimeError())
+        self.failureResultOf(first, RuntimeError)
+        self.failureResultOf(second, RuntimeError)
+
+
+    def test_callAgainAfterCompletion(self):
+        """
+        Once a call has completed, the next call for the same key calls the
+        function again.
+        """
+        self._call()
+        self.calls[0].callback(None)
+        self._call()
+        self.assertEqual(len(self.calls), 2)
+
+
+    def test_synchronousResult(self):
+        """
+        Functions that return synchronously work.
+        """
+        d = self.coalescer.call("key", lambda: 1)
+        self.assertEqual(self.successResultOf(d), 1)
+        self.assertFalse(self.coalescer.inFlight("key"))
+
+
+
+class CloneTreeTests(unittest.TestCase):
+    def test_cloneTree(self):
+        """
+        Cloning a tree copies its directories and the contents of its files.
+        """
+        source = filepath.FilePath(self.mktemp())
+        source.child("a").makedirs()
+        source.child("x").setContent("xyzzy")
+        source.child("a").child("y").setContent("plugh")
+
+        destination = filepath.FilePath(self.mktemp())
+        _util.cloneTree(source, destination)
+        self.assertEqual(destination.child("x").getContent(), "xyzzy")
+        self.assertEqual(destination.descendant(["a", "y"]).getContent(),
+                         "plugh")
+
+
+    def test_fallback(self):
+        """
+        Files are copied normally if they can't be cloned.
+        """
+        def ioctl(*a):
+            raise IOError()
+
+        self.patch(_util.fcntl, "ioctl", ioctl)
+        source = filepath.FilePath(self.mktemp())
+        source.setContent("xyzzy")
+        destination = filepath.FilePath(self.mktemp())
+        _util.cloneFile(source.path, destination.path)
+        self.assertEqual(destination.getContent(), "xyzzy")
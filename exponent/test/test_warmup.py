@@ -0,0 +1,102 @@
+"""
+Tests for warming up stores.
+"""
+from axiom import attributes, item, store
+from exponent import directory, storage, warmup
+from twisted.trial import unittest
+
+
+class StoreWarmerTests(unittest.TestCase):
+    def setUp(self):
+        self.rootStore = store.Store(self.mktemp())
+        userStore = store.Store(self.rootStore.filesdir.child("xyzzy"))
+        _Thing(store=userStore)
+        userStore.close()
+
+        self.warmer = warmup.StoreWarmer(store=self.rootStore)
+        self.rootStore.powerUp(self.warmer, warmup.IStoreWarmer)
+
+
+    def test_interface(self):
+        """
+        The store warmer provides ``IStoreWarmer``.
+        """
+        self.assertTrue(warmup.IStoreWarmer.providedBy(self.warmer))
+
+
+    def test_noWarmer(self):
+        """
+        Without a warmer, warming up a store does nothing.
+        """
+        otherStore = store.Store()
+        d = warmup.warm(otherStore, store.Store())
+        self.assertIdentical(self.successResultOf(d), otherStore)
+
+
+    def test_warmOnAcquire(self):
+        """
+        Lock directories warm up the stores they open, preloading the
+        configured item types.
+        """
+        loaded = []
+        self.patch(_Thing, "loaded", loaded)
+        self.warmer.itemTypes = [_qualifiedName(_Thing)]
+
+        lockDirectory = directory.LocalWriteLockDirectory(store=self.rootStore)
+        d = lockDirectory.acquire(["xyzzy"])
+
+        @d.addCallback
+        def checkWarmed(lock):
+            self.assertEqual(len(loaded), 1)
+            return lock.release()
+
+        return d
+
+
+    def test_warmWithoutReadAhead(self):
+        """
+        Reading ahead can be turned off, in which case warming up only
+        preloads items, synchronously.
+        """
+        self.warmer.readAhead = False
+        openedStore = store.Store(self.rootStore.filesdir.child("xyzzy"))
+        d = self.warmer.warm(openedStore)
+        self.assertIdentical(self.successResultOf(d), openedStore)
+
+
+    def test_warmHotStores(self):
+        """
+        Hot stores are opened in the root store's long-term storage. Hot
+        stores that don't exist are skipped.
+        """
+        fakeStorage = storage.FakeStorage(store=self.rootStore)
+        self.rootStore.powerUp(fakeStorage, storage.IStorage)
+        self.warmer.hotStores = [u"xyzzy", u"BOGUS"]
+
+        service = warmup.WarmUpService(self.warmer)
+        service.startService()
+
+        @service.warming.addCallback
+        def checkWarmed(_):
+            self.assertEqual(fakeStorage.pool.misses, 2)
+            self.assertEqual(len(fakeStorage.pool), 1)
+            self.flushLoggedErrors()
+
+        return service.warming
+
+
+
+def _qualifiedName(cls):
+    return u"{0}.{1}".format(cls.__module__, cls.__name__)
+
+
+
+class _Thing(item.Item):
+    """
+    An item that remembers when it is loaded.
+    """
+    _dummy = attributes.boolean()
+    loaded = []
+
+    def activate(self):
+        self.loaded.append(self)
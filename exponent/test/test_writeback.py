@@ -0,0 +1,187 @@
+"""
+Tests for scheduling write-backs of stores.
+"""
+from axiom import store
+from exponent import writeback
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+
+class WriteBackSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = writeback.WriteBackScheduler(
+            interval=10, maxConcurrent=2, clock=self.clock)
+        self.lock = _FakeLock()
+
+
+    def test_coalesce(self):
+        """
+        Stores marked dirty several times within an interval are written
+        back once, at the end of the interval.
+        """
+        for _ in range(5):
+            self.scheduler.markDirty(self.lock)
+        self.assertTrue(self.scheduler.isDirty(self.lock))
+
+        self.clock.advance(9)
+        self.assertEqual(self.lock.writes, [])
+        self.clock.advance(1)
+        self.assertEqual(len(self.lock.writes), 1)
+        self.assertEqual(self.scheduler.marks, 5)
+        self.assertEqual(self.scheduler.writes, 1)
+
+        self.lock.writes[0].callback(None)
+        self.assertFalse(self.scheduler.isDirty(self.lock))
+        self.clock.advance(10)
+        self.assertEqual(len(self.lock.writes), 1)
+
+
+    def test_transact(self):
+        """
+        Transactions run through the scheduler mark the store dirty.
+        """
+        self.lock.store = store.Store()
+        result = self.scheduler.transact(self.lock, lambda x: x * 2, 21)
+        self.assertEqual(result, 42)
+        self.assertTrue(self.scheduler.isDirty(self.lock))
+
+
+    def test_dirtyWhileWriting(self):
+        """
+        Stores that are marked dirty while they are being written back are
+        written back again afterwards, but never twice at the same time.
+        """
+        self.scheduler.markDirty(self.lock)
+        self.clock.advance(10)
+        self.scheduler.markDirty(self.lock)
+        self.clock.advance(10)
+        self.assertEqual(len(self.lock.writes), 1)
+
+        self.lock.writes[0].callback(None)
+        self.clock.advance(10)
+        self.assertEqual(len(self.lock.writes), 2)
+
+
+    def test_maxConcurrent(self):
+        """
+        No more than the maximum number of writes happen at the same time.
+        """
+        locks = [_FakeLock() for _ in range(3)]
+        for lock in locks:
+            self.scheduler.markDirty(lock)
+        self.clock.advance(10)
+        self.assertEqual([len(lock.writes) for lock in locks], [1, 1, 0])
+
+        locks[0].writes[0].callback(None)
+        self.assertEqual([len(lock.writes) for lock in locks], [1, 1, 1])
+
+
+    def test_releasedLocksNotWritten(self):
+        """
+        Stores of locks that have been released are not written back.
+        """
+        self.scheduler.markDirty(self.lock)
+        self.lock.released = True
+        self.clock.advance(10)
+        self.assertEqual(self.lock.writes, [])
+
+
+    def test_failedWriteRetried(self):
+        """
+        Stores that fail to be written back are written back again later.
+        """
+        self.scheduler.markDirty(self.lock)
+        self.clock.advance(10)
+        self.lock.writes[0].errback(RuntimeError())
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+        self.assertTrue(self.scheduler.isDirty(self.lock))
+        self.clock.advance(10)
+        self.assertEqual(len(self.lock.writes), 2)
+
+
+    def test_flushAndRelease(self):
+        """
+        Releasing through the scheduler writes back a dirty store right away,
+        and then releases the lock.
+        """
+        self.scheduler.markDirty(self.lock)
+        d = self.scheduler.release(self.lock)
+        self.assertEqual(len(self.lock.writes), 1)
+        self.assertFalse(self.lock.released)
+
+        self.lock.writes[0].callback(None)
+        self.successResultOf(d)
+        self.assertTrue(self.lock.released)
+
+
+    def test_flushWhileWriting(self):
+        """
+        Flushing a store that is being written back and has changed since
+        waits for the write, and then writes it back again.
+        """
+        self.scheduler.markDirty(self.lock)
+        self.clock.advance(10)
+        self.scheduler.markDirty(self.lock)
+
+        d = self.scheduler.flush(self.lock)
+        self.lock.writes[0].callback(None)
+        self.assertEqual(len(self.lock.writes), 2)
+        self.assertNoResult(d)
+        self.lock.writes[1].callback(None)
+        self.successResultOf(d)
+
+
+    def test_flushClean(self):
+        """
+        Flushing a store that isn't dirty doesn't write it back.
+        """
+        self.successResultOf(self.scheduler.flush(self.lock))
+        self.assertEqual(self.lock.writes, [])
+
+
+    def test_bandwidthLimit(self):
+        """
+        Writes are delayed to keep to the bandwidth limit.
+        """
+        scheduler = writeback.WriteBackScheduler(
+            interval=10, bytesPerSecond=100, clock=self.clock)
+        self.patch(writeback, "_storeSize", lambda lock: 300)
+
+        scheduler.markDirty(self.lock)
+        self.clock.advance(10)
+        self.assertEqual(len(self.lock.writes), 0)
+        self.clock.advance(2)
+        self.assertEqual(len(self.lock.writes), 1)
+
+
+    def test_stop(self):
+        """
+        Once stopped, the scheduler doesn't write anything back.
+        """
+        self.scheduler.markDirty(self.lock)
+        self.scheduler.stop()
+        self.clock.advance(10)
+        self.assertEqual(self.lock.writes, [])
+
+
+
+class _FakeLock(object):
+    """
+    A fake write lock that remembers its writes.
+    """
+    def __init__(self):
+        self.writes = []
+        self.released = False
+
+
+    def write(self):
+        d = defer.Deferred()
+        self.writes.append(d)
+        return d
+
+
+    def release(self):
+        self.released = True
+        return defer.succeed(None)
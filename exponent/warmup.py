@@ -0,0 +1,145 @@
+"""
+Warming up stores, so that the first queries after opening them are fast.
+"""
+from axiom import attributes, item
+from exponent import layout, storage, _util
+from twisted.application import service
+from twisted.internet import defer, threads
+from twisted.python import log, reflect
+from zope import interface
+
+
+class IStoreWarmer(interface.Interface):
+    """
+    Warms up stores after they have been opened.
+
+    Lock directories warm up the stores they open with the
+    ``IStoreWarmer`` powerup of their root store, if there is one.
+    """
+    def warm(openedStore):
+        """
+        Warms up a store that was just opened.
+
+        :return: A deferred that will fire with the store once it has been
+            warmed up.
+        """
+
+
+
+@interface.implementer(IStoreWarmer)
+class StoreWarmer(item.Item):
+    """
+    Warms up stores by reading their database file ahead in a thread, and
+    then loading the items of frequently used types.
+
+    Also warms up a list of hot stores, such as those of the most active
+    users, on request; ``WarmUpService`` does that when the application
+    starts.
+    """
+    powerupInterfaces = [IStoreWarmer]
+
+    readAhead = attributes.boolean(allowNone=False, default=True)
+    """
+    Whether to read the database file of opened stores ahead.
+    """
+
+    itemTypes = attributes.textlist(allowNone=False, default=[])
+    """
+    The fully qualified names of the item types to load from opened stores.
+    """
+
+    preloadLimit = attributes.integer(allowNone=False, default=1000)
+    """
+    The maximum number of items of each type to load.
+    """
+
+    hotStores = attributes.textlist(allowNone=False, default=[])
+    """
+    The ``/``-separated path segments of stores to warm up on startup.
+    """
+
+    maxConcurrent = attributes.integer(allowNone=False, default=4)
+    """
+    The maximum number of hot stores warmed up at the same time.
+    """
+
+    def warm(self, openedStore):
+        if self.readAhead and openedStore.dbdir is not None:
+            dbPath = openedStore.dbdir.child("db.sqlite")
+            d = threads.deferToThread(_util.readAhead, dbPath)
+        else:
+            d = defer.succeed(None)
+
+        return d.addCallback(lambda _: self._preload(openedStore))
+
+
+    def _preload(self, openedStore):
+        """
+        Loads the items of the configured types, so that the pages they are
+        on are in SQLite's page cache.
+        """
+        for typeName in self.itemTypes:
+            itemType = reflect.namedAny(typeName)
+            for _ in openedStore.query(itemType, limit=self.preloadLimit):
+                pass
+        return openedStore
+
+
+    def warmHotStores(self):
+        """
+        Warms up all of the hot stores: their database files are read ahead,
+        and if the root store has long-term storage, they are opened in it.
+
+        Hot stores that can't be warmed up are logged and skipped.
+
+        :return: A deferred that will fire when all hot stores have been
+            warmed up.
+        """
+        semaphore = defer.DeferredSemaphore(self.maxConcurrent)
+        longTermStorage = storage.IStorage(self.store, None)
+
+        def warmHotStore(pathSegments):
+            storePath = layout.storePathFor(self.store, pathSegments)
+            dbPath = storePath.child("db.sqlite")
+            d = threads.deferToThread(_util.readAhead, dbPath)
+            if longTermStorage is not None:
+                d.addCallback(lambda _: longTermStorage.get(pathSegments))
+            d.addErrback(log.err, "couldn't warm up %r" % (pathSegments,))
+            return d
+
+        ds = [semaphore.run(warmHotStore, hotStore.encode("utf-8").split("/"))
+              for hotStore in self.hotStores]
+        return defer.gatherResults(ds).addCallback(lambda _: None)
+
+
+
+def warm(openedStore, rootStore):
+    """
+    Warms up a freshly opened store with the root store's warmer, if it
+    has one.
+
+    :return: A deferred that will fire with the store.
+    """
+    warmer = IStoreWarmer(rootStore, None)
+    if warmer is None:
+        return defer.succeed(openedStore)
+    return warmer.warm(openedStore)
+
+
+
+class WarmUpService(service.Service):
+    """
+    A service that warms up the hot stores of a store warmer when it
+    starts, so that latency doesn't spike after a restart.
+
+    :ivar warming: A deferred that will fire when the hot stores have been
+        warmed up, once the service has started.
+    """
+    def __init__(self, warmer):
+        self.warmer = warmer
+        self.warming = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+        self.warming = self.warmer.warmHotStores()
@@ -0,0 +1,213 @@
+"""
+Scheduling write-backs of stores that are held with a write lock.
+"""
+from collections import OrderedDict
+from twisted.internet import defer, task
+from twisted.python import log
+
+
+class _TokenBucket(object):
+    """
+    A token bucket that limits the rate at which bytes can be written.
+
+    Reservations are always granted, but may put the bucket in debt; the
+    bucket says how long the reserver should wait before it is paid off.
+    """
+    def __init__(self, rate, clock):
+        self.rate = rate
+        self._clock = clock
+        self._tokens = 0.0
+        self._updated = clock.seconds()
+
+
+    def reserve(self, amount):
+        """
+        Reserves ``amount`` tokens.
+
+        :return: The number of seconds to wait before using them.
+        """
+        now = self._clock.seconds()
+        self._tokens = min(self._tokens + (now - self._updated) * self.rate,
+                           self.rate)
+        self._updated = now
+
+        self._tokens -= amount
+        return max(-self._tokens / self.rate, 0)
+
+
+
+def _storeSize(lock):
+    """
+    Estimates the number of bytes a write of the lock's store will write,
+    from the size of its database file.
+    """
+    dbdir = lock.store.dbdir
+    if dbdir is None:
+        return 0
+    dbPath = dbdir.child("db.sqlite")
+    return dbPath.getsize() if dbPath.exists() else 0
+
+
+
+class WriteBackScheduler(object):
+    """
+    Writes back stores held with write locks some time after they have
+    changed, coalescing many changes into a single write.
+
+    When a lock's store is marked dirty, it is written back within
+    ``interval`` seconds; any further changes before then are included in
+    that same write. At most ``maxConcurrent`` writes happen at the same
+    time. If ``bytesPerSecond`` is given, writes are delayed so that on
+    average no more than that many bytes are written per second, estimated
+    by the size of the stores' database files.
+
+    :ivar writes: The number of writes that were started.
+    :ivar marks: The number of times stores were marked dirty.
+    """
+    def __init__(self, interval=30, maxConcurrent=4, bytesPerSecond=None,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.interval = interval
+        self._clock = clock
+        self._semaphore = defer.DeferredSemaphore(maxConcurrent)
+        if bytesPerSecond is None:
+            self._bucket = None
+        else:
+            self._bucket = _TokenBucket(bytesPerSecond, clock)
+
+        self._dirty = OrderedDict()
+        self._writing = {}
+        self._call = None
+
+        self.writes = self.marks = 0
+
+
+    def markDirty(self, lock):
+        """
+        Marks the lock's store as changed, so that it will be written back.
+        """
+        self.marks += 1
+        self._dirty[lock] = None
+        self._schedule()
+
+
+    def isDirty(self, lock):
+        """
+        Checks if the lock's store has changes that haven't been written
+        back yet.
+        """
+        return lock in self._dirty or lock in self._writing
+
+
+    def transact(self, lock, f, *a, **kw):
+        """
+        Runs ``f(*a, **kw)`` in a transaction in the lock's store, and then
+        marks the store dirty.
+
+        :return: Whatever ``f`` returns.
+        """
+        result = lock.store.transact(f, *a, **kw)
+        self.markDirty(lock)
+        return result
+
+
+    def _schedule(self):
+        """
+        Schedules the next round of writes, unless one is already scheduled.
+        """
+        if self._call is None and self._dirty:
+            self._call = self._clock.callLater(self.interval, self._writeDirty)
+
+
+    def _writeDirty(self):
+        """
+        Starts writing back all of the dirty stores that aren't already
+        being written back. Stores that are will be written back in the
+        next round.
+        """
+        self._call = None
+
+        dirty, self._dirty = self._dirty, OrderedDict()
+        for lock in dirty:
+            if lock.released:
+                continue
+            elif lock in self._writing:
+                self._dirty[lock] = None
+            else:
+                self._write(lock).addErrback(lambda _: None)
+
+        self._schedule()
+
+
+    def _write(self, lock):
+        """
+        Writes back the lock's store, subject to the concurrency and
+        bandwidth limits. If the write fails, the store is marked dirty
+        again.
+        """
+        self._writing[lock] = []
+
+        def write():
+            self.writes += 1
+            if self._bucket is None:
+                return lock.write()
+            delay = self._bucket.reserve(_storeSize(lock))
+            d = task.deferLater(self._clock, delay, lambda: None)
+            return d.addCallback(lambda _: lock.write())
+
+        d = self._semaphore.run(write)
+
+        @d.addErrback
+        def retry(failure):
+            log.err(failure, "write-back failed, retrying later")
+            self.markDirty(lock)
+            return failure
+
+        @d.addBoth
+        def done(result):
+            for waiter in self._writing.pop(lock):
+                waiter.callback(None)
+            return result
+
+        return d
+
+
+    def flush(self, lock):
+        """
+        Immediately writes back the lock's store, if it is dirty, for example
+        before releasing the lock.
+
+        :return: A deferred that will fire when the store has been written
+            back.
+        """
+        if lock in self._writing:
+            d = defer.Deferred()
+            self._writing[lock].append(d)
+            return d.addCallback(lambda _: self.flush(lock))
+
+        if lock in self._dirty:
+            del self._dirty[lock]
+            return self._write(lock)
+        return defer.succeed(None)
+
+
+    def release(self, lock):
+        """
+        Writes back the lock's store if it is dirty, and then releases the
+        lock.
+
+        :return: A deferred that will fire when the lock has been released.
+        """
+        return self.flush(lock).addCallback(lambda _: lock.release())
+
+
+    def stop(self):
+        """
+        Stops scheduling writes. Stores that are still dirty are not written
+        back.
+        """
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None